@@ -184,3 +184,34 @@ class IQAReader:
             batch_a, batch_l, batch_doc_ids = [], [], []
 
         return [questions, answers, labels, question_ids, doc_ids]
+
+    def get_answer_pool(self):
+        """Gets all the answers of the pool, for retrieving answers from the whole pool instead of
+        ranking a small batch of them
+
+        Returns
+        -------
+        answer_ids : list of int
+        answers : list of list of str
+        """
+        answer_ids = sorted(self.answer_pool)
+        return answer_ids, [self._get_answer(answer_id) for answer_id in answer_ids]
+
+    def get_retrieval_test_data(self, split):
+        """Gets the questions of a test set with the ids of their correct answers in the pool of answers,
+        see `get_answer_pool`
+
+        Parameters
+        ----------
+        split : {'test1', 'test2'}
+            InsuraceQA provides these two test sets.
+
+        Returns
+        -------
+        questions : list of list of str
+        good_answer_ids : list of list of int
+        """
+        testx = self._get_pickle(split)
+        questions = [self._translate_sent(item['question']) for item in testx]
+        good_answer_ids = [list(item['good']) for item in testx]
+        return questions, good_answer_ids
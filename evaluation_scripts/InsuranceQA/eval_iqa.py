@@ -1,11 +1,12 @@
 import sys
 import os
 sys.path.append('../..')
-import numpy as np
 from sklearn.utils import shuffle
 from data_readers import IQAReader
 import gensim.downloader as api
-from sl_eval.models import MatchPyramid, DRMM_TKS
+from sl_eval.models import MatchPyramid, DRMM_TKS, NumpyWordVectors
+from sl_eval.models.utils.embedding_store import get_embedding_store
+from sl_eval.models.utils.trec_utils import write_qrels, write_run
 
 def save_qrels(test_data, fname):
     """Saves the WikiQA data `Truth Data`. This remains the same regardless of which model you use.
@@ -37,10 +38,7 @@ def save_qrels(test_data, fname):
 
     """
     queries, doc_group, label_group, query_ids, doc_id_group = test_data
-    with open(fname, 'w') as f:
-        for q, doc, labels, q_id, d_ids in zip(queries, doc_group, label_group, query_ids, doc_id_group):
-            for d, l, d_id in zip(doc, labels, d_ids):
-                f.write(q_id + '\t' +  '0' + '\t' +  str(d_id) + '\t' + str(l) + '\n')
+    write_qrels(fname, query_ids, doc_id_group, label_group)
     print("qrels done. Saved as %s" % fname)
 
 def save_model_pred(test_data, fname, similarity_fn):
@@ -79,77 +77,25 @@ def save_model_pred(test_data, fname, similarity_fn):
         Returns
             - similarity_score : float
     """
-    with open(fname, 'w') as f:
-        queries, doc_group, label_group, query_ids, doc_id_group = test_data
-        for q, doc, labels, q_id, d_ids in zip(queries, doc_group, label_group, query_ids, doc_id_group):
-            for d, l, d_id in zip(doc, labels, d_ids):
-                my_score = str(similarity_fn(q,d))
-                f.write(q_id + '\t' + 'Q0' + '\t' + str(d_id) + '\t' + '99' + '\t' + my_score + '\t' + 'STANDARD' + '\n')
+    queries, doc_group, label_group, query_ids, doc_id_group = test_data
+    score_groups = ([similarity_fn(q, d) for d in doc] for q, doc in zip(queries, doc_group))
+    write_run(fname, query_ids, doc_id_group, score_groups)
     print("Prediction done. Saved as %s" % fname)
 
 
-def w2v_similarity_fn(q, d):
-    """Similarity Function for Word2Vec
-
-    Parameters
-    ----------
-    query : list of str
-    doc : list of str
-
-    Returns
-    -------
-    similarity_score : float
-    """
-    def sent2vec(sent):
-        if len(sent)==0:
-            print('length is 0, Returning random')
-            return np.random.random((kv_model.vector_size,))
-
-        vec = []
-        for word in sent:
-            if word in kv_model:
-                vec.append(kv_model[word])
-
-        if len(vec) == 0:
-            print('No words in vocab, Returning random')
-            return np.random.random((kv_model.vector_size,))
-
-        vec = np.array(vec)
-
-        return np.mean(vec, axis=0)
-
-    def cosine_similarity(vec1, vec2):
-        return np.dot(vec1, vec2)/(np.linalg.norm(vec1)* np.linalg.norm(vec2))
-    return cosine_similarity(sent2vec(q),sent2vec(d))
-
-
-def mp_similarity_fn(q, d):
-    """Similarity Function for DRMM TKS
+def save_model_scores(test_data, fname, model):
+    """Same as `save_model_pred`, with the scores of `model.score_groups`, which scores the whole test data
+    in large batches instead of predicting one pair at a time
 
     Parameters
     ----------
-    query : list of str
-    doc : list of str
-
-    Returns
-    -------
-    similarity_score : float
-    """
-    return mp_model.predict([q], [[d]])[0][0]
-
-def dtks_similarity_fn(q, d):
-    """Similarity Function for DRMM TKS
-
-    Parameters
-    ----------
-    query : list of str
-    doc : list of str
-
-    Returns
-    -------
-    similarity_score : float
+    fname : str
+        File where the predictions should be saved
+    model : a model with a `score_groups` method, like :class:`~sl_eval.models.DRMM_TKS`
     """
-    return dtks_model.predict([q], [[d]])[0][0]
+    queries, doc_group, label_group, query_ids, doc_id_group = test_data
+    write_run(fname, query_ids, doc_id_group, model.score_groups(queries, doc_group))
+    print("Prediction done. Saved as %s" % fname)
 
 
 if __name__ == '__main__':
@@ -177,10 +123,13 @@ if __name__ == '__main__':
     test2_data = iqa_reader.get_test_data('test2', batch_size=test_batch_size)
 
     kv_model = api.load('glove-wiki-gigaword-' + str(word_embedding_len))
+    # Both models share one copy of the embedding matrix
+    embedding_store = get_embedding_store(kv_model, cache_dir=os.path.join('..', '..', 'data', 'vocab_cache'))
     
     print('Getting word2vec baselines')
-    save_model_pred(test1_data, 'pred_iqa_baseline_test1_w2v', w2v_similarity_fn)
-    save_model_pred(test2_data, 'pred_iqa_baseline_test2_w2v', w2v_similarity_fn)
+    word_vectors = NumpyWordVectors.from_keyed_vectors(kv_model)
+    save_model_scores(test1_data, 'pred_iqa_baseline_test1_w2v', word_vectors)
+    save_model_scores(test2_data, 'pred_iqa_baseline_test2_w2v', word_vectors)
     save_qrels(test1_data, 'qrels_iqa_baseline_test1_w2v')
     save_qrels(test2_data, 'qrels_iqa_baseline_test2_w2v')
 
@@ -190,13 +139,13 @@ if __name__ == '__main__':
     print('Training on InsuranceQA with MatchPyramid')
     mp_model = MatchPyramid(queries=train_q, docs=train_d, labels=train_l, target_mode='ranking',
                           word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size,
-                          steps_per_epoch=steps_per_epoch)
+                          steps_per_epoch=steps_per_epoch, embedding_store=embedding_store)
 
     save_qrels(test1_data, qrels1_save_name_mp)
-    save_model_pred(test1_data, pred1_save_name_mp, mp_similarity_fn)
+    save_model_scores(test1_data, pred1_save_name_mp, mp_model)
 
     save_qrels(test2_data, qrels2_save_name_mp)
-    save_model_pred(test2_data, pred2_save_name_mp, mp_similarity_fn)
+    save_model_scores(test2_data, pred2_save_name_mp, mp_model)
 
 
 
@@ -216,10 +165,10 @@ if __name__ == '__main__':
     print('Training on InsuranceQA with DRMM_TKS')
     dtks_model = DRMM_TKS(queries=train_q, docs=train_d, labels=train_l, target_mode='ranking',
                           word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size,
-                          steps_per_epoch=steps_per_epoch)
+                          steps_per_epoch=steps_per_epoch, embedding_store=embedding_store)
 
     save_qrels(test1_data, qrels1_save_name_dtks)
-    save_model_pred(test1_data, pred1_save_name_dtks, dtks_similarity_fn)
+    save_model_scores(test1_data, pred1_save_name_dtks, dtks_model)
 
     save_qrels(test2_data, qrels2_save_name_dtks)
-    save_model_pred(test2_data, pred2_save_name_dtks, dtks_similarity_fn)
+    save_model_scores(test2_data, pred2_save_name_dtks, dtks_model)
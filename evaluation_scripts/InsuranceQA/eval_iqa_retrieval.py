@@ -0,0 +1,106 @@
+"""This script evaluates two stage retrieval on InsuranceQA: the answers of each test question are fetched
+from the whole pool of answers with a nearest neighbour index over mean word vectors, then re-ranked with
+DRMM_TKS and MatchPyramid. The recall and the latency of each stage are reported."""
+
+import sys
+import os
+sys.path.append('../..')
+import numpy as np
+from sklearn.utils import shuffle
+from data_readers import IQAReader
+import gensim.downloader as api
+from sl_eval.models import MatchPyramid, DRMM_TKS, NumpyWordVectors
+from sl_eval.models.utils.embedding_store import get_embedding_store
+from sl_eval.models.utils.evaluation_metrics import mean_recall
+from sl_eval.models.utils.retrieval import TwoStageRetriever
+
+
+def report_retrieval(retriever, questions, good_answer_ids, n_candidates, n_results):
+    """Prints the recall and the latency of each stage of the retriever on the test questions
+
+    Parameters
+    ----------
+    retriever : :class:`~sl_eval.models.utils.retrieval.TwoStageRetriever`
+    questions : list of list of str
+    good_answer_ids : list of list of int
+        The ids of the correct answers of each question, as positions in the indexed answers
+    n_candidates : int
+        The number of answers fetched from the index for each question
+    n_results : int
+        The number of answers kept after re-ranking
+    """
+    candidates = retriever.retrieve(questions, n_candidates)
+    print('Candidate generation : recall@%d = %.4f, recall@%d = %.4f' % (
+        n_candidates, mean_recall(candidates, good_answer_ids),
+        n_results, mean_recall(candidates, good_answer_ids, k=n_results)))
+
+    if retriever.reranker is not None:
+        doc_ids, _ = retriever.rerank(questions, candidates, n_results)
+        print('Re-ranking : recall@%d = %.4f, recall@1 = %.4f' % (
+            n_results, mean_recall(doc_ids, good_answer_ids), mean_recall(doc_ids, good_answer_ids, k=1)))
+
+    for stage in ['retrieval', 'reranking']:
+        if stage in retriever.timings:
+            elapsed, n_queries = retriever.timings[stage]
+            print('%s latency : %.2fms per question (%.2fs for %d questions)' % (
+                stage.capitalize(), 1000. * elapsed / n_queries, elapsed, n_queries))
+
+
+if __name__ == '__main__':
+    iqa_folder_path = os.path.join('..', '..', 'data', 'insurance_qa_python')
+    iqa_reader = IQAReader(iqa_folder_path)
+
+    # PARAMETERS ---------------------------------------------------------
+    train_batch_size = 50
+    word_embedding_len = 300
+    batch_size = 50
+    text_maxlen = 200
+    n_epochs = 5
+    index_type = 'ivf'
+    n_candidates = 100
+    n_results = 10
+    # --------------------------------------------------------------------
+
+    train_q, train_d, train_l = iqa_reader.get_train_data(batch_size=train_batch_size)
+    train_q, train_d, train_l = shuffle(train_q, train_d, train_l)
+    steps_per_epoch = len(train_q)//batch_size
+
+    answer_ids, answers = iqa_reader.get_answer_pool()
+    # The retriever gives the answers their position in `answers` as ids
+    answer_positions = {answer_id: i for i, answer_id in enumerate(answer_ids)}
+    test_data = {}
+    for split in ['test1', 'test2']:
+        questions, good_answer_ids = iqa_reader.get_retrieval_test_data(split)
+        test_data[split] = questions, [[answer_positions[a] for a in ids] for ids in good_answer_ids]
+
+    kv_model = api.load('glove-wiki-gigaword-' + str(word_embedding_len))
+    # Both models share one copy of the embedding matrix
+    embedding_store = get_embedding_store(kv_model, cache_dir=os.path.join('..', '..', 'data', 'vocab_cache'))
+    word_vectors = NumpyWordVectors.from_keyed_vectors(kv_model)
+
+    retriever = TwoStageRetriever(word_vectors, index_type, n_lists=int(np.sqrt(len(answers))))
+    retriever.index_docs(answers)
+    print('Indexed %d answers in %.2fs' % (len(answers), retriever.timings['indexing'][0]))
+
+    print('Word2Vec retrieval without re-ranking')
+    for split, (questions, good_answer_ids) in test_data.items():
+        print('On %s' % split)
+        report_retrieval(retriever, questions, good_answer_ids, n_candidates, n_results)
+
+    print('Training on InsuranceQA with MatchPyramid')
+    mp_model = MatchPyramid(queries=train_q, docs=train_d, labels=train_l, target_mode='ranking',
+                          word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size,
+                          steps_per_epoch=steps_per_epoch, embedding_store=embedding_store)
+    retriever.reranker = mp_model
+    for split, (questions, good_answer_ids) in test_data.items():
+        print('MatchPyramid re-ranking on %s' % split)
+        report_retrieval(retriever, questions, good_answer_ids, n_candidates, n_results)
+
+    print('Training on InsuranceQA with DRMM_TKS')
+    dtks_model = DRMM_TKS(queries=train_q, docs=train_d, labels=train_l, target_mode='ranking',
+                          word_embedding=kv_model, epochs=n_epochs, text_maxlen=300, batch_size=batch_size,
+                          steps_per_epoch=steps_per_epoch, embedding_store=embedding_store)
+    retriever.reranker = dtks_model
+    for split, (questions, good_answer_ids) in test_data.items():
+        print('DRMM_TKS re-ranking on %s' % split)
+        report_retrieval(retriever, questions, good_answer_ids, n_candidates, n_results)
@@ -39,6 +39,8 @@ import sys
 import os
 
 from sl_eval.models import MatchPyramid, DRMM_TKS, BiDAF_T
+from sl_eval.models.utils.embedding_store import get_embedding_store
+from sl_eval.models.utils.trec_utils import write_qrels, write_run
 from data_readers import WikiReaderIterable, WikiReaderStatic
 import gensim.downloader as api
 import argparse
@@ -73,10 +75,7 @@ def save_qrels(test_data, fname):
 
     """
     queries, doc_group, label_group, query_ids, doc_id_group = test_data
-    with open(fname, 'w') as f:
-        for q, doc, labels, q_id, d_ids in zip(queries, doc_group, label_group, query_ids, doc_id_group):
-            for d, l, d_id in zip(doc, labels, d_ids):
-                f.write(q_id + '\t' +  '0' + '\t' +  str(d_id) + '\t' + str(l) + '\n')
+    write_qrels(fname, query_ids, doc_id_group, label_group)
     print("qrels done. Saved as %s" % fname)
 
 def save_model_pred(test_data, fname, similarity_fn):
@@ -116,40 +115,24 @@ def save_model_pred(test_data, fname, similarity_fn):
             - similarity_score : float
     """
     queries, doc_group, label_group, query_ids, doc_id_group = test_data
-    with open(fname, 'w') as f:
-        for q, doc, labels, q_id, d_ids in zip(queries, doc_group, label_group, query_ids, doc_id_group):
-            for d, l, d_id in zip(doc, labels, d_ids):
-                my_score = str(similarity_fn(q,d))
-                f.write(q_id + '\t' + 'Q0' + '\t' + str(d_id) + '\t' + '99' + '\t' + my_score + '\t' + 'STANDARD' + '\n')
+    score_groups = ([similarity_fn(q, d) for d in doc] for q, doc in zip(queries, doc_group))
+    write_run(fname, query_ids, doc_id_group, score_groups)
     print("Prediction done. Saved as %s" % fname)
 
-def dtks_similarity_fn(q, d):
-    """Similarity Function for DRMM TKS
 
-    Parameters
-    ----------
-    query : list of str
-    doc : list of str
-
-    Returns
-    -------
-    similarity_score : float
-    """
-    return drmm_tks_model.predict([q], [[d]])[0][0]
-
-def mp_similarity_fn(q, d):
-    """Similarity Function for DRMM TKS
+def save_model_scores(test_data, fname, model):
+    """Same as `save_model_pred`, with the scores of `model.score_groups`, which scores the whole test data
+    in large batches instead of predicting one pair at a time
 
     Parameters
     ----------
-    query : list of str
-    doc : list of str
-
-    Returns
-    -------
-    similarity_score : float
+    fname : str
+        File where the predictions should be saved
+    model : a model with a `score_groups` method, like :class:`~sl_eval.models.DRMM_TKS`
     """
-    return mp_model.predict([q], [[d]])[0][0]
+    queries, doc_group, label_group, query_ids, doc_id_group = test_data
+    write_run(fname, query_ids, doc_id_group, model.score_groups(queries, doc_group))
+    print("Prediction done. Saved as %s" % fname)
 
 
 if __name__ == '__main__':
@@ -206,6 +189,11 @@ if __name__ == '__main__':
     save_qrels(test_data, qrels_save_path)
 
     kv_model = api.load('glove-wiki-gigaword-' + str(num_embedding_dims))
+    # The models with the same embedding settings share one copy of the embedding matrix. BiDAF_T uses the raw
+    # vectors with a zero pad word, so it builds its own
+    vocab_cache_dir = os.path.join('..', '..', 'data', 'vocab_cache')
+    mp_embedding_store = get_embedding_store(kv_model, unk_handle_method='zero', cache_dir=vocab_cache_dir)
+    dtks_embedding_store = get_embedding_store(kv_model, cache_dir=vocab_cache_dir)
 
 
 
@@ -226,20 +214,12 @@ if __name__ == '__main__':
 
         print('Pretraining on SQUAD-T dataset')
         bidaf_t_model = BiDAF_T(q_squad, d_squad, l_squad, kv_model, n_epochs=n_epochs,
-                                steps_per_epoch=steps_per_epoch_squad)
+                                steps_per_epoch=steps_per_epoch_squad,
+                                vocab_workers=os.cpu_count(), train_shards_dir='squad_t_shards')
 
 
         print('Testing on WikiQA-test')
-        queries, doc_group, label_group, query_ids, doc_id_group = test_data
-        i=0
-        with open(bidaf_t_pred_save_path, 'w') as f:
-            for q, doc, labels, q_id, d_ids in zip(queries, doc_group, label_group, query_ids, doc_id_group):
-                batch_score = bidaf_t_model.batch_predict(q, doc)
-                for d, l, d_id, bscore in zip(doc, labels, d_ids, batch_score):
-                    my_score = bscore[1]
-                    i += 1
-                    f.write(q_id + '\t' + 'Q0' + '\t' + str(d_id) + '\t' + '99' + '\t' + str(my_score) + '\t' + 'STANDARD' + '\n')
-        print("Prediction done. Saved as %s" % bidaf_t_pred_save_path)
+        save_model_scores(test_data, bidaf_t_pred_save_path, bidaf_t_model)
 
 
         print('FineTuning on WikiQA-train set')
@@ -252,16 +232,7 @@ if __name__ == '__main__':
 
 
         print('Testing on WikiQA-test after finetuning')
-        queries, doc_group, label_group, query_ids, doc_id_group = test_data
-        i=0
-        with open(bidaf_t_finetuned_pred_save_path, 'w') as f:
-            for q, doc, labels, q_id, d_ids in zip(queries, doc_group, label_group, query_ids, doc_id_group):
-                batch_score = bidaf_t_model.batch_predict(q, doc)
-                for d, l, d_id, bscore in zip(doc, labels, d_ids, batch_score):
-                    my_score = bscore[1]
-                    i += 1
-                    f.write(q_id + '\t' + 'Q0' + '\t' + str(d_id) + '\t' + '99' + '\t' + str(my_score) + '\t' + 'STANDARD' + '\n')
-        print("Prediction done. Saved as %s" % bidaf_t_finetuned_pred_save_path)        
+        save_model_scores(test_data, bidaf_t_finetuned_pred_save_path, bidaf_t_model)
 
     if do_mp:
         n_epochs = 2 
@@ -273,14 +244,14 @@ if __name__ == '__main__':
         mp_model = MatchPyramid(
                             queries=q_iterable, docs=d_iterable, labels=l_iterable, word_embedding=kv_model,
                             epochs=n_epochs, steps_per_epoch=steps_per_epoch, batch_size=batch_size, text_maxlen=text_maxlen,
-                            unk_handle_method='zero'
+                            unk_handle_method='zero', embedding_store=mp_embedding_store
                         )
 
         print('Test set results')
         mp_model.evaluate(q_test_iterable, d_test_iterable, l_test_iterable)
 
         print('Saving prediction on test data in TREC format')
-        save_model_pred(test_data, mp_pred_save_path, mp_similarity_fn)
+        save_model_scores(test_data, mp_pred_save_path, mp_model)
 
     if do_dtks:
         batch_size = 10
@@ -290,12 +261,13 @@ if __name__ == '__main__':
         # Train the model
         drmm_tks_model = DRMM_TKS(
                             queries=q_iterable, docs=d_iterable, labels=l_iterable, word_embedding=kv_model, epochs=n_epochs,
-                            topk=20, steps_per_epoch=steps_per_epoch, batch_size=batch_size
+                            topk=20, steps_per_epoch=steps_per_epoch, batch_size=batch_size,
+                            embedding_store=dtks_embedding_store
                         )
 
         print('Test set results')
         drmm_tks_model.evaluate(q_test_iterable, d_test_iterable, l_test_iterable)
 
         print('Saving prediction on test data in TREC format')
-        save_model_pred(test_data, dtks_pred_save_path, dtks_similarity_fn)
+        save_model_scores(test_data, dtks_pred_save_path, drmm_tks_model)
 
@@ -1,6 +1,7 @@
 """This script evaluates the DRMM_TKS, MatchPyramid and BiDAF-T model on Quora Duplicate Questions Task"""
 
 import sys
+import os
 sys.path.append('..')
 
 import numpy as np
@@ -8,47 +9,15 @@ from gensim import downloader as api
 from sklearn.utils import shuffle
 from sl_eval.models.matchpyramid import MatchPyramid
 from sl_eval.models.drmm_tks import DRMM_TKS
+from sl_eval.models.baseline_numpy import NumpyWordVectors
 import re
 
-def w2v_similarity_fn(q, d):
-    """Similarity Function for Word2Vec
-
-    Parameters
-    ----------
-    query : list of str
-    doc : list of str
-
-    Returns
-    -------
-    similarity_score : float
-    """
-    def sent2vec(sent):
-        if len(sent)==0:
-            print('length is 0, Returning random')
-            return np.random.random((kv_model.vector_size,))
-
-        vec = []
-        for word in sent:
-            if word in kv_model:
-                vec.append(kv_model[word])
-
-        if len(vec) == 0:
-            print('No words in vocab, Returning random')
-            return np.random.random((kv_model.vector_size,))
-
-        vec = np.array(vec)
-
-        return np.mean(vec, axis=0)
-
-    def cosine_similarity(vec1, vec2):
-        return np.dot(vec1, vec2)/(np.linalg.norm(vec1)* np.linalg.norm(vec2))
-    return cosine_similarity(sent2vec(q),sent2vec(d))
-
 if __name__ == '__main__':
 
 	train_split = 0.8
 	num_samples = 323432
 	n_word_embedding_dims = 300
+	vocab_cache_dir = os.path.join('..', 'data', 'vocab_cache')
 
 	qqp = api.load('quora-duplicate-questions')
 
@@ -96,12 +65,9 @@ if __name__ == '__main__':
 	kv_model = api.load('glove-wiki-gigaword-' + str(n_word_embedding_dims))
 
 	print('Getting word2vec baseline')
-	num_correct, num_total = 0, 0
-	for q1, q2, d in zip(test_q1, test_q2, test_duplicate):
-		if w2v_similarity_fn(q1, q2) >= 0 and d == 1 or w2v_similarity_fn(q1, q2) < 0 and d == 0:
-			num_correct += 1
-		num_total += 1
-	print('Word2Vec baseline accuracy is %f' % (100. * num_correct / num_total))
+	similarities = NumpyWordVectors.from_keyed_vectors(kv_model).cosine_similarity(test_q1, test_q2)
+	is_correct = (similarities >= 0) == (np.array(test_duplicate) == 1)
+	print('Word2Vec baseline accuracy is %f' % (100. * np.mean(is_correct)))
 
 
 	n_epochs = 10
@@ -110,7 +76,7 @@ if __name__ == '__main__':
 	
 	mp_model = MatchPyramid(queries=train_q1, docs=train_q2, labels=train_duplicate, target_mode='classification',
 							word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size,
-							steps_per_epoch=num_samples//batch_size)
+							steps_per_epoch=num_samples//batch_size, cache_dir=vocab_cache_dir)
 	num_correct, num_total, accuracy = mp_model.evaluate_classification(test_q1, test_q2, test_duplicate, batch_size=20)
 	print('Results on MatchPyramid with Quora Duplicate Questions dataset')
 	print('Accuracy = %.2f' % (accuracy*100))
@@ -122,7 +88,7 @@ if __name__ == '__main__':
 	text_maxlen = 100
 	dtks_model = DRMM_TKS(queries=train_q1, docs=train_q2, labels=train_duplicate, target_mode='classification',
 	                     word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size,
-	                     steps_per_epoch=num_samples//batch_size)
+	                     steps_per_epoch=num_samples//batch_size, cache_dir=vocab_cache_dir)
 	num_correct, num_total, accuracy = dtks_model.evaluate_classification(test_q1, test_q2, test_duplicate, batch_size=20)
 	print('Results on DRMM_TKS with Quora Duplicate Questions dataset')
 	print('Accuracy = %.2f' % (accuracy*100))
@@ -12,6 +12,7 @@ from sl_eval.models import MatchPyramid, DRMM_TKS
 if __name__ == '__main__':
 	sick_folder_path = os.path.join('..', 'data')
 	sick_reader = SickReader(sick_folder_path)
+	vocab_cache_dir = os.path.join('..', 'data', 'vocab_cache')
 
 
 	x1, x2, label = sick_reader.get_entailment_data()
@@ -29,7 +30,8 @@ if __name__ == '__main__':
  
 	steps_per_epoch = len(train_x1)//batch_size
 	mp_model = MatchPyramid(queries=train_x1, docs=train_x2, labels=train_labels, target_mode='inference',
-	                     word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size, steps_per_epoch=steps_per_epoch)
+	                     word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size, steps_per_epoch=steps_per_epoch,
+	                     cache_dir=vocab_cache_dir)
 	num_correct, num_total, accuracy = mp_model.evaluate_inference(test_x1, test_x2, test_labels)
 	print('Results on MatchPyramid with SICK dataset')
 	print('Accuracy = %.2f' % (accuracy*100))
@@ -41,7 +43,7 @@ if __name__ == '__main__':
 	n_epochs = 5
 	dtks_model = DRMM_TKS(queries=train_x1, docs=train_x2, labels=train_labels, target_mode='inference',
 	                     word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size,
-	                     steps_per_epoch=steps_per_epoch)
+	                     steps_per_epoch=steps_per_epoch, cache_dir=vocab_cache_dir)
 	num_correct, num_total, accuracy = dtks_model.evaluate_inference(test_x1, test_x2, test_labels)
 	print('Results on DRMM_TKS with SICK dataset')
 	print('Accuracy = %.2f' % (accuracy*100))
@@ -11,6 +11,7 @@ if __name__ == '__main__':
 
 	snli_folder_path = os.path.join('..', 'data', 'snli_1.0')
 	snli_reader = SnliReader(snli_folder_path)
+	vocab_cache_dir = os.path.join('..', 'data', 'vocab_cache')
 
 	train_x1, train_x2, train_labels, train_annotator_labels = snli_reader.get_data('train')
 	test_x1, test_x2, test_labels, test_annotator_labels = snli_reader.get_data('test')
@@ -29,7 +30,8 @@ if __name__ == '__main__':
 
 	print('Training MatchPyramid on SNLI')
 	mp_model = MatchPyramid(queries=train_x1, docs=train_x2, labels=train_labels, target_mode='inference',
-	                     word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size, steps_per_epoch=steps_per_epoch)
+	                     word_embedding=kv_model, epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size, steps_per_epoch=steps_per_epoch,
+	                     cache_dir=vocab_cache_dir)
 	num_correct, num_total, accuracy = mp_model.evaluate_inference(test_x1, test_x2, test_labels)
 	print('Results on MatchPyramid with SNLI dataset')
 	print('Accuracy = %.2f' % (accuracy*100))
@@ -43,7 +45,8 @@ if __name__ == '__main__':
 	steps_per_epoch = len(train_x1)//batch_size
 
 	dtks_model = DRMM_TKS(queries=train_x1, docs=train_x2, labels=train_labels, target_mode='inference', word_embedding=kv_model,
-						  epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size, steps_per_epoch=steps_per_epoch)
+						  epochs=n_epochs, text_maxlen=text_maxlen, batch_size=batch_size, steps_per_epoch=steps_per_epoch,
+						  cache_dir=vocab_cache_dir)
 	num_correct, num_total, accuracy = dtks_model.evaluate_inference(test_x1, test_x2, test_labels)
 	print('Results on DRMM_TKS with SNLI dataset')
 	print('Accuracy = %.2f' % (accuracy*100))
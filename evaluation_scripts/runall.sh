@@ -15,6 +15,9 @@ echo "Running eval on InsuranceQA"
 cd ../InsuranceQA
 python eval_iqa.py
 
+echo "Running two stage retrieval eval on InsuranceQA"
+python eval_iqa_retrieval.py
+
 echo "Running Glove + NN  baseline on Quora"
 cd ..
 python eval_baseline_qp.py
@@ -1,4 +1,30 @@
-from .matchpyramid import MatchPyramid
-from .drmm_tks import DRMM_TKS
-from .bidaf_t import BiDAF_T
-from .baseline import BaselineModel
+import importlib
+import sys
+
+# The module of each model. From python 3.7, they are only imported when first used, so the NumPy scorers
+# can be imported without loading TensorFlow and Keras
+_MODEL_MODULES = {
+    'MatchPyramid': '.matchpyramid',
+    'DRMM_TKS': '.drmm_tks',
+    'BiDAF_T': '.bidaf_t',
+    'BaselineModel': '.baseline',
+    'NumpyDRMM_TKS': '.drmm_tks_numpy',
+    'NumpyBaselineModel': '.baseline_numpy',
+    'NumpyWordVectors': '.baseline_numpy',
+}
+
+__all__ = list(_MODEL_MODULES)
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name in _MODEL_MODULES:
+            return getattr(importlib.import_module(_MODEL_MODULES[name], __name__), name)
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    # Module level __getattr__ needs python 3.7
+    from .matchpyramid import MatchPyramid
+    from .drmm_tks import DRMM_TKS
+    from .bidaf_t import BiDAF_T
+    from .baseline import BaselineModel
+    from .drmm_tks_numpy import NumpyDRMM_TKS
+    from .baseline_numpy import NumpyBaselineModel, NumpyWordVectors
@@ -1,6 +1,8 @@
 from keras.layers import Embedding, Dense, Input, Concatenate
 from keras.models import Model
 
+from .baseline_numpy import NumpyBaselineModel, NumpyWordVectors
+
 
 class BaselineModel:
     '''A simple Baseline model which uses Dense/Fully Connected Neural Networks
@@ -40,6 +42,30 @@ class BaselineModel:
 
         self.model.fit(X, y, epochs=n_epochs)
 
+    def export_npz(self, fname, kv_model=None):
+        '''Exports the weights of the Dense layers to a .npz file, which
+        :class:`~sl_eval.models.baseline_numpy.NumpyBaselineModel` loads to predict without Keras
+
+        Parameters
+        ----------
+        fname : str
+            Path to the .npz file
+        kv_model : :class:`~gensim.models.keyedvectors.KeyedVectors`, optional
+            The word embeddings the sentence vectors of the train data were averaged from.
+            If given, they are exported too, so the NumPy model can predict from sentences
+        '''
+        if self.model is None:
+            raise ValueError('The model has to be trained before being exported')
+        dense_layers = [layer for layer in self.model.layers if isinstance(layer, Dense)]
+        word_vectors = None
+        if kv_model is not None:
+            word_vectors = NumpyWordVectors.from_keyed_vectors(kv_model)
+        NumpyBaselineModel(
+            [layer.get_weights() for layer in dense_layers],
+            [layer.get_config()['activation'] for layer in dense_layers],
+            word_vectors
+        ).save(fname)
+
     def _get_model(self):
         '''Gets the keras model of the needed `model_type` '''
         input_vec1 = Input(shape=(self.vector_size,), name='x1')
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module scores sentence pairs like :class:`~sl_eval.models.baseline.BaselineModel` and the word2vec
+cosine baselines of the evaluation scripts, in NumPy only, without Keras or gensim.
+
+Both baselines work on the mean word vectors of the sentences. These are computed here for a whole batch of
+sentences at once: one hash lookup for all their words, one gather of the vectors and one sum per sentence
+with `np.add.reduceat`. The pairs are read as a stream, so millions of them can be scored without holding
+them all in memory, which makes the baselines usable as a cheap first stage before the neural models.
+
+Examples
+--------
+The cosine baseline, from the KeyedVectors of the evaluation scripts
+
+>>> from sl_eval.models.baseline_numpy import NumpyWordVectors
+>>> word_vectors = NumpyWordVectors.from_keyed_vectors(kv_model)
+>>> word_vectors.cosine_similarity([["how", "old", "are", "you"]], [["what", "is", "your", "age"]])
+
+A trained BaselineModel, exported with the KeyedVectors it was trained on
+
+>>> model.export_npz('baseline.npz', kv_model)
+>>> numpy_model = NumpyBaselineModel.load('baseline.npz')
+>>> for predictions in numpy_model.iter_predict(queries, docs):
+...     pass
+"""
+
+import logging
+from itertools import islice
+import numpy as np
+
+from .utils.word_hashes import hash_words, lookup_hashes
+from .utils.trec_utils import DEFAULT_SCORE_BATCH_SIZE, iter_group_batches
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the exported file changes
+NPZ_VERSION = 1
+
+# The number of pairs scored at once by the streaming methods
+DEFAULT_PAIR_BATCH_SIZE = 100000
+
+# Keeps the cosine similarity of zero vectors at 0
+NORM_EPSILON = 1e-12
+
+
+def _relu(x):
+    return np.maximum(x, 0)
+
+
+def _softmax(x):
+    """Softmax over the last axis"""
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def _linear(x):
+    return x
+
+
+ACTIVATIONS = {'relu': _relu, 'softmax': _softmax, 'linear': _linear}
+
+
+def _iter_pair_batches(queries, docs, batch_size):
+    """Yields the (query, doc) pairs in lists of `batch_size` queries and docs"""
+    pairs = zip(queries, docs)
+    while True:
+        batch = list(islice(pairs, batch_size))
+        if not batch:
+            return
+        batch_queries, batch_docs = zip(*batch)
+        yield list(batch_queries), list(batch_docs)
+
+
+def _check_version(arrays):
+    if int(arrays['version']) != NPZ_VERSION:
+        raise ValueError("Unkown version %d of the exported file. It must be %d" %
+                         (int(arrays['version']), NPZ_VERSION))
+
+
+class NumpyWordVectors:
+    """The mean word vectors of sentences and their cosine similarity, like the `w2v_similarity_fn` of the
+    evaluation scripts
+
+    Unlike `w2v_similarity_fn`, which gives a random vector to a sentence with no known word, such sentences
+    get the zero vector here, so their cosine similarity is 0 and the scores don't change from one run to another.
+    """
+
+    def __init__(self, vectors, sorted_hashes, sorted_ids):
+        """
+        Parameters
+        ----------
+        vectors : numpy array of shape (n_words, vector_size)
+            The rows are cast to float32 when they are looked up, so it can be stored in float16
+        sorted_hashes : numpy array of uint64
+        sorted_ids : numpy array of int
+            The sorted hash index of the words, see :class:`~sl_eval.models.utils.vocab.Vocabulary`
+        """
+        self.vectors = vectors
+        self.vector_size = vectors.shape[1]
+        self.sorted_hashes = sorted_hashes
+        self.sorted_ids = sorted_ids
+
+    @classmethod
+    def from_keyed_vectors(cls, kv_model, dtype=np.float32):
+        """Builds the word vectors from a :class:`~gensim.models.keyedvectors.KeyedVectors`
+
+        Parameters
+        ----------
+        kv_model : :class:`~gensim.models.keyedvectors.KeyedVectors`
+        dtype : numpy dtype, optional
+            The dtype the vectors are stored in
+        """
+        hashes = hash_words(kv_model.index2word)
+        order = np.argsort(hashes)
+        return cls(np.asarray(kv_model.vectors, dtype=dtype), hashes[order], order)
+
+    def _get_arrays(self):
+        return {'word_vectors': self.vectors, 'sorted_hashes': self.sorted_hashes, 'sorted_ids': self.sorted_ids}
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        return cls(arrays['word_vectors'], arrays['sorted_hashes'], arrays['sorted_ids'])
+
+    def save(self, fname):
+        """Saves the word vectors to a .npz file, see :meth:`load`"""
+        np.savez(fname, version=NPZ_VERSION, **self._get_arrays())
+
+    @classmethod
+    def load(cls, fname):
+        """Loads word vectors saved by :meth:`save`
+
+        Parameters
+        ----------
+        fname : str
+            Path to the .npz file
+        """
+        with np.load(fname) as arrays:
+            _check_version(arrays)
+            return cls._from_arrays(arrays)
+
+    def lookup(self, tokens, default=-1):
+        """Gets the ids of a batch of tokens, like :meth:`~sl_eval.models.utils.vocab.Vocabulary.lookup`"""
+        return lookup_hashes(self.sorted_hashes, self.sorted_ids, tokens, default)
+
+    def sentence_vectors(self, sentences):
+        """Gets the mean of the vectors of the known words of each sentence
+
+        Parameters
+        ----------
+        sentences : list of list of str
+
+        Returns
+        -------
+        numpy array of float32 of shape (len(sentences), vector_size)
+            The zero vector for the sentences with no known word
+        """
+        sentences = [list(sentence) for sentence in sentences]
+        lengths = np.array([len(sentence) for sentence in sentences], dtype=np.int64)
+        ids = self.lookup([word for sentence in sentences for word in sentence])
+        sentence_index = np.repeat(np.arange(len(sentences)), lengths)
+
+        known = ids >= 0
+        ids, sentence_index = ids[known], sentence_index[known]
+        counts = np.bincount(sentence_index, minlength=len(sentences))
+
+        result = np.zeros((len(sentences), self.vector_size), dtype=np.float32)
+        if len(ids) == 0:
+            return result
+        # The words are in the order of the sentences, so each sentence is a run of rows
+        has_words = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts[has_words])[:-1]])
+        result[has_words] = np.add.reduceat(self.vectors[ids].astype(np.float32, copy=False), starts, axis=0)
+        result[has_words] /= counts[has_words, None]
+        return result
+
+    def cosine_similarity(self, queries, docs):
+        """Gets the cosine similarity of the mean word vectors of each (query, doc) pair
+
+        Parameters
+        ----------
+        queries : list of list of str
+        docs : list of list of str
+            The doc of each query
+
+        Returns
+        -------
+        numpy array of float32 of shape (len(queries),)
+        """
+        queries = list(queries)
+        vectors = self.sentence_vectors(queries + list(docs))
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), NORM_EPSILON)
+        return np.einsum('ij,ij->i', vectors[:len(queries)], vectors[len(queries):])
+
+    def iter_cosine_similarity(self, queries, docs, batch_size=DEFAULT_PAIR_BATCH_SIZE):
+        """Streams :meth:`cosine_similarity` over the pairs, `batch_size` pairs at a time
+
+        Parameters
+        ----------
+        queries : iterable of list of str
+        docs : iterable of list of str
+        batch_size : int, optional
+
+        Yields
+        ------
+        numpy array of float32
+            The similarities of a batch of pairs, in their order
+        """
+        for batch_queries, batch_docs in _iter_pair_batches(queries, docs, batch_size):
+            yield self.cosine_similarity(batch_queries, batch_docs)
+
+    def score_groups(self, queries, doc_groups, batch_size=DEFAULT_SCORE_BATCH_SIZE):
+        """Scores queries with their groups of candidate docs by cosine similarity, like the `score_groups`
+        of the models
+
+        Parameters
+        ----------
+        queries : iterable of list of str
+        doc_groups : iterable of list of list of str
+            The candidate docs of each query
+        batch_size : int, optional
+            The number of (query, doc) pairs scored at once.
+            See :func:`~sl_eval.models.utils.trec_utils.iter_group_batches`
+
+        Returns
+        -------
+        list of numpy arrays of float
+            The score of each doc of each query, in their order
+        """
+        scores = []
+        for batch_queries, batch_doc_groups in iter_group_batches(queries, doc_groups, batch_size):
+            doc_lens = [len(docs) for docs in batch_doc_groups]
+            similarities = self.cosine_similarity(
+                [q for q, n_docs in zip(batch_queries, doc_lens) for _ in range(n_docs)],
+                [d for docs in batch_doc_groups for d in docs]
+            )
+            scores.extend(np.split(similarities, np.cumsum(doc_lens)[:-1]))
+        return scores
+
+
+class NumpyBaselineModel:
+    """Predicts the classes of sentence pairs like a trained :class:`~sl_eval.models.baseline.BaselineModel`,
+    in NumPy only
+    """
+
+    def __init__(self, layer_weights, activations, word_vectors=None):
+        """
+        Parameters
+        ----------
+        layer_weights : list of list of numpy arrays
+            The kernel and the bias of each Dense layer, in their order. The first one takes the
+            concatenation of the two sentence vectors
+        activations : list of {'relu', 'softmax', 'linear'}
+            The activation of each Dense layer
+        word_vectors : :class:`NumpyWordVectors`, optional
+            The word vectors the model was trained on, needed to predict from sentences
+        """
+        for activation in activations:
+            if activation not in ACTIVATIONS:
+                raise ValueError("Unkown activation %s. It must be one of %s" % (activation, list(ACTIVATIONS)))
+        self.layer_weights = [[np.asarray(w, dtype=np.float32) for w in weights] for weights in layer_weights]
+        self.activations = list(activations)
+        self.word_vectors = word_vectors
+
+    def save(self, fname):
+        """Saves the model to a .npz file, see :meth:`load`"""
+        arrays = {'version': NPZ_VERSION, 'activations': np.array(self.activations)}
+        for i, (kernel, bias) in enumerate(self.layer_weights):
+            arrays['kernel_%d' % i], arrays['bias_%d' % i] = kernel, bias
+        if self.word_vectors is not None:
+            arrays.update(self.word_vectors._get_arrays())
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a model saved by :meth:`save` or exported by `BaselineModel.export_npz`
+
+        Parameters
+        ----------
+        fname : str
+            Path to the .npz file
+        """
+        with np.load(fname) as arrays:
+            _check_version(arrays)
+            activations = [str(activation) for activation in arrays['activations']]
+            word_vectors = None
+            if 'word_vectors' in arrays:
+                word_vectors = NumpyWordVectors._from_arrays(arrays)
+            return cls(
+                [[arrays['kernel_%d' % i], arrays['bias_%d' % i]] for i in range(len(activations))],
+                activations, word_vectors
+            )
+
+    def predict_vectors(self, X1, X2):
+        """Predicts the classes of pairs of sentence vectors, like `BaselineModel.model.predict`
+
+        Parameters
+        ----------
+        X1 : numpy array of shape (n_pairs, vector_size)
+        X2 : numpy array of shape (n_pairs, vector_size)
+
+        Returns
+        -------
+        numpy array of float32 of shape (n_pairs, num_predictions)
+        """
+        x = np.concatenate([np.asarray(X1, dtype=np.float32), np.asarray(X2, dtype=np.float32)], axis=1)
+        for (kernel, bias), activation in zip(self.layer_weights, self.activations):
+            x = ACTIVATIONS[activation](np.dot(x, kernel) + bias)
+        return x
+
+    def predict(self, queries, docs):
+        """Predicts the classes of (query, doc) pairs of sentences from their mean word vectors
+
+        Parameters
+        ----------
+        queries : list of list of str
+        docs : list of list of str
+            The doc of each query
+
+        Returns
+        -------
+        numpy array of float32 of shape (len(queries), num_predictions)
+        """
+        if self.word_vectors is None:
+            raise ValueError("The model has no word vectors. Export it with the KeyedVectors it was trained on")
+        queries = list(queries)
+        vectors = self.word_vectors.sentence_vectors(queries + list(docs))
+        return self.predict_vectors(vectors[:len(queries)], vectors[len(queries):])
+
+    def iter_predict(self, queries, docs, batch_size=DEFAULT_PAIR_BATCH_SIZE):
+        """Streams :meth:`predict` over the pairs, `batch_size` pairs at a time
+
+        Parameters
+        ----------
+        queries : iterable of list of str
+        docs : iterable of list of str
+        batch_size : int, optional
+
+        Yields
+        ------
+        numpy array of float32
+            The predictions of a batch of pairs, in their order
+        """
+        for batch_queries, batch_docs in _iter_pair_batches(queries, docs, batch_size):
+            yield self.predict(batch_queries, batch_docs)
@@ -50,17 +50,22 @@ from keras.utils.np_utils import to_categorical
 import keras.backend as K
 
 from .utils.custom_layers import Highway
+from .utils.embeddings import INDEX_DTYPE, EMBEDDING_DTYPES, seeded_vectors
+from .utils.vocab import Vocabulary
+from .utils.corpus import build_indexed_corpus, get_triplets, iter_pair_batches, BatchBuffers, N_BATCH_BUFFERS
+from .utils.indexing import index_sentences
+from .utils.batch_sequences import TripletSequence
+from .utils.train_shards import save_train_shards, make_train_dataset, interleave_tensors, iter_dataset
+from .utils.trec_utils import DEFAULT_SCORE_BATCH_SIZE, iter_group_batches
 
 import numpy as np
 import tensorflow as tf
 import random as rn
 import os
-from collections import Counter
 import gensim.downloader as api
 import logging
-import hashlib
-from numpy import random as np_random
 import string
+from functools import partial
 from keras import optimizers
 
 
@@ -91,11 +96,56 @@ K.set_session(sess)
 
 logger = logging.getLogger(__name__)
 
+
+def _make_batch(X1, X2, y, corpus, corpus_word_ids, corpus_word_chars, max_question_words, max_passage_words):
+    """Makes the inputs of a batch of question passage pairs of `corpus` for the train Sequence,
+    see :mod:`~sl_eval.models.utils.batch_sequences` and BiDAF_T._pad_corpus_sentences
+
+    Parameters
+    ----------
+    X1 : numpy array of int
+        The indices in `corpus` of the questions
+    X2 : numpy array of int
+        The indices in `corpus` of the passages
+    y : numpy array with {0, 1}
+        1 if the passage is relevant to the question
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+    corpus_word_ids : numpy array
+        The word id of each word of `corpus`, followed by the pad word id
+    corpus_word_chars : numpy array
+        The character ids of each word of `corpus`, followed by those of the pad word
+    max_question_words : int
+    max_passage_words : int
+    """
+    question = corpus.pad_sentences(X1, max_question_words, len(corpus.words))
+    passage = corpus.pad_sentences(X2, max_passage_words, len(corpus.words))
+    one_hot = np.array([[1, 0], [0, 1]], dtype=np.float32)
+    return ({'question_input': corpus_word_ids[question],
+             'passage_input': corpus_word_ids[passage],
+             'char_question_input': corpus_word_chars[question],
+             'char_passage_input': corpus_word_chars[passage]}, one_hot[y.astype(np.int64)])
+
+
+def _ranking_inputs(batch, corpus_word_ids, corpus_word_chars):
+    """Turns a batch of triplet rows of the train shards into the inputs of the model, in tensorflow ops,
+    see :func:`~sl_eval.models.utils.train_shards.make_train_dataset` and :func:`_make_batch`
+    """
+    question = interleave_tensors(batch['question'], batch['question'])
+    passage = interleave_tensors(batch['pos_passage'], batch['neg_passage'])
+    corpus_word_ids, corpus_word_chars = tf.constant(corpus_word_ids), tf.constant(corpus_word_chars)
+    y = tf.tile(tf.constant([[0, 1], [1, 0]], dtype=tf.float32), [tf.shape(batch['question'])[0], 1])
+    return ({'question_input': tf.gather(corpus_word_ids, question),
+             'passage_input': tf.gather(corpus_word_ids, passage),
+             'char_question_input': tf.gather(corpus_word_chars, question),
+             'char_passage_input': tf.gather(corpus_word_chars, passage)}, y)
+
+
 class BiDAF_T:
     def __init__(self, queries, docs, labels, kv_model, max_passage_words=100, max_passage_sents=1, max_question_words=40,
         char_embedding_dim=8, batch_size=50, unk_handle_method='zero', pad_handle_method='zero', optimizer='adam',
         n_epochs=5, n_encoder_hidden_nodes=200, max_word_charlen=25, depth=5, filters=100, word_embedding_dim=100,
-        steps_per_epoch=1):
+        steps_per_epoch=1, embedding_store=None, embedding_dtype='float32', vocab_workers=1,
+        shuffle_seed=42, batch_workers=1, train_shards_dir=None):
 
         self.queries = queries
         self.docs = docs
@@ -119,45 +169,83 @@ class BiDAF_T:
         self.depth = depth
         self.filters = filters
         self.model = None
+        # The parts of the model the questions and the passages are encoded in when predicting, see predict_groups
+        self.question_model = None
+        self.passage_model = None
         #sgd = optimizers.SGD(lr=0.01, decay=1e-6, momentum=0.9, nesterov=True)
         # ada = optimizers.Adadelta(lr=0.5)
         # optimizer = ada
         self.steps_per_epoch = steps_per_epoch
         self.optimizer = 'adam'
+        # A store shared with other models in the process. Its matrix and Embedding layer are used if given
+        self.embedding_store = embedding_store
+        # The dtype the embedding matrix is stored in. See EMBEDDING_DTYPES
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError("Unkown embedding_dtype %s. It must be one of %s" % (embedding_dtype, list(EMBEDDING_DTYPES)))
+        self.embedding_dtype = embedding_dtype
+        # The number of processes the train data is counted and indexed in while building the vocab
+        self.vocab_workers = vocab_workers
+        # The seed of the permutation the train triplets are shuffled with each epoch. None keeps their order
+        self.shuffle_seed = shuffle_seed
+        # The number of processes the train batches are made in. If more than 1, keras makes them from a Sequence
+        self.batch_workers = batch_workers
+        # If given, the train triplets are exported to .npy shards in this folder and read back by a tf.data pipeline
+        self.train_shards_dir = train_shards_dir
+        # The train data in ids of its own words, see _set_indexed_corpus
+        self.indexed_corpus = None
+        self._corpus_source = None
 
         self.char2index = {}
-        self.word2index = {}
+        self.vocab = Vocabulary()
 
         self.build_vocab()
         self.train()
 
     def build_vocab(self):
     
-        n_queries, n_docs = 0, 0
-        q_lens, doc_lens, n_docs_per_query = [], [], []
-
         for i, char in enumerate(string.printable, start=1):
             self.char2index[char] = i
 
-        # Create word indexes from training data
-        word_counter = Counter()
-        for q, docs, labels in zip(self.queries, self.docs, self.labels):
-            n_queries += 1
-            q_lens.append(len(q))
-            n_docs_per_query.append(len(docs))
-            word_counter.update(q)
-            for d in docs:
-                n_docs += 1
-                word_counter.update(d)
-                doc_lens.append(len(d))
-
-        self.vocab_size = len(word_counter)
+        # Count and index the training data in one pass over it
+        corpus, counts, _ = build_indexed_corpus(self.queries, self.docs, self.labels, n_workers=self.vocab_workers)
+        train_words = corpus.words
+        n_queries, n_docs = len(corpus), len(corpus.lengths) - len(corpus)
+
+        self.vocab_size = len(train_words)
         logger.info('There are %d vocab words in the training data', self.vocab_size)
         logger.info('There are %d queries and %d docs in the training data', n_queries, n_docs)
 
-        self.word2index = {}
-        for i, word in enumerate(word_counter.keys(), start=1):
-            self.word2index[word] = i
+        if self.embedding_store is not None:
+            store = self.embedding_store
+            # Unlike the other models, BiDAF_T trains on the raw vectors with its own pad row, so a store
+            # which doesn't give it these would change what it trains on
+            if store.normalize_embeddings:
+                raise ValueError("The embedding store has L2 normalized embeddings. BiDAF_T uses the raw vectors, "
+                                 "so the store has to be built with normalize_embeddings=False")
+            store_pad_handle_method = 'random' if np.any(store.embedding_matrix[store.pad_word_index]) else 'zero'
+            if store_pad_handle_method != self.pad_handle_method:
+                raise ValueError("The embedding store has a %s pad word, which doesn't match pad_handle_method=%s" %
+                                 (store_pad_handle_method, self.pad_handle_method))
+            if store.unk_handle_method != self.unk_handle_method:
+                logger.warning("The embedding store uses unk_handle_method=%s. It will be used instead",
+                               store.unk_handle_method)
+                self.unk_handle_method = store.unk_handle_method
+            store.add_words(train_words)
+            self.vocab = store.vocab
+            self.pad_word_index = store.pad_word_index
+            self.unk_word_index = store.unk_word_index
+            self.embedding_matrix = store.embedding_matrix
+            logger.info(
+                'Using the shared embedding matrix of shape %s. The pad_word is set to the index: %d and the '
+                'unkwnown words will be set to the index %d', str(self.embedding_matrix.shape),
+                self.pad_word_index, self.unk_word_index
+            )
+            self._set_indexed_corpus(corpus)
+            del self.kv_model
+            return
+
+        # The train words are indexed from 1 since 0 is the pad word
+        self.vocab = Vocabulary(train_words, ids=np.arange(1, self.vocab_size + 1), counts=counts)
 
         self.pad_word_index = 0
         self.unk_word_index = self.vocab_size + 1
@@ -167,22 +255,24 @@ class BiDAF_T:
             self.pad_word_index, self.unk_word_index
         )
 
-        num_embedding_words = 0
-        num_non_embedding_words = 0
-
-        for word in self.word2index:
-            if word in self.kv_model:
-                num_embedding_words += 1
-            else:
-                num_non_embedding_words += 1
+        oov_words = [word for word in train_words if word not in self.kv_model.vocab]
+        num_non_embedding_words = len(oov_words)
+        num_embedding_words = self.vocab_size - num_non_embedding_words
 
         logger.info(
             "There are %d words in the embdding matrix and %d which aren't there",
             num_embedding_words, num_non_embedding_words
         )
 
+        # The words in the embedding file which aren't train words are indexed after the unk word
+        train_word_set = set(train_words)
+        extra_words = [word for word in self.kv_model.index2word if word not in train_word_set]
+        first_extra_index = self.unk_word_index + 1
+        self.vocab.extend(extra_words, ids=np.arange(first_extra_index, first_extra_index + len(extra_words)))
+
         # 1 for pad word, 1 for unk_word in non-train data
-        self.embedding_matrix = np.zeros((1 + len(self.kv_model.vocab) + 1 + num_embedding_words , self.kv_model.vector_size))
+        self.embedding_matrix = np.zeros((first_extra_index + len(extra_words), self.kv_model.vector_size),
+                                         dtype=EMBEDDING_DTYPES[self.embedding_dtype])
 
         if self.pad_handle_method == 'zero':
             self.embedding_matrix[self.pad_word_index] = np.zeros((self.kv_model.vector_size))
@@ -198,19 +288,15 @@ class BiDAF_T:
         else:
             raise ValueError('Unkown unk handle method')
 
-        for word in self.word2index:
-            if word in self.kv_model:
-                self.embedding_matrix[self.word2index[word]] = self.kv_model[word]
-            else:
-                self.embedding_matrix[self.word2index[word]] = self._seeded_vector(word, self.kv_model.vector_size)
+        for word, index in zip(train_words, self.vocab.lookup(train_words)):
+            if word in self.kv_model.vocab:
+                self.embedding_matrix[index] = self.kv_model[word]
+        self.embedding_matrix[self.vocab.lookup(oov_words)] = seeded_vectors(oov_words, self.kv_model.vector_size)
 
-        additional_embedding_index = self.pad_word_index + 1
-        for word in self.kv_model.vocab:
-            if word not in self.word2index:
-                self.embedding_matrix[additional_embedding_index] = self.kv_model[word]
-                self.word2index[word] = additional_embedding_index
-                additional_embedding_index += 1
+        kv_index = [self.kv_model.vocab[word].index for word in extra_words]
+        self.embedding_matrix[first_extra_index:] = self.kv_model.vectors[kv_index]
 
+        self._set_indexed_corpus(corpus)
         del self.kv_model
 
 
@@ -247,7 +333,7 @@ class BiDAF_T:
 
         assert type(sentence) == list
         str_sent = sentence
-        sentence = [self.word2index[word] if word in self.word2index else self.unk_word_index for word in sentence]
+        sentence = self.vocab.lookup(sentence, default=self.unk_word_index).tolist()
         while len(sentence) < max_len:
             sentence.append(self.pad_word_index)
         if len(sentence) > max_len:
@@ -277,81 +363,104 @@ class BiDAF_T:
             sentence = sentence[:max_len]
         return sentence
 
-    def _get_full_batch_iter(self, pair_list, batch_size):
-        """Returns batches with alternate positive and negative docs taken from
-        the `pair_list`. Since each question has a positive and neagative counter part,
-        we divide batch_size by 2 (batch_size // 2 * 2)
-        """
-        X1, X2, y = [], [], []
-        cX1, cX2 = [], []
-        batch_size = batch_size//2
-        while True:
-            for i, (query, pos_doc, neg_doc, cquery, cpos_doc, cneg_doc) in enumerate(pair_list):
-                X1.append(query)
-                cX1.append(cquery)
-
-                X2.append(pos_doc)
-                cX2.append(cpos_doc)
-
-                y.append([0, 1])
-
-                X1.append(query)
-                cX1.append(cquery)
-
-                X2.append(neg_doc)
-                cX2.append(cneg_doc)
-
-                y.append([1, 0])
-
-                if i % batch_size == 0 and i != 0:
-                    yield ({'question_input': np.array(X1), 'passage_input': np.array(X2),
-                            'char_question_input': np.array(cX1), 'char_passage_input': np.array(cX2)}, np.array(y))
-                    X1, X2, y = [], [], []
-                    cX1, cX2 = [], []
+    def _set_indexed_corpus(self, corpus):
+        """Keeps `corpus` as the train data along with the model's word id and the indexed characters
+        of each of its words, so batches are made from it with numpy indexing only
 
+        Parameters
+        ----------
+        corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+        """
+        self.indexed_corpus = corpus
+        # The sentences are padded with the extra id len(corpus.words), which is given the last row of both tables
+        self._corpus_word_ids = np.append(self.vocab.lookup(corpus.words, default=self.unk_word_index),
+                                          np.array([self.pad_word_index], dtype=INDEX_DTYPE))
+        self._corpus_word_chars = np.full((len(corpus.words) + 1, self.max_word_charlen), self.char_pad_index,
+                                          dtype=INDEX_DTYPE)
+        if corpus.words:
+            self._corpus_word_chars[:-1] = [self._char_word(word) for word in corpus.words]
+        self._corpus_source = (self.queries, self.docs, self.labels)
+
+    def _get_indexed_corpus(self):
+        """Gets the train data as an :class:`~sl_eval.models.utils.corpus.IndexedCorpus`.
+        It is only indexed again if the train data changed since the vocab was built, like when finetuning.
+        """
+        source = (self.queries, self.docs, self.labels)
+        if self.indexed_corpus is None or any(new is not old for new, old in zip(source, self._corpus_source)):
+            corpus, _, _ = build_indexed_corpus(*source, n_workers=self.vocab_workers)
+            self._set_indexed_corpus(corpus)
+        return self.indexed_corpus
 
-    def _get_pair_list(self, queries, docs, labels):
-        """Yields a character and word based indexed pair list of the format
-        question, pos_doc, negative_doc
+    def _pad_corpus_sentences(self, indices, max_len, out=None):
+        """Returns the word ids and the character ids of sentences of the indexed corpus, padded to `max_len`
+        Same as _make_sentence_indexed_padded and _make_sentence_indexed_padded_charred for a whole batch
 
         Parameters
         ----------
-        queries : list of list of str
-        docs : list of list of list of str
-        labels : list of list of list of int
-
+        indices : list of int
+            The indices of the sentences in `indexed_corpus`
+        max_len : int
+        out : tuple of numpy arrays, optional
+            Preallocated (corpus word indices, word ids, character ids) arrays of the shapes
+            (len(indices), max_len), (len(indices), max_len) and (len(indices), max_len, max_word_charlen)
+            to write the result into
         """
-        while True:
-            for q, doc, label in zip(queries, docs, labels):
-                doc, label = (list(t) for t in zip(*sorted(zip(doc, label), reverse=True)))
-                for item in zip(doc, label):
-                    if item[1] == 1:
-                        for new_item in zip(doc, label):
-                            if new_item[1] == 0:
-                                yield(
-                                  self._make_sentence_indexed_padded(q, self.max_question_words),
-                                  self._make_sentence_indexed_padded(item[0], self.max_passage_words),
-                                  self._make_sentence_indexed_padded(new_item[0], self.max_passage_words),
-                                  self._make_sentence_indexed_padded_charred(q, self.max_question_words),
-                                  self._make_sentence_indexed_padded_charred(item[0],self.max_passage_words),
-                                  self._make_sentence_indexed_padded_charred(new_item[0], self.max_passage_words)
-                                )
-
-    def _string2numeric_hash(self, text):
-        "Gets a numeric hash for a given string"
-        return int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
-
-    def _seeded_vector(self, seed_string, vector_size):
-        """Create one 'random' vector (but deterministic by seed_string)"""
-        # Note: built-in hash() may vary by Python version or even (in Py3.x) per launch
-        once = np_random.RandomState(self._string2numeric_hash(seed_string) & 0xffffffff)
-        return (once.rand(vector_size) - 0.5) / vector_size
-
+        corpus = self.indexed_corpus
+        if out is None:
+            indexed = corpus.pad_sentences(indices, max_len, len(corpus.words))
+            return self._corpus_word_ids[indexed], self._corpus_word_chars[indexed]
+        indexed, word_ids, word_chars = out
+        corpus.pad_sentences(indices, max_len, len(corpus.words), out=indexed)
+        np.take(self._corpus_word_ids, indexed, axis=0, out=word_ids)
+        np.take(self._corpus_word_chars, indexed, axis=0, out=word_chars)
+        return word_ids, word_chars
+
+    def _get_full_batch_iter(self, triplets, batch_size):
+        """Returns batches with alternate positive and negative docs taken from
+        the `triplets`. Since each question has a positive and neagative counter part,
+        we divide batch_size by 2 (batch_size // 2 * 2)
+        The triplets are shuffled each epoch with `shuffle_seed`, see
+        :func:`~sl_eval.models.utils.corpus.iter_pair_batches`
+        The arrays of a batch are overwritten N_BATCH_BUFFERS batches later
+        """
+        n_pairs = batch_size // 2 * 2
+        buffers = BatchBuffers({
+            'question_indexed': ((n_pairs, self.max_question_words), self.indexed_corpus.ids.dtype),
+            'question_input': ((n_pairs, self.max_question_words), self._corpus_word_ids.dtype),
+            'char_question_input': ((n_pairs, self.max_question_words, self.max_word_charlen),
+                                    self._corpus_word_chars.dtype),
+            'passage_indexed': ((n_pairs, self.max_passage_words), self.indexed_corpus.ids.dtype),
+            'passage_input': ((n_pairs, self.max_passage_words), self._corpus_word_ids.dtype),
+            'char_passage_input': ((n_pairs, self.max_passage_words, self.max_word_charlen),
+                                   self._corpus_word_chars.dtype),
+        })
+        # The pairs alternate between relevant and irrelevant docs, so the labels are the same for every batch
+        y = np.tile(np.array([[0, 1], [1, 0]], dtype=np.float32), (batch_size // 2, 1))
+        for X1, X2, _ in iter_pair_batches(triplets, batch_size // 2, seed=getattr(self, 'shuffle_seed', None)):
+            # The sentences are sliced and padded from the corpus in one go for the whole batch
+            batch = buffers.next()
+            self._pad_corpus_sentences(X1, self.max_question_words, out=(
+                batch['question_indexed'], batch['question_input'], batch['char_question_input']))
+            self._pad_corpus_sentences(X2, self.max_passage_words, out=(
+                batch['passage_indexed'], batch['passage_input'], batch['char_passage_input']))
+            yield ({'question_input': batch['question_input'],
+                    'passage_input': batch['passage_input'],
+                    'char_question_input': batch['char_question_input'],
+                    'char_passage_input': batch['char_passage_input']}, y)
 
     def _get_model(self, max_passage_sents, max_passage_words, max_question_words, embedding_matrix, n_highway_layers=2,
             highway_activation='relu', embed_trainable=False, n_encoder_hidden_nodes=200, filters=100, depth=5,
             max_word_charlen=25, char_embedding_dim=8):
-        """Returns a keras model as per the BiDAF-T architecture"""
+        """Returns a keras model as per the BiDAF-T architecture, with its question tower and passage model
+
+        Returns
+        -------
+        model : :class:`keras.models.Model`
+        question_model : :class:`keras.models.Model`
+            From the question inputs to the encoded question
+        passage_model : :class:`keras.models.Model`
+            From the passage inputs and an encoded question to the prediction of the model
+        """
 
         total_passage_words = max_passage_sents * max_passage_words
 
@@ -365,110 +474,161 @@ class BiDAF_T:
         # (batch_size, total_passage_words, max_word_charlen)
         char_passage_input = Input(shape=(total_passage_words, max_word_charlen), dtype='int32', name="char_passage_input")
 
-        embedding_layer = Embedding(embedding_matrix.shape[0], embedding_matrix.shape[1],
-                                  weights=[embedding_matrix], trainable=embed_trainable)
+        if self.embedding_store is not None:
+            embedding_layer = self.embedding_store.get_embedding_layer()
+        else:
+            embedding_layer = Embedding(embedding_matrix.shape[0], embedding_matrix.shape[1],
+                                      weights=[embedding_matrix], trainable=embed_trainable)
 
 
         # Get a character embedding for each word
         char_embedding_layer = Embedding(input_dim=len(self.char2index) + 1, output_dim=char_embedding_dim)
 
-        # (batch_size, max_question_words, max_word_charlen, char_embedding_dim)
-        char_q = char_embedding_layer(char_question_input)
-        # (batch_size, total_passage_words, max_word_charlen, char_embedding_dim)
-        char_p = char_embedding_layer(char_passage_input)
-
         q_conv_layer = TimeDistributed(Conv1D(filters, depth))
         p_conv_layer = TimeDistributed(Conv1D(filters, depth))
-        char_q = q_conv_layer(char_q)
-        char_p = p_conv_layer(char_p)
 
         mpool_layer = Lambda(lambda x: tf.reduce_max(x, -2))
 
-        # (batch_size, max_question_words, depth)
-        char_q = mpool_layer(char_q)
-        # (batch_size, total_passage_words, depth)
-        char_p = mpool_layer(char_p)
-       
-
-        question_embedding = embedding_layer(question_input)  # (batch_size, max_question_words, embedding_dim)
-        passage_embedding = embedding_layer(passage_input)  # (batch_size, total_passage_words, embedding_dim)
-
-        # (batch_size, max_question_words, depth + word_embedding_dim)
-        question_embedding = Concatenate()([question_embedding, char_q])
-        # (batch_size, total_passage_words, depth + word_embedding_dim)
-        passage_embedding = Concatenate()([passage_embedding, char_p])
-
         # Highway Layer doesn't affect the shape of the tensor
+        question_highway_layers, passage_highway_layers = [], []
         for i in range(n_highway_layers):
             highway_layer = Highway(activation='relu', name='highway_{}'.format(i))
-            
-            question_layer = TimeDistributed(highway_layer, name=highway_layer.name + "_qtd")
-            question_embedding = question_layer(question_embedding)
-
-            passage_layer = TimeDistributed(highway_layer, name=highway_layer.name + "_ptd")
-            passage_embedding = passage_layer(passage_embedding)
+            question_highway_layers.append(TimeDistributed(highway_layer, name=highway_layer.name + "_qtd"))
+            passage_highway_layers.append(TimeDistributed(highway_layer, name=highway_layer.name + "_ptd"))
 
         # To capture contextual information in a passage
         passage_bidir_encoder = Bidirectional(LSTM(n_encoder_hidden_nodes, return_sequences=True,
                                                                    name='PassageBidirEncoder'), merge_mode='concat')
 
-        encoded_passage = passage_bidir_encoder(passage_embedding)  # (batch_size, total_passage_words, 2*n_encoder_hidden_nodes)
-        encoded_question = passage_bidir_encoder(question_embedding)  # (batch_size, max_question_words, 2*n_encoder_hidden_nodes)
+        similarity_layer = Dense(1)
+        modelling_layers = [Bidirectional(LSTM(n_encoder_hidden_nodes, return_sequences=True)),
+                            Bidirectional(LSTM(n_encoder_hidden_nodes, return_sequences=True))]
+        output_layer = Dense(2, activation='softmax')
 
-        # Reshape to calculate a dot similarity between query and passage
-        
-        # (batch_size, total_passage_words, max_question_words, 2*n_encoder_hidden_nodes)
-        tiled_passage = Lambda(lambda x: tf.tile(tf.expand_dims(x, 2), [1, 1, max_question_words, 1]))(encoded_passage)
+        def encode_question(question_input, char_question_input):
+            # (batch_size, max_question_words, max_word_charlen, char_embedding_dim)
+            char_q = char_embedding_layer(char_question_input)
+            char_q = q_conv_layer(char_q)
+            # (batch_size, max_question_words, depth)
+            char_q = mpool_layer(char_q)
+
+            question_embedding = embedding_layer(question_input)  # (batch_size, max_question_words, embedding_dim)
+
+            # (batch_size, max_question_words, depth + word_embedding_dim)
+            question_embedding = Concatenate()([question_embedding, char_q])
+
+            for question_layer in question_highway_layers:
+                question_embedding = question_layer(question_embedding)
+
+            return passage_bidir_encoder(question_embedding)  # (batch_size, max_question_words, 2*n_encoder_hidden_nodes)
+
+        def score_passage(passage_input, char_passage_input, encoded_question):
+            # (batch_size, total_passage_words, max_word_charlen, char_embedding_dim)
+            char_p = char_embedding_layer(char_passage_input)
+            char_p = p_conv_layer(char_p)
+            # (batch_size, total_passage_words, depth)
+            char_p = mpool_layer(char_p)
+
+            passage_embedding = embedding_layer(passage_input)  # (batch_size, total_passage_words, embedding_dim)
+
+            # (batch_size, total_passage_words, depth + word_embedding_dim)
+            passage_embedding = Concatenate()([passage_embedding, char_p])
 
-        # (batch_size, total_passage_words, max_question_words, 2*n_encoder_hidden_nodes)
-        tiled_question = Lambda(lambda x: tf.tile(tf.expand_dims(x, 1), [1, total_passage_words, 1, 1]))(encoded_question)
+            for passage_layer in passage_highway_layers:
+                passage_embedding = passage_layer(passage_embedding)
 
-        # (batch_size, total_passage_words, max_question_words, 2*n_encoder_hidden_nodes)
-        a_elmwise_mul_b = Lambda(lambda x:tf.multiply(x[0], x[1]))([tiled_passage, tiled_question])
+            encoded_passage = passage_bidir_encoder(passage_embedding)  # (batch_size, total_passage_words, 2*n_encoder_hidden_nodes)
 
-        # (batch_size, total_passage_words, max_question_words, 6*n_encoder_hidden_nodes)
-        concat_data = Concatenate(axis=-1)([tiled_passage, tiled_question, a_elmwise_mul_b])
+            # Reshape to calculate a dot similarity between query and passage
 
-        S = Dense(1)(concat_data)
-        S = Lambda(lambda x: K.squeeze(x, -1))(S)  # (batch_size, total_passage_words, max_question_words)
+            # (batch_size, total_passage_words, max_question_words, 2*n_encoder_hidden_nodes)
+            tiled_passage = Lambda(lambda x: tf.tile(tf.expand_dims(x, 2), [1, 1, max_question_words, 1]))(encoded_passage)
 
-        # Normalize using softmax for the `max_question_words` dimension
-        S = Activation('softmax')(S)
+            # (batch_size, total_passage_words, max_question_words, 2*n_encoder_hidden_nodes)
+            tiled_question = Lambda(lambda x: tf.tile(tf.expand_dims(x, 1), [1, total_passage_words, 1, 1]))(encoded_question)
 
-        # Context2Query (Passage2Query)
-        # batch_matmul((batch_size, total_passage_words, max_question_words), (batch_size, max_question_words, 2*n_encoder_hidden_nodes) ) =
-        # (batch_size, total_passage_words, 2*n_encoder_hidden_nodes)
-        c2q = Lambda(lambda x: tf.matmul(x[0], x[1]))([S, encoded_question])
+            # (batch_size, total_passage_words, max_question_words, 2*n_encoder_hidden_nodes)
+            a_elmwise_mul_b = Lambda(lambda x:tf.multiply(x[0], x[1]))([tiled_passage, tiled_question])
 
-        # Query2Context
-        # b: attention weights on the context
-        b = Lambda(lambda x: tf.nn.softmax(K.max(x, 2), dim=-1), name='b')(S) # (batch_size, total_passage_words)
+            # (batch_size, total_passage_words, max_question_words, 6*n_encoder_hidden_nodes)
+            concat_data = Concatenate(axis=-1)([tiled_passage, tiled_question, a_elmwise_mul_b])
 
-        # batch_matmul( (batch_size, 1, total_passage_words), (batch_size, total_passage_words, 2*n_encoder_hidden_nodes) ) = 
-        # (batch_size, 1, 2*n_encoder_hidden_nodes)
-        q2c = Lambda(lambda x:tf.matmul(tf.expand_dims(x[0], 1), x[1]))([b, encoded_passage]) 
-        # (batch_size, total_passage_words, 2*n_encoder_hidden_nodes), tiled `total_passage_words` times
-        q2c = Lambda(lambda x: tf.tile(x, [1, total_passage_words, 1]))(q2c)
+            S = similarity_layer(concat_data)
+            S = Lambda(lambda x: K.squeeze(x, -1))(S)  # (batch_size, total_passage_words, max_question_words)
 
+            # Normalize using softmax for the `max_question_words` dimension
+            S = Activation('softmax')(S)
 
-        # G: query aware representation of each context word
-         # (batch_size, total_passage_words, 8*n_encoder_hidden_nodes)
-        G = Lambda(lambda x: tf.concat([x[0], x[1], tf.multiply(x[0], x[1]), tf.multiply(x[0], x[2])], axis=-1))([encoded_passage, c2q, q2c])
+            # Context2Query (Passage2Query)
+            # batch_matmul((batch_size, total_passage_words, max_question_words), (batch_size, max_question_words, 2*n_encoder_hidden_nodes) ) =
+            # (batch_size, total_passage_words, 2*n_encoder_hidden_nodes)
+            c2q = Lambda(lambda x: tf.matmul(x[0], x[1]))([S, encoded_question])
 
+            # Query2Context
+            # b: attention weights on the context
+            b = Lambda(lambda x: tf.nn.softmax(K.max(x, 2), dim=-1), name='b')(S) # (batch_size, total_passage_words)
 
-        # Get some more context based info over the passage words
-        modelled_passage = Bidirectional(LSTM(n_encoder_hidden_nodes, return_sequences=True))(G)
-        modelled_passage = Bidirectional(LSTM(n_encoder_hidden_nodes, return_sequences=True))(modelled_passage)
+            # batch_matmul( (batch_size, 1, total_passage_words), (batch_size, total_passage_words, 2*n_encoder_hidden_nodes) ) = 
+            # (batch_size, 1, 2*n_encoder_hidden_nodes)
+            q2c = Lambda(lambda x:tf.matmul(tf.expand_dims(x[0], 1), x[1]))([b, encoded_passage]) 
+            # (batch_size, total_passage_words, 2*n_encoder_hidden_nodes), tiled `total_passage_words` times
+            q2c = Lambda(lambda x: tf.tile(x, [1, total_passage_words, 1]))(q2c)
 
-        # Reshape it back to be at the sentence level
-        #reshaped_passage = Reshape((max_passage_sents, max_passage_words, n_encoder_hidden_nodes*2))(modelled_passage)
 
-        g2 = Lambda(lambda x: tf.reduce_max(x, 1))(modelled_passage)
+            # G: query aware representation of each context word
+             # (batch_size, total_passage_words, 8*n_encoder_hidden_nodes)
+            G = Lambda(lambda x: tf.concat([x[0], x[1], tf.multiply(x[0], x[1]), tf.multiply(x[0], x[2])], axis=-1))([encoded_passage, c2q, q2c])
 
-        pred = Dense(2, activation='softmax')(g2)
+
+            # Get some more context based info over the passage words
+            modelled_passage = G
+            for modelling_layer in modelling_layers:
+                modelled_passage = modelling_layer(modelled_passage)
+
+            # Reshape it back to be at the sentence level
+            #reshaped_passage = Reshape((max_passage_sents, max_passage_words, n_encoder_hidden_nodes*2))(modelled_passage)
+
+            g2 = Lambda(lambda x: tf.reduce_max(x, 1))(modelled_passage)
+
+            return output_layer(g2)
+
+        encoded_question = encode_question(question_input, char_question_input)
+        pred = score_passage(passage_input, char_passage_input, encoded_question)
 
         model = Model(inputs=[question_input, passage_input, char_question_input, char_passage_input], outputs=[pred])
-        return model
+
+        # The question tower and the passage model share the layers of the model, see predict_groups
+        question_model = Model(inputs=[question_input, char_question_input], outputs=encoded_question)
+        # (batch_size, max_question_words, 2*n_encoder_hidden_nodes)
+        encoded_question_input = Input(shape=(max_question_words, 2 * n_encoder_hidden_nodes),
+                                       name="encoded_question_input")
+        passage_model = Model(inputs=[passage_input, char_passage_input, encoded_question_input],
+                              outputs=[score_passage(passage_input, char_passage_input, encoded_question_input)])
+        return model, question_model, passage_model
+
+    def _get_train_dataset_iter(self, triplets, batch_size):
+        """Returns a generator of the train batches made by a tf.data pipeline from .npy shards in
+        `train_shards_dir`, which are exported first unless an earlier run already did.
+        See :mod:`~sl_eval.models.utils.train_shards`
+
+        Parameters
+        ----------
+        triplets : tuple of numpy arrays
+            See :func:`~sl_eval.models.utils.corpus.get_triplets`
+        batch_size : int
+            The number of triplets of a batch
+        """
+        corpus = self.indexed_corpus
+        question, pos_passage, neg_passage = triplets
+        columns = [('question', question, self.max_question_words), ('pos_passage', pos_passage, self.max_passage_words),
+                   ('neg_passage', neg_passage, self.max_passage_words)]
+        # The rows hold indices of the corpus words, which are turned into word and character ids in the pipeline
+        key = save_train_shards(self.train_shards_dir, corpus, columns, len(corpus.words), model='BiDAF_T')
+        to_inputs = partial(_ranking_inputs, corpus_word_ids=self._corpus_word_ids,
+                            corpus_word_chars=self._corpus_word_chars)
+        dataset = make_train_dataset(self.train_shards_dir, key, batch_size, to_inputs,
+                                     seed=getattr(self, 'shuffle_seed', None))
+        return iter_dataset(dataset, K.get_session())
 
     def train(self, queries=None, docs=None, labels=None, n_epochs=None, steps_per_epoch=None, batch_size=None):
         """Trains the model on the existing or given queries, docs and labels"""
@@ -476,7 +636,7 @@ class BiDAF_T:
         # If you're building for the first time
         if self.model is None:
             # Build Model
-            self.model = self._get_model(max_passage_sents=self.max_passage_sents, max_passage_words=self.max_passage_words,
+            self.model, self.question_model, self.passage_model = self._get_model(max_passage_sents=self.max_passage_sents, max_passage_words=self.max_passage_words,
                          max_question_words=self.max_question_words, embedding_matrix=self.embedding_matrix, 
                          n_encoder_hidden_nodes=self.n_encoder_hidden_nodes, char_embedding_dim=self.char_embedding_dim, 
                          depth=self.depth, filters=self.filters, max_word_charlen=self.max_word_charlen
@@ -492,8 +652,24 @@ class BiDAF_T:
         self.steps_per_epoch = steps_per_epoch or self.steps_per_epoch
         self.batch_size = batch_size or self.batch_size
 
-        train_generator = self._get_full_batch_iter(self._get_pair_list(self.queries, self.docs, self.labels), self.batch_size)
-        self.model.fit_generator(train_generator, steps_per_epoch=self.steps_per_epoch, epochs=self.n_epochs)
+        triplets = get_triplets(self._get_indexed_corpus())
+        if getattr(self, 'train_shards_dir', None) is not None:
+            train_generator = self._get_train_dataset_iter(triplets, self.batch_size // 2)
+            fit_kwargs = {}
+        elif getattr(self, 'batch_workers', 1) > 1:
+            train_generator = TripletSequence(
+                triplets, self.batch_size // 2, _make_batch, seed=getattr(self, 'shuffle_seed', None),
+                corpus=self.indexed_corpus, corpus_word_ids=self._corpus_word_ids,
+                corpus_word_chars=self._corpus_word_chars, max_question_words=self.max_question_words,
+                max_passage_words=self.max_passage_words
+            )
+            fit_kwargs = {'workers': self.batch_workers, 'use_multiprocessing': True}
+        else:
+            train_generator = self._get_full_batch_iter(triplets, self.batch_size)
+            # The generator writes its batches into reused buffers, see BatchBuffers
+            fit_kwargs = {'max_queue_size': N_BATCH_BUFFERS - 1}
+        self.model.fit_generator(train_generator, steps_per_epoch=self.steps_per_epoch, epochs=self.n_epochs,
+                                 **fit_kwargs)
 
 
     def batch_predict(self, q, doc):
@@ -516,23 +692,85 @@ class BiDAF_T:
 
         Effectively, we can rank the answers with the 90% and 30%
         """
-        wq, cq = [], []
-        test_docs, ctest_docs = [], []
-        num_docs = len(doc)
-
-        for d in doc:
-            cq.append(self._make_sentence_indexed_padded_charred(q, self.max_question_words))
-            wq.append(self._make_sentence_indexed_padded(q, self.max_question_words))
-            test_docs.append(self._make_sentence_indexed_padded(d, self.max_passage_words))
-            ctest_docs.append(self._make_sentence_indexed_padded_charred(d, self.max_passage_words))
+        return self.predict_groups([q], [doc])
 
-        wq = np.array(wq).reshape((num_docs, self.max_question_words))
-        cq = np.array(cq).reshape((num_docs, self.max_question_words, self.max_word_charlen))
+    def predict_groups(self, queries, docs, batch_size=256):
+        """Returns predictions on several queries with their candidate docs, all packed in the same batches.
+        Each query is encoded once by the question tower, and its encoding is repeated for each of its docs
+        for the passage model, so the question side of the model doesn't run again for every doc
 
-        test_docs = np.array(test_docs).reshape((num_docs, self.total_passage_words))
-        ctest_docs = np.array(ctest_docs).reshape((num_docs, self.total_passage_words, self.max_word_charlen))
+        Parameters
+        ----------
+        queries : list of list of str
+        docs : list of list of list of str
+            The candidate docs of each query
+        batch_size : int, optional
+            The number of (query, doc) pairs predicted at once
 
-        preds = self.model.predict(x={'question_input':wq,  'passage_input':test_docs,
-                                      'char_passage_input': ctest_docs, 'char_question_input': cq})
+        Returns
+        -------
+        numpy array of shape (n_pairs, 2)
+            The predictions of the docs of all the queries, in their order, like :meth:`batch_predict`
+        """
+        queries, docs = list(queries), [list(doc) for doc in docs]
+        doc_lens = np.array([len(doc) for doc in docs], dtype=np.int64)
+        flat_docs = [d for doc in docs for d in doc]
+        if len(flat_docs) == 0:
+            return np.zeros((0, 2), dtype=np.float32)
+
+        # Only the queries with docs are encoded
+        has_docs = doc_lens > 0
+        queries = [q for q, has in zip(queries, has_docs) if has]
+        wq, _ = index_sentences(queries, self.vocab, self.max_question_words, self.pad_word_index, self.unk_word_index)
+        cq = np.array([self._make_sentence_indexed_padded_charred(q, self.max_question_words) for q in queries],
+                      dtype=INDEX_DTYPE)
+        encoded_questions = self.question_model.predict(x={'question_input': wq, 'char_question_input': cq},
+                                                        batch_size=batch_size)
+        # The index in encoded_questions of the query of each pair
+        pair_queries = np.repeat(np.arange(len(queries)), doc_lens[has_docs])
+
+        test_docs, _ = index_sentences(flat_docs, self.vocab, self.max_passage_words, self.pad_word_index,
+                                       self.unk_word_index)
+        test_docs = test_docs.reshape((len(flat_docs), self.total_passage_words))
+
+        preds = None
+        for start in range(0, len(flat_docs), batch_size):
+            batch_docs = flat_docs[start: start + batch_size]
+            ctest_docs = np.array([self._make_sentence_indexed_padded_charred(d, self.max_passage_words)
+                                   for d in batch_docs], dtype=INDEX_DTYPE)
+            ctest_docs = ctest_docs.reshape((len(batch_docs), self.total_passage_words, self.max_word_charlen))
+            batch_preds = self.passage_model.predict(
+                x={'passage_input': test_docs[start: start + batch_size], 'char_passage_input': ctest_docs,
+                   'encoded_question_input': encoded_questions[pair_queries[start: start + batch_size]]},
+                batch_size=batch_size
+            )
+            if preds is None:
+                preds = np.empty((len(flat_docs),) + batch_preds.shape[1:], dtype=batch_preds.dtype)
+            preds[start: start + batch_size] = batch_preds
         return preds
 
+
+    def score_groups(self, queries, doc_groups, batch_size=DEFAULT_SCORE_BATCH_SIZE):
+        """Scores queries with their groups of candidate docs, many groups per prediction,
+        like for writing a TREC run with :func:`~sl_eval.models.utils.trec_utils.write_run`
+
+        Parameters
+        ----------
+        queries : iterable of list of str
+        doc_groups : iterable of list of list of str
+            The candidate docs of each query
+        batch_size : int, optional
+            The number of (query, doc) pairs indexed and predicted at once.
+            See :func:`~sl_eval.models.utils.trec_utils.iter_group_batches`
+
+        Returns
+        -------
+        list of numpy arrays of float
+            The probability of each doc of each query being a correct answer, in their order
+        """
+        scores = []
+        for batch_queries, batch_doc_groups in iter_group_batches(queries, doc_groups, batch_size):
+            predictions = self.predict_groups(batch_queries, batch_doc_groups)
+            doc_lens = [len(docs) for docs in batch_doc_groups]
+            scores.extend(np.split(predictions[:, 1], np.cumsum(doc_lens)[:-1]))
+        return scores
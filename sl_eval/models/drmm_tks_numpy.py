@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module scores query-doc pairs with the weights of a trained DRMM_TKS in NumPy only, without TensorFlow or Keras.
+
+The forward pass of DRMM_TKS is small: an embedding lookup, the cosine interaction matrix of the query and the doc,
+its top k per query word, a few dense softplus layers and a gated sum over the query words. Serving it through
+Keras means loading TensorFlow, creating a session and going through `predict` for every request, which costs
+far more than the pass itself on CPU.
+
+A trained :class:`~sl_eval.models.drmm_tks.DRMM_TKS` is exported with its `export_npz` method, and the file is
+loaded back here with :meth:`NumpyDRMM_TKS.load`, which only reads a few arrays.
+
+Examples
+--------
+>>> from sl_eval.models import DRMM_TKS
+>>> DRMM_TKS.load('drmm_tks').export_npz('drmm_tks.npz')
+
+Then, in the serving process
+
+>>> from sl_eval.models.drmm_tks_numpy import NumpyDRMM_TKS
+>>> model = NumpyDRMM_TKS.load('drmm_tks.npz')
+>>> model.predict([["When", "was", "Gandhi", "born", "?"]], [[["Gandhi", "was", "born", "in", "1869"]]])
+"""
+
+import logging
+import numpy as np
+
+from .utils.indexing import index_sentences
+from .utils.word_hashes import lookup_hashes
+from .utils.trec_utils import DEFAULT_SCORE_BATCH_SIZE, iter_group_batches
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the exported file changes
+NPZ_VERSION = 1
+
+# The epsilon of the l2 normalization of the keras backend
+L2_EPSILON = 1e-12
+
+
+def _l2_normalize(x):
+    """Same as `K.l2_normalize(x, axis=-1)`"""
+    return x / np.sqrt(np.maximum(np.sum(np.square(x), axis=-1, keepdims=True), L2_EPSILON))
+
+
+def _softmax(x):
+    """Softmax over the last axis"""
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def _softplus(x):
+    return np.logaddexp(0, x)
+
+
+class NumpyDRMM_TKS:
+    """Scores query-doc pairs like a trained DRMM_TKS, in NumPy only
+
+    The sentences are translated with the vocab of the model at export time. Words which weren't in it get the
+    unknown word index, where DRMM_TKS may have added them to its vocab with seeded vectors.
+    """
+
+    def __init__(self, embedding_matrix, gating_weights, hidden_weights, output_weights, topk, text_maxlen,
+                 pad_word_index, unk_word_index, sorted_hashes, sorted_ids):
+        """
+        Parameters
+        ----------
+        embedding_matrix : numpy array of shape (n_words, embedding_dim)
+            The rows are cast to float32 when they are looked up, so it can be stored in float16
+        gating_weights : list of numpy arrays
+            The kernel and the bias of the term gating layer
+        hidden_weights : list of list of numpy arrays
+            The kernel and the bias of each hidden layer, in their order
+        output_weights : list of numpy arrays or None
+            The kernel and the bias of the softmax output layer of the 'classification' and 'inference'
+            target_modes. None in the 'ranking' target_mode, where the output is the gated sum itself
+        topk : int
+        text_maxlen : int
+        pad_word_index : int
+        unk_word_index : int
+        sorted_hashes : numpy array of uint64
+        sorted_ids : numpy array of int
+            The sorted hash index of the vocab, see :class:`~sl_eval.models.utils.vocab.Vocabulary`
+        """
+        self.embedding_matrix = embedding_matrix
+        self.gating_kernel, self.gating_bias = [np.asarray(w, dtype=np.float32) for w in gating_weights]
+        self.hidden_weights = [[np.asarray(w, dtype=np.float32) for w in weights] for weights in hidden_weights]
+        self.output_weights = None
+        if output_weights is not None:
+            self.output_weights = [np.asarray(w, dtype=np.float32) for w in output_weights]
+        self.topk = int(topk)
+        self.text_maxlen = int(text_maxlen)
+        self.pad_word_index = int(pad_word_index)
+        self.unk_word_index = int(unk_word_index)
+        self.sorted_hashes = sorted_hashes
+        self.sorted_ids = sorted_ids
+
+    def save(self, fname):
+        """Saves the model to a .npz file, see :meth:`load`"""
+        arrays = {
+            'version': NPZ_VERSION, 'embedding_matrix': self.embedding_matrix,
+            'gating_kernel': self.gating_kernel, 'gating_bias': self.gating_bias,
+            'n_hidden_layers': len(self.hidden_weights), 'topk': self.topk, 'text_maxlen': self.text_maxlen,
+            'pad_word_index': self.pad_word_index, 'unk_word_index': self.unk_word_index,
+            'sorted_hashes': self.sorted_hashes, 'sorted_ids': self.sorted_ids
+        }
+        for i, (kernel, bias) in enumerate(self.hidden_weights):
+            arrays['hidden_kernel_%d' % i], arrays['hidden_bias_%d' % i] = kernel, bias
+        if self.output_weights is not None:
+            arrays['output_kernel'], arrays['output_bias'] = self.output_weights
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a model saved by :meth:`save` or exported by `DRMM_TKS.export_npz`
+
+        Parameters
+        ----------
+        fname : str
+            Path to the .npz file
+        """
+        with np.load(fname) as arrays:
+            if int(arrays['version']) != NPZ_VERSION:
+                raise ValueError("Unkown version %d of the exported file. It must be %d" %
+                                 (int(arrays['version']), NPZ_VERSION))
+            output_weights = None
+            if 'output_kernel' in arrays:
+                output_weights = [arrays['output_kernel'], arrays['output_bias']]
+            return cls(
+                embedding_matrix=arrays['embedding_matrix'],
+                gating_weights=[arrays['gating_kernel'], arrays['gating_bias']],
+                hidden_weights=[[arrays['hidden_kernel_%d' % i], arrays['hidden_bias_%d' % i]]
+                                for i in range(int(arrays['n_hidden_layers']))],
+                output_weights=output_weights, topk=arrays['topk'], text_maxlen=arrays['text_maxlen'],
+                pad_word_index=arrays['pad_word_index'], unk_word_index=arrays['unk_word_index'],
+                sorted_hashes=arrays['sorted_hashes'], sorted_ids=arrays['sorted_ids']
+            )
+
+    def lookup(self, tokens, default=-1):
+        """Gets the ids of a batch of tokens, like :meth:`~sl_eval.models.utils.vocab.Vocabulary.lookup`"""
+        return lookup_hashes(self.sorted_hashes, self.sorted_ids, tokens, default)
+
+    def _translate(self, sentences):
+        """Translates sentences into word ids padded to text_maxlen"""
+        indexed, _ = index_sentences(sentences, self, self.text_maxlen, self.pad_word_index, self.unk_word_index)
+        return indexed
+
+    def _embed(self, indexed):
+        return self.embedding_matrix[indexed].astype(np.float32, copy=False)
+
+    def _encode_queries(self, indexed_queries):
+        """Returns the l2 normalized embeddings of the queries, of shape (n_queries, text_maxlen, embedding_dim),
+        and their term gating, of shape (n_queries, text_maxlen)
+        """
+        q_embed = self._embed(indexed_queries)
+        g = _softmax(np.matmul(q_embed, self.gating_kernel) + self.gating_bias)
+        return _l2_normalize(q_embed), g.reshape(len(indexed_queries), -1)
+
+    def _score(self, q_norm, g, indexed_docs):
+        """Scores docs against the encoded queries of the same rows, see :meth:`_encode_queries`"""
+        d_norm = _l2_normalize(self._embed(indexed_docs))
+        # (n_pairs, text_maxlen, text_maxlen)
+        mm = np.matmul(q_norm, d_norm.transpose(0, 2, 1))
+        # The k largest values of each row, in decreasing order like tf.nn.top_k
+        mm_k = np.partition(mm, mm.shape[-1] - self.topk, axis=-1)[..., -self.topk:]
+        mm_k = np.sort(mm_k, axis=-1)[..., ::-1]
+
+        for kernel, bias in self.hidden_weights:
+            mm_k = _softplus(np.matmul(mm_k, kernel) + bias)
+
+        mean = np.sum(mm_k.reshape(len(g), -1) * g, axis=1, keepdims=True)
+        if self.output_weights is None:
+            return mean
+        kernel, bias = self.output_weights
+        return _softmax(np.matmul(mean, kernel) + bias)
+
+    def predict(self, queries, docs, batch_size=256):
+        """Predicts the similarity of each query with each of its candidate docs, like `DRMM_TKS.predict`.
+        Each query is encoded once for all its docs
+
+        Parameters
+        ----------
+        queries : list of list of str
+        docs : list of list of list of str
+            The candidate docs of each query
+        batch_size : int, optional
+            The number of pairs scored at once. The interaction matrices of a batch are held in memory
+
+        Returns
+        -------
+        numpy array of float32
+            One row per query-doc pair, in their order
+        """
+        queries, docs = list(queries), [list(doc) for doc in docs]
+        doc_lens = np.array([len(doc) for doc in docs], dtype=np.int64)
+        flat_docs = [d for doc in docs for d in doc]
+        output_dim = 1 if self.output_weights is None else len(self.output_weights[1])
+        predictions = np.empty((len(flat_docs), output_dim), dtype=np.float32)
+        if len(flat_docs) == 0:
+            return predictions
+
+        q_norm, g = self._encode_queries(self._translate(queries))
+        indexed_docs = self._translate(flat_docs)
+        # The index in q_norm and g of the query of each pair
+        pair_queries = np.repeat(np.arange(len(queries)), doc_lens)
+        for start in range(0, len(flat_docs), batch_size):
+            rows = pair_queries[start: start + batch_size]
+            predictions[start: start + batch_size] = self._score(q_norm[rows], g[rows],
+                                                                 indexed_docs[start: start + batch_size])
+        return predictions
+
+    def score_groups(self, queries, doc_groups, batch_size=DEFAULT_SCORE_BATCH_SIZE):
+        """Scores queries with their groups of candidate docs, like `DRMM_TKS.score_groups`
+
+        Parameters
+        ----------
+        queries : iterable of list of str
+        doc_groups : iterable of list of list of str
+            The candidate docs of each query
+        batch_size : int, optional
+            The number of (query, doc) pairs translated at once.
+            See :func:`~sl_eval.models.utils.trec_utils.iter_group_batches`
+
+        Returns
+        -------
+        list of numpy arrays of float
+            The score of each doc of each query, in their order
+        """
+        scores = []
+        for batch_queries, batch_doc_groups in iter_group_batches(queries, doc_groups, batch_size):
+            predictions = self.predict(batch_queries, batch_doc_groups)
+            doc_lens = [len(docs) for docs in batch_doc_groups]
+            scores.extend(np.split(predictions[:, 0], np.cumsum(doc_lens)[:-1]))
+        return scores
@@ -31,17 +31,25 @@ Given 2 sentences, we try to predict the relation between them.
 
 import logging
 import numpy as np
-import hashlib
-from numpy import random as np_random
 from gensim.models import KeyedVectors
-from collections import Counter
 from .utils.custom_losses import rank_hinge_loss
-from .utils.custom_layers import TopKLayer, DynamicMaxPooling
+from .utils.custom_layers import TopKLayer, LengthDynamicMaxPooling
 from .utils.custom_callbacks import ValidationCallback
 from .utils.evaluation_metrics import mapk, mean_ndcg
-from sklearn.preprocessing import normalize
+from .utils.embeddings import EMBEDDING_DTYPES, INDEX_DTYPE, build_embedding_matrix, normalize_rows
+from .utils.vocab import Vocabulary
+from .utils.corpus import (build_indexed_corpus, get_triplets, sample_triplets, get_doc_pairs, iter_pair_batches,
+                           interleave_pairs, BatchBuffers, N_BATCH_BUFFERS)
+from .utils.indexing import index_sentences
+from .utils.batch_sequences import TripletSequence, LabelledPairSequence
+from .utils.train_shards import save_train_shards, make_train_dataset, interleave_tensors, iter_dataset
+from .utils.trec_utils import DEFAULT_SCORE_BATCH_SIZE, iter_group_batches
+from .utils.buckets import get_bucket_widths, iter_bucketed_batches, predict_bucketed
+from .utils.length_profile import DEFAULT_LENGTH_COVERAGE, recommend_sizes
+from .utils.vocab_cache import get_cache_key, load_vocab_cache, save_vocab_cache
 from gensim import utils
 from collections import Iterable
+from functools import partial
 from keras.utils.np_utils import to_categorical
 
 import numpy as np
@@ -81,24 +89,77 @@ from keras import optimizers
 from keras.models import load_model
 from keras.losses import hinge
 from keras.models import Model
-from keras.layers import Input, Embedding, Dot, Dense, Reshape, Dropout, Conv2D, Flatten
+from keras.callbacks import LambdaCallback
+from keras.layers import Input, Embedding, Dot, Dense, Reshape, Dropout, Conv2D, Flatten, Lambda
 
 logger = logging.getLogger(__name__)
 
 
-def _get_full_batch_iter(pair_list, batch_size, text_maxlen):
+def _make_batch(X1, X2, y, corpus, text_maxlen, pad_word_index):
+    """Makes the inputs of a batch of pairs of sentences of `corpus` for the train Sequences,
+    see :mod:`~sl_eval.models.utils.batch_sequences`
+
+    Parameters
+    ----------
+    X1 : numpy array of int
+        The indices in `corpus` of the queries
+    X2 : numpy array of int
+        The indices in `corpus` of the docs
+    y : numpy array
+        The targets
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+    text_maxlen : int
+    pad_word_index : int
+    """
+    inputs = {'query': corpus.pad_sentences(X1, text_maxlen, pad_word_index),
+              'doc': corpus.pad_sentences(X2, text_maxlen, pad_word_index)}
+    # The pooling indices are derived from the lengths in the model
+    inputs['query_len'], inputs['doc_len'] = corpus.lengths[X1], corpus.lengths[X2]
+    return inputs, y
+
+
+def _ranking_inputs(batch):
+    """Turns a batch of triplet rows of the train shards into the inputs of the model, in tensorflow ops,
+    see :func:`~sl_eval.models.utils.train_shards.make_train_dataset`
+    """
+    inputs = {'query': interleave_tensors(batch['query'], batch['query']),
+              'doc': interleave_tensors(batch['pos_doc'], batch['neg_doc']),
+              'query_len': interleave_tensors(batch['query_len'], batch['query_len']),
+              'doc_len': interleave_tensors(batch['pos_doc_len'], batch['neg_doc_len'])}
+    return inputs, tf.tile(tf.constant([1, 0], dtype=tf.float32), [tf.shape(batch['query'])[0]])
+
+
+def _labelled_inputs(batch, n_labels):
+    """Turns a batch of labelled pair rows of the train shards into the inputs of the model, in tensorflow ops,
+    see :func:`~sl_eval.models.utils.train_shards.make_train_dataset`
+    """
+    inputs = {'query': batch['query'], 'doc': batch['doc'], 'query_len': batch['query_len'], 'doc_len': batch['doc_len']}
+    return inputs, tf.one_hot(batch['label'][:, 0], n_labels)
+
+
+def _get_full_batch_iter(triplets, batch_size, corpus, text_maxlen, pad_word_index, seed=None):
     """Provides all the data points int the format: X1, X2, y with
     alternate positive and negative examples of `batch_size` in a streamable format.
 
     Parameters
     ----------
-    pair_list : iterable list of tuple
-                See docstring for _get_pair_list for more details
+    triplets : tuple of numpy arrays
+        The (query, positive_doc, negative_doc) sentence indices,
+        see :func:`~sl_eval.models.utils.corpus.get_triplets`
     batch_size : int
         half the size in which the generator will yield datapoints. The size is doubled since
         we include positive and negative examples.
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+        The corpus the indices in `triplets` refer to
     text_maxlen : int
-        the maimum length that a document/query can take
+        the maximum length that a document/query can take
+    pad_word_index : int
+    seed : int, optional
+        The seed of the permutation the triplets are shuffled with each epoch.
+        If None, they are kept in their order
+
+    The arrays of a batch are overwritten N_BATCH_BUFFERS batches later, so at most N_BATCH_BUFFERS - 1
+    batches may be queued ahead of the one being trained on.
 
     Yields
     -------
@@ -106,82 +167,24 @@ def _get_full_batch_iter(pair_list, batch_size, text_maxlen):
         the queries
     X2 : numpy array of shape (batch_size * 2, text_maxlen)
         the docs
-    y : numpy array with {0, 1} of shape (batch_size * 2, 1)
+    y : numpy array with {0, 1} of shape (batch_size * 2,)
         The relation between X1[i] and X2[j]
         1 : X2[i] is relevant to X1[i]
         0 : X2[i] is not relevant to X1[i]
     """
-
-    X1, X2, X1_len, X2_len, y = [], [], [], [], []
-    while True:
-        for i, (query, pos_doc, neg_doc) in enumerate(pair_list):
-            query, query_len = query
-            pos_doc, pos_doc_len = pos_doc
-            neg_doc, neg_doc_len = neg_doc
-
-            X1.append(query)
-            X1_len.append(query_len)
-            X2.append(pos_doc)
-            X2_len.append(pos_doc_len)
-            y.append(1)
-
-            X1.append(query)
-            X1_len.append(query_len)
-            X2.append(neg_doc)
-            X2_len.append(neg_doc_len)
-            y.append(0)
-
-            if i % batch_size == 0 and i != 0:
-                yield ({'query': np.array(X1), 'doc': np.array(X2),
-                    'dpool_index': DynamicMaxPooling.dynamic_pooling_index(X1_len, X2_len, text_maxlen, text_maxlen)}, np.array(y))
-                X1, X2, X1_len, X2_len, y = [], [], [], [], []
-
-def _get_pair_list(queries, docs, labels, _make_indexed):
-    """Yields a tuple with query document pairs in the format
-    (query, positive_doc, negative_doc)
-    [(q1, d+, d-), (q2, d+, d-), (q3, d+, d-), ..., (qn, d+, d-)]
-        where each query or document is a list of int
-
-    Parameters
-    ----------
-    queries : iterable list of list of str
-        The queries to the model
-    docs : iterable list of list of list of str
-        The candidate documents for each query
-    labels : iterable list of int
-        The relevance of the document to the query. 1 = relevant, 0 = not relevant
-    _make_indexed : function
-        Translates the given sentence as a list of list of str into a list of list of int
-        based on the model's internal dictionary
-
-    Example
-    -------
-    [(['When', 'was', 'Abraham', 'Lincoln', 'born', '?'],
-      ['He', 'was', 'born', 'in', '1809'],
-      ['Abraham', 'Lincoln', 'was', 'the', 'president',
-       'of', 'the', 'United', 'States', 'of', 'America']),
-
-     (['When', 'was', 'the', 'first', 'World', 'War', '?'],
-      ['It', 'was', 'fought', 'in', '1914'],
-      ['There', 'were', 'over', 'a', 'million', 'deaths']),
-
-     (['When', 'was', 'the', 'first', 'World', 'War', '?'],
-      ['It', 'was', 'fought', 'in', '1914'],
-      ['The', 'first', 'world', 'war', 'was', 'bad'])
-    ]
-
-    """
-
-    while True:
-        j=0
-        for q, doc, label in zip(queries, docs, labels):
-            doc, label = (list(t) for t in zip(*sorted(zip(doc, label), reverse=True)))
-            for item in zip(doc, label):
-                if item[1] == 1:
-                    for new_item in zip(doc, label):
-                        if new_item[1] == 0:
-                            j+=1
-                            yield((_make_indexed(q), len(q)), (_make_indexed(item[0]), len(item[0])), (_make_indexed(new_item[0]), len(new_item[0])))
+    buffers = BatchBuffers({'query': ((2 * batch_size, text_maxlen), corpus.ids.dtype),
+                            'doc': ((2 * batch_size, text_maxlen), corpus.ids.dtype),
+                            'query_len': ((2 * batch_size,), INDEX_DTYPE),
+                            'doc_len': ((2 * batch_size,), INDEX_DTYPE)})
+    for X1, X2, y in iter_pair_batches(triplets, batch_size, seed=seed):
+        # The sentences are sliced and padded from the corpus in one go for the whole batch,
+        # into arrays which are reused every N_BATCH_BUFFERS batches
+        batch = buffers.next()
+        corpus.pad_sentences(X1, text_maxlen, pad_word_index, out=batch['query'])
+        corpus.pad_sentences(X2, text_maxlen, pad_word_index, out=batch['doc'])
+        np.take(corpus.lengths, X1, out=batch['query_len'])
+        np.take(corpus.lengths, X2, out=batch['doc_len'])
+        yield dict(batch), y
 
 
 class MatchPyramid(utils.SaveLoad):
@@ -192,7 +195,10 @@ class MatchPyramid(utils.SaveLoad):
     def __init__(self, queries=None, docs=None, labels=None, word_embedding=None,
                  text_maxlen=200, normalize_embeddings=True, epochs=10, unk_handle_method='random',
                  validation_data=None, topk=50, target_mode='ranking', verbose=1, batch_size=20, steps_per_epoch=100,
-                 num_inferences=3):
+                 num_inferences=3, cache_dir=None, trim_vocab=False, inference_corpora=None,
+                 n_spare_rows=1000, embedding_store=None, embedding_dtype='float32', vocab_workers=1,
+                 shuffle_seed=42, batch_workers=1, train_shards_dir=None, length_buckets=None,
+                 length_coverage=None, negatives_per_positive=None, negative_sampling='uniform'):
         """Initializes the model and trains it
 
         Parameters
@@ -236,6 +242,57 @@ class MatchPyramid(utils.SaveLoad):
             for example: {'contradiction', 'entailment', 'temp'} -> 3
         steps_per_epoch : int
             number of steps which will consitute one epoch
+        cache_dir : str, optional
+            Folder where the built vocab and embedding matrix are cached, keyed by the training corpus,
+            the word embeddings, `unk_handle_method` and `normalize_embeddings`.
+            Later runs with the same inputs memory map them from there instead of rebuilding them.
+            If None, nothing is cached.
+        trim_vocab : bool, optional
+            If True, only the words of the train data, the validation data and `inference_corpora` are put
+            in the embedding matrix instead of every word of `word_embedding`. It makes the model much
+            smaller to keep in memory, save and load. Words met later on are added to the spare rows
+            (see `n_spare_rows`) and once those run out, they are set to the unk word.
+        inference_corpora : list of iterable list of list of str, optional
+            Corpora of sentences the model will be used on. Only used if `trim_vocab` is True.
+        n_spare_rows : int, optional
+            The number of rows kept free in the embedding matrix for words unseen while building the vocab.
+            Only used if `trim_vocab` is True.
+        embedding_store : :class:`~sl_eval.models.utils.embedding_store.EmbeddingStore`, optional
+            A store shared with other models in the process. If given, its embedding matrix and Embedding layer
+            are used instead of building new ones, `cache_dir` isn't used and its `unk_handle_method`
+            and `normalize_embeddings` take precedence over the model's.
+        embedding_dtype : {'float32', 'float16'}, optional
+            The dtype the embedding matrix is stored in. 'float16' halves its memory, which is mostly useful
+            for models only used for inference. The Embedding layer computes in float32 either way.
+        vocab_workers : int, optional
+            The number of processes the train data is counted and indexed in while building the vocab.
+            If 1, it is done in this process.
+        shuffle_seed : int, optional
+            The seed of the permutation the (query, relevant doc, irrelevant doc) triplets are shuffled with
+            each epoch in the 'ranking' target_mode. If None, they are kept in the order of the data.
+        batch_workers : int, optional
+            The number of processes the train batches are made in. If more than 1, keras makes them from a
+            Sequence in as many worker processes. If 1, a generator makes them in this process.
+        train_shards_dir : str, optional
+            If given, the train data is exported to sharded .npy files in this folder, or found there from
+            an earlier run, and read back by a tf.data pipeline. This takes precedence over batch_workers.
+        length_buckets : list of int, optional
+            The widths the sentences are padded to, like [10, 20, 40, 80]. If given, the model is built with
+            dynamic sentence lengths, and the batches of the train generator and of the predictions are grouped by
+            length and padded to the smallest width which holds their sentences instead of `text_maxlen`.
+        length_coverage : float between 0 and 1, optional
+            If given, like 0.995, text_maxlen is set to the shortest length which leaves
+            this share of the train sentences untruncated.
+            Either way, the length percentiles of the train data and the recommended sizes are logged when
+            the vocab is built.
+        negatives_per_positive : int, optional
+            If given, each relevant doc is trained against at most this many irrelevant docs of its query, drawn
+            again each epoch, instead of against all of them. This keeps the number of triplets linear in the
+            size of the groups. The shards and the length buckets draw them once per call to train.
+        negative_sampling : {'uniform', 'hard'}, optional
+            How the irrelevant docs are drawn when `negatives_per_positive` is given. 'uniform' draws them at
+            random. 'hard' picks those the model scores highest, from predictions of all the train pairs made
+            before training and refreshed at the end of each epoch.
 
 
         Examples
@@ -254,11 +311,10 @@ class MatchPyramid(utils.SaveLoad):
         self.queries = queries
         self.docs = docs
         self.labels = labels
-        self.word_counter = Counter()
         self.text_maxlen = text_maxlen
         self.topk = topk
         self.word_embedding = word_embedding
-        self.word2index, self.index2word = {}, {}
+        self.vocab = Vocabulary()
         self.normalize_embeddings = normalize_embeddings
         self.model = None
         self.epochs = epochs
@@ -269,11 +325,38 @@ class MatchPyramid(utils.SaveLoad):
         self.needs_vocab_build = True
         self.batch_size = batch_size
         self.steps_per_epoch = steps_per_epoch
+        self.cache_dir = cache_dir
+        self.trim_vocab = trim_vocab
+        self.inference_corpora = inference_corpora or []
+        self.n_spare_rows = n_spare_rows if trim_vocab else 0
+        self.embedding_store = embedding_store
+        self.vocab_workers = vocab_workers
+        self.shuffle_seed = shuffle_seed
+        self.batch_workers = batch_workers
+        self.train_shards_dir = train_shards_dir
+        self.length_buckets = length_buckets
+        self.length_coverage = length_coverage
+        self.negatives_per_positive = negatives_per_positive
+        if negative_sampling not in ['uniform', 'hard']:
+            raise ValueError("Unkown negative_sampling %s. It must be either 'uniform' or 'hard'" % negative_sampling)
+        self.negative_sampling = negative_sampling
+        # The cached predictions of the train docs the hard negatives are picked from. See _score_train_docs
+        self._doc_scores = None
+        # The train data in word ids, made while building the vocab. See _get_indexed_corpus
+        self.indexed_corpus = None
+        self._corpus_source = None
+
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError("Unkown embedding_dtype %s. It must be one of %s" % (embedding_dtype, list(EMBEDDING_DTYPES)))
+        self.embedding_dtype = embedding_dtype
+
+        if self.embedding_store is not None and self.trim_vocab:
+            raise ValueError("trim_vocab can't be used with a shared embedding_store")
         self.num_inferences = num_inferences
 
         # These functions have been defined outside the class and set as attributes here
         # so that they can be ignored when saving the model to file
-        self._get_pair_list = _get_pair_list
+        self._get_pair_list = get_triplets
         self._get_full_batch_iter = _get_full_batch_iter
 
         if self.target_mode not in ['ranking', 'classification', 'inference']:
@@ -298,26 +381,40 @@ class MatchPyramid(utils.SaveLoad):
 
         logger.info("Starting Vocab Build")
 
-        # get all the vocab words
-        for q in self.queries:
-            self.word_counter.update(q)
-
-        if self.target_mode in ['classification', 'inference']:
-            for doc in self.docs:
-                self.word_counter.update(doc)
-        else:
-            for doc in self.docs:
-                for d in doc:
-                    self.word_counter.update(d)
-
-        for i, word in enumerate(self.word_counter.keys()):
-            self.word2index[word] = i
-            self.index2word[i] = word
-
-        self.vocab_size = len(self.word2index)
+        # Count and index the train data in one pass over it
+        corpus, counts, corpus_fingerprint = build_indexed_corpus(
+            self.queries, self.docs, self.labels, target_mode=self.target_mode, n_workers=self.vocab_workers
+        )
+        train_words = corpus.words
+
+        # Size text_maxlen from the lengths of the train sentences, before the keras model is built
+        length_coverage = getattr(self, 'length_coverage', None)
+        text_maxlen, _ = recommend_sizes(corpus, self.text_maxlen, None,
+                                         coverage=length_coverage or DEFAULT_LENGTH_COVERAGE)
+        if length_coverage is not None:
+            self.text_maxlen = text_maxlen
+            logger.info("text_maxlen is set to %d", self.text_maxlen)
+
+        # Words which will be met outside the train data
+        corpus_words = []
+        if self.trim_vocab:
+            seen_words = set(train_words)
+            for sentence in self._get_trim_corpora_sentences():
+                for word in sentence:
+                    if word not in seen_words:
+                        seen_words.add(word)
+                        corpus_words.append(word)
+                corpus_fingerprint.update(sentence)
+
+        self.vocab_size = len(train_words)
         logger.info("Vocab Build Complete")
         logger.info("Vocab Size is %d", self.vocab_size)
 
+        if self.embedding_store is not None:
+            self._use_embedding_store(train_words)
+            self._set_indexed_corpus(corpus)
+            return
+
         logger.info("Building embedding index using KeyedVector pretrained word embeddings")
         if type(self.word_embedding) == KeyedVectors:
             kv_model = self.word_embedding
@@ -332,75 +429,58 @@ class MatchPyramid(utils.SaveLoad):
             "The embeddings_index built from the given file has %d words of %d dimensions",
             embedding_vocab_size, self.embedding_dim
         )
+        # Words without a pretrained vector would only be unk words, so they aren't kept
+        corpus_words = [word for word in corpus_words if word in kv_model.vocab]
+
+        cached = None
+        if self.cache_dir is not None:
+            cache_key = get_cache_key(
+                corpus_fingerprint.hexdigest(), kv_model, self.unk_handle_method, self.normalize_embeddings,
+                target_mode=self.target_mode, trim_vocab=self.trim_vocab, n_spare_rows=self.n_spare_rows,
+                embedding_dtype=self.embedding_dtype
+            )
+            # A trimmed embedding matrix is small and gets written into when extending the vocab
+            cached = load_vocab_cache(self.cache_dir, cache_key, mmap_mode=None if self.trim_vocab else 'r')
+
+        if cached is not None:
+            self.embedding_matrix = cached['embedding_matrix']
+            self.vocab = cached['vocab']
+            self.pad_word_index = cached['pad_word_index']
+            self.unk_word_index = cached['unk_word_index']
+        else:
+            logger.info("Building the Embedding Matrix for the model's Embedding Layer")
 
-        logger.info("Building the Embedding Matrix for the model's Embedding Layer")
-
-        # Initialize the embedding matrix
-        # UNK word gets the vector based on the method
-        if self.unk_handle_method == 'random':
-            self.embedding_matrix = np.random.uniform(-0.2, 0.2, (self.vocab_size, self.embedding_dim))
-        elif self.unk_handle_method == 'zero':
-            self.embedding_matrix = np.zeros((self.vocab_size, self.embedding_dim))
+            self.embedding_matrix, extra_words, n_non_embedding_words = build_embedding_matrix(
+                train_words + corpus_words, kv_model, unk_handle_method=self.unk_handle_method,
+                normalize_embeddings=self.normalize_embeddings,
+                add_extra_words=not self.trim_vocab, n_spare_rows=self.n_spare_rows,
+                dtype=EMBEDDING_DTYPES[self.embedding_dtype]
+            )
+            logger.info(
+                "There are %d words out of %d (%.2f%%) not in the embeddings. Setting them to %s",
+                n_non_embedding_words, self.vocab_size, n_non_embedding_words * 100 / self.vocab_size,
+                self.unk_handle_method
+            )
 
-        n_non_embedding_words = 0
-        for word, i in self.word2index.items():
-            if word in kv_model:
-                # words not found in keyed vectors will get the vector based on unk_handle_method
-                self.embedding_matrix[i] = kv_model[word]
-            else:
-                if self.unk_handle_method == 'random':
-                    # Creates the same random vector for the given string each time
-                    self.embedding_matrix[i] = self._seeded_vector(word, self.embedding_dim)
-                n_non_embedding_words += 1
-        logger.info(
-            "There are %d words out of %d (%.2f%%) not in the embeddings. Setting them to %s", n_non_embedding_words,
-            self.vocab_size, n_non_embedding_words * 100 / self.vocab_size, self.unk_handle_method
-        )
+            # The words in the embedding file which aren't there in the train vocab are indexed after it
+            # It will be useful for embedding words encountered in validation and test set
+            extra_words = corpus_words + extra_words
+            logger.info("Added %d additional words from the embedding file to embedding matrix", len(extra_words))
+            self.vocab = Vocabulary(train_words + extra_words, counts=counts)
 
-        # Include embeddings for words in embedding file but not in the train vocab
-        # It will be useful for embedding words encountered in validation and test set
-        logger.info(
-            "Adding additional words from the embedding file to embedding matrix"
-        )
+            # Set the pad and unk word to second last and last index
+            self.pad_word_index = self.vocab_size + len(extra_words)
+            self.unk_word_index = self.pad_word_index + 1
 
-        # The point where vocab words end
-        vocab_offset = self.vocab_size
-        extra_embeddings = []
-        # Take the words in the embedding file which aren't there int the train vocab
-        for word in list(kv_model.vocab):
-            if word not in self.word2index:
-                # Add the new word's vector and index it
-                extra_embeddings.append(kv_model[word])
-                # We also need to keep an additional indexing of these
-                # words
-                self.word2index[word] = vocab_offset
-                vocab_offset += 1
-
-        # Set the pad and unk word to second last and last index
-        self.pad_word_index = vocab_offset
-        self.unk_word_index = vocab_offset + 1
-
-        if self.unk_handle_method == 'random':
-            unk_embedding_row = np.random.uniform(-0.2, 0.2, (1, self.embedding_dim))
-        elif self.unk_handle_method == 'zero':
-            unk_embedding_row = np.zeros((1, self.embedding_dim))
-
-        pad_embedding_row = np.random.uniform(-0.2,
-                                              0.2, (1, self.embedding_dim))
-
-        if len(extra_embeddings) > 0:
-            self.embedding_matrix = np.vstack(
-                [self.embedding_matrix, np.array(extra_embeddings),
-                 pad_embedding_row, unk_embedding_row]
-            )
-        else:
-            self.embedding_matrix = np.vstack(
-                [self.embedding_matrix, pad_embedding_row, unk_embedding_row]
-            )
+            if self.cache_dir is not None:
+                save_vocab_cache(
+                    self.cache_dir, cache_key, self.vocab, self.vocab_size, self.embedding_matrix,
+                    self.pad_word_index, self.unk_word_index
+                )
 
-        if self.normalize_embeddings:
-            logger.info("Normalizing the word embeddings")
-            self.embedding_matrix = normalize(self.embedding_matrix)
+        # The spare rows come right after the unk word
+        self.next_spare_row = self.unk_word_index + 1
+        self._set_indexed_corpus(corpus)
 
         logger.info("Embedding Matrix build complete. It now has shape %s", str(self.embedding_matrix.shape))
         logger.info("Pad word has been set to index %d", self.pad_word_index)
@@ -408,49 +488,120 @@ class MatchPyramid(utils.SaveLoad):
         logger.info("Embedding index build complete")
         self.needs_vocab_build = False
 
-    def _string2numeric_hash(self, text):
-        "Gets a numeric hash for a given string"
-        return int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+    def _use_embedding_store(self, train_words):
+        """Points the vocab and the embedding matrix to the ones of `embedding_store`
 
-    def _seeded_vector(self, seed_string, vector_size):
-        """Create one 'random' vector (but deterministic by seed_string)"""
-        # Note: built-in hash() may vary by Python version or even (in Py3.x) per launch
-        once = np_random.RandomState(self._string2numeric_hash(seed_string) & 0xffffffff)
-        return (once.rand(vector_size) - 0.5) / vector_size
+        Parameters
+        ----------
+        train_words : list of str
+            The train vocab words
+        """
+        store = self.embedding_store
+        if store.unk_handle_method != self.unk_handle_method or store.normalize_embeddings != self.normalize_embeddings:
+            logger.warning(
+                "The embedding store uses unk_handle_method=%s and normalize_embeddings=%s. They will be used instead",
+                store.unk_handle_method, store.normalize_embeddings
+            )
+            self.unk_handle_method = store.unk_handle_method
+            self.normalize_embeddings = store.normalize_embeddings
 
-    def _make_indexed(self, sentence):
-        """Gets the indexed version of the sentence based on the self.word2index dict
-        in the form of a list
+        # Train words without a pretrained vector get a row in the store
+        store.add_words(train_words)
 
-        This function should never encounter any OOV words since it only indexes
-        in vocab words
+        self.vocab = store.vocab
+        self.embedding_matrix = store.embedding_matrix
+        self.embedding_dim = store.embedding_dim
+        self.pad_word_index = store.pad_word_index
+        self.unk_word_index = store.unk_word_index
+
+        logger.info("Using the shared embedding matrix of shape %s", str(self.embedding_matrix.shape))
+        logger.info("Pad word has been set to index %d", self.pad_word_index)
+        logger.info("Unknown word has been set to index %d", self.unk_word_index)
+        self.needs_vocab_build = False
+
+    def _get_trim_corpora_sentences(self):
+        """Yields the sentences of the validation data and of `inference_corpora`"""
+        if self.validation_data is not None:
+            val_queries, val_docs, _ = self.validation_data
+            for q in val_queries:
+                yield q
+            for doc in val_docs:
+                if self.target_mode == 'ranking':
+                    for d in doc:
+                        yield d
+                else:
+                    yield doc
+
+        for corpus in self.inference_corpora:
+            for sentence in corpus:
+                yield sentence
+
+    def _extend_vocab(self, data):
+        """Adds the words of `data` which are in `word_embedding` but not in the vocab to the spare rows
+        of a trimmed embedding matrix and updates the Embedding layer with them.
+
+        Does nothing if the vocab isn't trimmed or the model was loaded without its word embeddings.
+        Words which don't fit in the spare rows are left to be set to the unk word.
 
         Parameters
         ----------
-        sentence : iterable list of list of str
-            The sentence to be indexed
-
-        Raises
-        ------
-        ValueError : If the sentence has a lenght more than text_maxlen
+        data : list of list of str
         """
+        if not getattr(self, 'trim_vocab', False) or self.word_embedding is None:
+            return
+
+        kv_model = self.word_embedding
+        words = list(dict.fromkeys(word for sentence in data for word in sentence))
+        new_words = [
+            word for word, index in zip(words, self.vocab.lookup(words)) if index < 0 and word in kv_model.vocab
+        ]
+        if not new_words:
+            return
+
+        n_free_rows = len(self.embedding_matrix) - self.next_spare_row
+        if len(new_words) > n_free_rows:
+            logger.info(
+                "Only %d of %d new words fit in the spare rows. The rest will be set to the unk word",
+                n_free_rows, len(new_words)
+            )
+            new_words = new_words[:n_free_rows]
+            if not new_words:
+                return
 
-        indexed_sent = []
-        for word in sentence:
-            if word in self.word2index:
-                indexed_sent.append(self.word2index[word])
-            else:
-                indexed_sent.append(self.unk_word_index)
+        start, end = self.next_spare_row, self.next_spare_row + len(new_words)
+        self.embedding_matrix[start: end] = kv_model.vectors[[kv_model.vocab[word].index for word in new_words]]
+        if self.normalize_embeddings:
+            normalize_rows(self.embedding_matrix[start: end])
+        self.vocab.extend(new_words, ids=np.arange(start, end))
+        self.next_spare_row = end
+
+        if self.model is not None:
+            self.model.get_layer('word_embedding').set_weights([self.embedding_matrix])
+        logger.info("Added %d words to the spare rows of the embedding matrix", len(new_words))
+
+    def _set_indexed_corpus(self, corpus):
+        """Translates `corpus` from the ids of its own words to the model's and keeps it as the train data
 
+        Parameters
+        ----------
+        corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+        """
+        self._extend_vocab([corpus.words])
+        self.indexed_corpus = corpus.remap(self.vocab.lookup(corpus.words, default=self.unk_word_index))
+        self._corpus_source = (self.queries, self.docs, self.labels)
 
-        if len(indexed_sent) > self.text_maxlen:
-            indexed_sent = indexed_sent[:self.text_maxlen]
-            #raise ValueError(
-             #   "text_maxlen: %d isn't big enough. Error at sentence of length %d."
-              #  "Sentence is %s" % (self.text_maxlen, len(sentence), sentence)
-            #)
-        indexed_sent = indexed_sent + [self.pad_word_index] * (self.text_maxlen - len(indexed_sent))
-        return indexed_sent
+    def _get_indexed_corpus(self):
+        """Gets the train data as an :class:`~sl_eval.models.utils.corpus.IndexedCorpus` in the model's word ids.
+        It is only indexed again if the train data changed since the vocab was built, like when retraining.
+        """
+        source = (self.queries, self.docs, self.labels)
+        if getattr(self, 'indexed_corpus', None) is None or \
+                any(new is not old for new, old in zip(source, self._corpus_source)):
+            corpus, _, _ = build_indexed_corpus(
+                *source, target_mode=self.target_mode, n_workers=getattr(self, 'vocab_workers', 1)
+            )
+            self._set_indexed_corpus(corpus)
+        return self.indexed_corpus
 
     def _get_full_batch(self):
         """Provides all the data points int the format: X1, X2, y with
@@ -467,51 +618,209 @@ class MatchPyramid(utils.SaveLoad):
             1 : X2[i] is relevant to X1[i]
             0 : X2[i] is not relevant to X1[i]
         """
-        X1, X2, y = [], [], []
-        for i, (query, pos_doc, neg_doc) in enumerate(self.pair_list):
-            X1.append(query)
-            X2.append(pos_doc)
-            y.append(1)
-            X1.append(query)
-            X2.append(neg_doc)
-            y.append(0)
+        pair_list = self.pair_list
+        if callable(pair_list):
+            pair_list = pair_list(np.random.RandomState(getattr(self, 'shuffle_seed', None)))
+        X1, X2, y = interleave_pairs(*pair_list)
 
-        return np.array(X1), np.array(X2), np.array(y)
+        corpus = self._get_indexed_corpus()
+        return (corpus.pad_sentences(X1, self.text_maxlen, self.pad_word_index),
+                corpus.pad_sentences(X2, self.text_maxlen, self.pad_word_index), np.array(y, dtype=np.float32))
 
     def _get_classification_batch(self, batch_size):
         """Yields batches of data to train for classification tasks"""
+        corpus = self._get_indexed_corpus()
+        labels = np.asarray(corpus.labels)
+        # The two sentences of a pair are the 'query' and 'doc' of its group
+        x1_indices = corpus.group_offsets[:-1]
+        # Only full batches are yielded
+        n_samples = len(corpus) - len(corpus) % batch_size
         while True:
-            x1_batch, x2_batch, dupl_batch = [], [], []
-            x1_len, x2_len = [], []
-            for x1, x2, d in zip(self.queries, self.docs, self.labels):
-                x1_batch.append(self._make_indexed(x1))
-                x2_batch.append(self._make_indexed(x2))
-                x1_len.append(len(x1))
-                x2_len.append(len(x2))
-                dupl_batch.append(to_categorical(d, 2))
-
-                if len(x1_batch) % batch_size == 0:
-                    yield ({'query': np.array(x1_batch), 'doc': np.array(x2_batch),
-                        'dpool_index': DynamicMaxPooling.dynamic_pooling_index(x1_len, x2_len, self.text_maxlen, self.text_maxlen)}, np.squeeze(np.array(dupl_batch)))
-                    x1_batch, x2_batch, dupl_batch, x1_len, x2_len = [], [], [], [], []
+            for start in range(0, n_samples, batch_size):
+                x1_batch = x1_indices[start: start + batch_size]
+                x2_batch = x1_batch + 1
+                yield ({'query': corpus.pad_sentences(x1_batch, self.text_maxlen, self.pad_word_index),
+                        'doc': corpus.pad_sentences(x2_batch, self.text_maxlen, self.pad_word_index),
+                        'query_len': corpus.lengths[x1_batch], 'doc_len': corpus.lengths[x2_batch]},
+                       np.squeeze(to_categorical(labels[start: start + batch_size], 2).astype(np.float32)))
 
     def _get_inference_batch(self, batch_size):
         """Yields batches of data to train for classification tasks"""
+        corpus = self._get_indexed_corpus()
+        labels = np.asarray(corpus.labels)
+        # The two sentences of a pair are the 'query' and 'doc' of its group
+        x1_indices = corpus.group_offsets[:-1]
+        # Only full batches are yielded
+        n_samples = len(corpus) - len(corpus) % batch_size
         while True:
-            x1_batch, x2_batch, dupl_batch = [], [], []
-            x1_len, x2_len = [], []
-            for x1, x2, d in zip(self.queries, self.docs, self.labels):
-                x1_batch.append(self._make_indexed(x1))
-                x2_batch.append(self._make_indexed(x2))
-                x1_len.append(len(x1))
-                x2_len.append(len(x2))
-                dupl_batch.append(to_categorical(d, self.num_inferences))
+            for start in range(0, n_samples, batch_size):
+                x1_batch = x1_indices[start: start + batch_size]
+                x2_batch = x1_batch + 1
+                yield ({'query': corpus.pad_sentences(x1_batch, self.text_maxlen, self.pad_word_index),
+                        'doc': corpus.pad_sentences(x2_batch, self.text_maxlen, self.pad_word_index),
+                        'query_len': corpus.lengths[x1_batch], 'doc_len': corpus.lengths[x2_batch]},
+                       np.squeeze(to_categorical(labels[start: start + batch_size], self.num_inferences).astype(np.float32)))
+
+    def _get_train_sequence(self, batch_size):
+        """Returns a keras Sequence of the train batches, which keras can make in several worker processes
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of triplets of a batch in the 'ranking' target_mode, or else of pairs
+        """
+        corpus = self._get_indexed_corpus()
+        batch_kwargs = dict(corpus=corpus, text_maxlen=self.text_maxlen, pad_word_index=self.pad_word_index)
+        if self.target_mode == 'ranking':
+            self.pair_list = self._get_train_triplets(corpus)
+            return TripletSequence(self.pair_list, batch_size, _make_batch, seed=getattr(self, 'shuffle_seed', None),
+                                   **batch_kwargs)
+        elif self.target_mode == 'classification':
+            return LabelledPairSequence(corpus, batch_size, 2, _make_batch, **batch_kwargs)
+        elif self.target_mode == 'inference':
+            return LabelledPairSequence(corpus, batch_size, self.num_inferences, _make_batch, **batch_kwargs)
+        raise ValueError('Unkown target mode %s' % str(self.target_mode))
+
+    def _get_train_dataset_iter(self, batch_size):
+        """Returns a generator of the train batches made by a tf.data pipeline from .npy shards in
+        `train_shards_dir`, which are exported first unless an earlier run already did.
+        See :mod:`~sl_eval.models.utils.train_shards`
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of triplets of a batch in the 'ranking' target_mode, or else of pairs
+        """
+        corpus = self._get_indexed_corpus()
+        if self.target_mode == 'ranking':
+            self.pair_list = self._get_train_triplets(corpus, resample=False)
+            query, pos_doc, neg_doc = self.pair_list
+            columns = [('query', query, self.text_maxlen), ('pos_doc', pos_doc, self.text_maxlen),
+                       ('neg_doc', neg_doc, self.text_maxlen), ('query_len', corpus.lengths[query], None),
+                       ('pos_doc_len', corpus.lengths[pos_doc], None), ('neg_doc_len', corpus.lengths[neg_doc], None)]
+            to_inputs = _ranking_inputs
+        elif self.target_mode in ['classification', 'inference']:
+            n_labels = 2 if self.target_mode == 'classification' else self.num_inferences
+            # The two sentences of a pair are the 'query' and 'doc' of its group
+            query = corpus.group_offsets[:-1]
+            columns = [('query', query, self.text_maxlen), ('doc', query + 1, self.text_maxlen),
+                       ('label', np.asarray(corpus.labels), None), ('query_len', corpus.lengths[query], None),
+                       ('doc_len', corpus.lengths[query + 1], None)]
+            to_inputs = partial(_labelled_inputs, n_labels=n_labels)
+        else:
+            raise ValueError('Unkown target mode %s' % str(self.target_mode))
 
-                if len(x1_batch) % batch_size == 0:
-                    yield ({'query': np.array(x1_batch), 'doc': np.array(x2_batch),
-                        'dpool_index': DynamicMaxPooling.dynamic_pooling_index(x1_len, x2_len, self.text_maxlen, self.text_maxlen)}, np.squeeze(np.array(dupl_batch)))
-                    x1_batch, x2_batch, dupl_batch, x1_len, x2_len = [], [], [], [], []
+        key = save_train_shards(self.train_shards_dir, corpus, columns, self.pad_word_index,
+                                model='MatchPyramid', target_mode=self.target_mode)
+        dataset = make_train_dataset(self.train_shards_dir, key, batch_size, to_inputs,
+                                     seed=getattr(self, 'shuffle_seed', None))
+        return iter_dataset(dataset, K.get_session())
 
+    def _get_bucket_widths(self, lengths):
+        """Returns the widths sentences of the given lengths are padded to as queries and as docs,
+        see :mod:`~sl_eval.models.utils.buckets`
+
+        Parameters
+        ----------
+        lengths : numpy array of int
+        """
+        widths = get_bucket_widths(lengths, self.length_buckets, self.text_maxlen)
+        return widths, widths
+
+    def _get_bucketed_batch_iter(self, batch_size):
+        """Yields the train batches grouped by length, each padded to the widths of its bucket
+
+        Parameters
+        ----------
+        batch_size : int
+            The number of triplets of a batch in the 'ranking' target_mode, or else of pairs
+        """
+        corpus = self._get_indexed_corpus()
+        query_widths, doc_widths = self._get_bucket_widths(corpus.lengths)
+        if self.target_mode == 'ranking':
+            self.pair_list = self._get_train_triplets(corpus, resample=False)
+            query, pos_doc, neg_doc = self.pair_list
+            # Both pairs of a triplet go in the same batch, for the rank_hinge_loss
+            example_widths = (query_widths[query], np.maximum(doc_widths[pos_doc], doc_widths[neg_doc]))
+        elif self.target_mode in ['classification', 'inference']:
+            n_labels = 2 if self.target_mode == 'classification' else self.num_inferences
+            # The two sentences of a pair are the 'query' and 'doc' of its group
+            query = corpus.group_offsets[:-1]
+            labels = to_categorical(np.asarray(corpus.labels), n_labels).astype(np.float32)
+            example_widths = (query_widths[query], doc_widths[query + 1])
+        else:
+            raise ValueError('Unkown target mode %s' % str(self.target_mode))
+
+        for (query_width, doc_width), examples in iter_bucketed_batches(example_widths, batch_size,
+                                                                        seed=getattr(self, 'shuffle_seed', None)):
+            if self.target_mode == 'ranking':
+                X1, X2, y = interleave_pairs(query[examples], pos_doc[examples], neg_doc[examples])
+            else:
+                X1, y = query[examples], labels[examples]
+                X2 = X1 + 1
+            yield ({'query': corpus.pad_sentences(X1, query_width, self.pad_word_index),
+                    'doc': corpus.pad_sentences(X2, doc_width, self.pad_word_index),
+                    'query_len': corpus.lengths[X1], 'doc_len': corpus.lengths[X2]}, y)
+
+    def _get_train_triplets(self, corpus, resample=True):
+        """Returns the (query, relevant doc, irrelevant doc) triplets the model is trained on in the 'ranking'
+        target_mode, see :func:`~sl_eval.models.utils.corpus.get_triplets`
+
+        Parameters
+        ----------
+        corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+        resample : bool, optional
+            With `negatives_per_positive`, whether to return a function which draws new triplets from a
+            `RandomState` each epoch, see :func:`~sl_eval.models.utils.corpus.sample_triplets`.
+            Otherwise, the triplets are drawn once with `shuffle_seed`
+        """
+        negatives_per_positive = getattr(self, 'negatives_per_positive', None)
+        if negatives_per_positive is None:
+            return self._get_pair_list(corpus)
+
+        doc_scores = None
+        if getattr(self, 'negative_sampling', 'uniform') == 'hard':
+            # Filled in place by _score_train_docs, so the triplets drawn later see the new scores
+            if getattr(self, '_doc_scores', None) is None or len(self._doc_scores) != len(corpus.lengths):
+                self._doc_scores = np.zeros(len(corpus.lengths), dtype=np.float32)
+            doc_scores = self._doc_scores
+        draw_triplets = partial(sample_triplets, corpus, negatives_per_positive, doc_scores=doc_scores)
+        if resample:
+            return draw_triplets
+        return draw_triplets(np.random.RandomState(getattr(self, 'shuffle_seed', None)))
+
+    def _score_train_docs(self, batch_size=10000):
+        """Predicts each train doc with its query and caches the scores the hard negatives are picked from
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of pairs predicted at once
+        """
+        corpus = self._get_indexed_corpus()
+        if getattr(self, '_doc_scores', None) is None or len(self._doc_scores) != len(corpus.lengths):
+            self._doc_scores = np.zeros(len(corpus.lengths), dtype=np.float32)
+        queries, docs = get_doc_pairs(corpus)
+        for start in range(0, len(docs), batch_size):
+            X1, X2 = queries[start: start + batch_size], docs[start: start + batch_size]
+            x, _ = _make_batch(X1, X2, None, corpus, self.text_maxlen, self.pad_word_index)
+            self._doc_scores[X2] = self._predict(x).reshape(-1)
+        logger.info("Scored %d train docs for the hard negatives", len(docs))
+
+    def _predict(self, x):
+        """Predicts the translated pairs `x`, bucket by bucket if the model has `length_buckets`
+
+        Parameters
+        ----------
+        x : dict
+            The model's input with one row per query-doc pair, padded to text_maxlen
+        """
+        if getattr(self, 'length_buckets', None) is None:
+            return self.model.predict(x=x)
+        # The sentences are left aligned, so their clipped lengths are their numbers of words
+        query_widths, _ = self._get_bucket_widths(np.count_nonzero(x['query'] != self.pad_word_index, axis=1))
+        _, doc_widths = self._get_bucket_widths(np.count_nonzero(x['doc'] != self.pad_word_index, axis=1))
+        return predict_bucketed(self.model, x, {'query': query_widths, 'doc': doc_widths})
 
     def train(self, queries, docs, labels, word_embedding=None,
               text_maxlen=40, normalize_embeddings=True, epochs=10, unk_handle_method='zero',
@@ -547,11 +856,21 @@ class MatchPyramid(utils.SaveLoad):
         if self.needs_vocab_build:
             self.build_vocab(self.queries, self.docs, self.labels, self.word_embedding)
 
-
-        self.pair_list = self._get_pair_list(self.queries, self.docs, self.labels, self._make_indexed)
-
-        if self.target_mode == 'ranking':
-            train_generator = self._get_full_batch_iter(self.pair_list, batch_size, self.text_maxlen)
+        # The generators write their batches into reused buffers, see BatchBuffers
+        fit_kwargs = {'max_queue_size': N_BATCH_BUFFERS - 1}
+        if getattr(self, 'train_shards_dir', None) is not None:
+            train_generator = self._get_train_dataset_iter(batch_size if self.target_mode == 'ranking' else self.batch_size)
+            fit_kwargs = {}
+        elif getattr(self, 'batch_workers', 1) > 1:
+            train_generator = self._get_train_sequence(batch_size if self.target_mode == 'ranking' else self.batch_size)
+            fit_kwargs = {'workers': self.batch_workers, 'use_multiprocessing': True}
+        elif getattr(self, 'length_buckets', None) is not None:
+            train_generator = self._get_bucketed_batch_iter(batch_size if self.target_mode == 'ranking' else self.batch_size)
+        elif self.target_mode == 'ranking':
+            self.pair_list = self._get_train_triplets(self._get_indexed_corpus())
+            train_generator = self._get_full_batch_iter(self.pair_list, batch_size, self.indexed_corpus,
+                                                        self.text_maxlen, self.pad_word_index,
+                                                        seed=getattr(self, 'shuffle_seed', None))
         elif self.target_mode == 'classification':
             train_generator = self._get_classification_batch(self.batch_size)
         elif self.target_mode == 'inference':
@@ -587,26 +906,15 @@ class MatchPyramid(utils.SaveLoad):
         if self.validation_data is not None:
             test_queries, test_docs, test_labels = self.validation_data
 
-            long_doc_list = []
-            long_label_list = []
-            long_query_list = []
-            doc_lens = []
-
-            for query, doc, label in zip(test_queries, test_docs, test_labels):
-                i = 0
-                for d, l in zip(doc, label):
-                    long_query_list.append(query)
-                    long_doc_list.append(d)
-                    long_label_list.append(l)
-                    i += 1
-                doc_lens.append(len(doc))
-
-            indexed_long_query_list = self._translate_user_data(long_query_list)
-            indexed_long_doc_list = self._translate_user_data(long_doc_list)
+            test_queries, test_docs = list(test_queries), list(test_docs)
+            x, doc_lens = self._translate_groups(test_queries, test_docs)
+            long_label_list = [l for label in test_labels for l in label]
 
             val_callback = ValidationCallback(
-                                {"X1": indexed_long_query_list, "X2": indexed_long_doc_list, "doc_lengths": doc_lens,
-                                "y": long_label_list}
+                                {"X1": x['query'], "X2": x['doc'], "doc_lengths": doc_lens,
+                                "y": long_label_list},
+                                # The model also takes the query_len and doc_len inputs of x
+                                predict_fn=partial(self._predict, x)
                             )
             val_callback = [val_callback]  # since `model.fit` requires a list
 
@@ -616,8 +924,22 @@ class MatchPyramid(utils.SaveLoad):
 
         
         print('Fitting gen')
+        if (self.target_mode == 'ranking' and getattr(self, 'negatives_per_positive', None) is not None and
+                getattr(self, 'negative_sampling', 'uniform') == 'hard'):
+            # The hard negatives are picked with the current model, so the scores are refreshed after each epoch
+            self._score_train_docs()
+            val_callback = (val_callback or []) + [
+                LambdaCallback(on_epoch_end=lambda epoch, logs: self._score_train_docs())
+            ]
+
+        if isinstance(train_generator, TripletSequence):
+            # After the hard negatives are scored, so the triplets of the next epoch are drawn with the new scores
+            val_callback = (val_callback or []) + [
+                LambdaCallback(on_epoch_end=lambda epoch, logs: train_generator.set_epoch(epoch + 1))
+            ]
+
         self.model.fit_generator(train_generator, steps_per_epoch=self.steps_per_epoch, callbacks=val_callback,
-                                epochs=self.epochs, shuffle=False, verbose=1)
+                                epochs=self.epochs, shuffle=False, verbose=1, **fit_kwargs)
 
 
     def _translate_user_data(self, data, silent_mode=True):
@@ -640,38 +962,71 @@ class MatchPyramid(utils.SaveLoad):
         [[31  1 23 31  4  5  6 30 30 30]
          [31  1 31  8  6 30 30 30 30 30]]
         """
-        translated_data = []
-        n_skipped_words = 0
-
-        for sentence in data:
-            translated_sentence = []
-            for word in sentence:
-                if word in self.word2index:
-                    translated_sentence.append(self.word2index[word])
-                else:
-                    # If the key isn't there give it the zero word index
-                    translated_sentence.append(self.unk_word_index)
-                    n_skipped_words += 1
-
-            if len(translated_sentence) > self.text_maxlen:
-                translated_sentence = translated_sentence[:self.text_maxlen]
-            #raise ValueError(
-             #   "text_maxlen: %d isn't big enough. Error at sentence of length %d."
-              #  "Sentence is %s" % (self.text_maxlen, len(sentence), sentence)
-            #)
-            translated_sentence = translated_sentence + (self.text_maxlen - len(sentence)) * [self.pad_word_index]
-            # if str(np.array(translated_sentence).shape) != '(70,)':
-            #     print(np.array(translated_sentence))
-            #     print(np.array(translated_sentence).shape)
-            translated_data.append(np.array(translated_sentence))
+        self._extend_vocab(data)
+        translated_data, n_skipped_words = index_sentences(
+            data, self.vocab, self.text_maxlen, self.pad_word_index, self.unk_word_index
+        )
+
         if not silent_mode:
             logger.info(
                 "Found %d unknown words. Set them to unknown word index : %d", n_skipped_words, self.unk_word_index
             )
-
-        translated_data = np.array(translated_data)
         return translated_data
 
+    def _translate_groups(self, queries, docs):
+        """Translates queries with their groups of candidate docs into the model's input.
+        Each query is indexed once and its row is repeated for each of its docs.
+
+        Parameters
+        ----------
+        queries : list of list of str
+        docs : list of list of list of str
+
+        Returns
+        -------
+        x : dict
+            The model's input with one row per query-doc pair
+        doc_lens : list of int
+            The number of docs of each query
+        """
+        doc_lens = [len(doc) for doc in docs]
+        indexed_queries = self._translate_user_data(queries)
+        indexed_docs = self._translate_user_data([d for doc in docs for d in doc])
+        x = {'query': np.repeat(indexed_queries, doc_lens, axis=0), 'doc': indexed_docs}
+        x['query_len'] = np.repeat(np.array([len(query) for query in queries], dtype=INDEX_DTYPE), doc_lens)
+        x['doc_len'] = np.array([len(d) for doc in docs for d in doc], dtype=INDEX_DTYPE)
+        return x, doc_lens
+
+    def _evaluate_accuracy(self, X1, X2, D, batch_size):
+        """Predicts the sentence pairs in batches and returns the accuracy of the argmax of the predictions.
+        Only full batches are evaluated.
+
+        Parameters
+        ----------
+        X1 : list of list of str
+        X2 : list of list of str
+        D : list of int
+            The class of each pair
+        batch_size : int
+        """
+        X1, X2, D = list(X1), list(X2), list(D)
+        num_total = min(len(X1), len(X2), len(D))
+        num_total -= num_total % batch_size
+        indexed_X1 = self._translate_user_data(X1[:num_total])
+        indexed_X2 = self._translate_user_data(X2[:num_total])
+        x1_len = np.array([len(x1) for x1 in X1[:num_total]], dtype=INDEX_DTYPE)
+        x2_len = np.array([len(x2) for x2 in X2[:num_total]], dtype=INDEX_DTYPE)
+
+        num_correct = 0
+        for start in range(0, num_total, batch_size):
+            batch = slice(start, start + batch_size)
+            x = {'query': indexed_X1[batch], 'doc': indexed_X2[batch], 'query_len': x1_len[batch],
+                 'doc_len': x2_len[batch]}
+            this_pred = self._predict(x)
+            num_correct += int(np.count_nonzero(np.argmax(this_pred, axis=1) == np.asarray(D[batch])))
+
+        return num_correct, num_total, num_correct/num_total
+
     def predict(self, queries, docs, silent_mode=True):
         """Predcits the similarity between a query-document pair
         based on the trained DRMM TKS model
@@ -700,26 +1055,14 @@ class MatchPyramid(utils.SaveLoad):
          [0.99258184]
          [0.9960481 ]]
         """
-        long_query_len = []
-        long_doc_len = []
-        long_query_list = []
-        long_doc_list = []
-        for query, doc in zip(queries, docs):
-            for d in doc:
-                long_query_list.append(query)
-                long_query_len.append(len(query))
-                long_doc_list.append(d)
-                long_doc_len.append(len(d))
-
-        indexed_long_query_list = self._translate_user_data(long_query_list)
-        indexed_long_doc_list = self._translate_user_data(long_doc_list)
-
-        predictions = self.model.predict(x={'query': indexed_long_query_list, 'doc': indexed_long_doc_list,
-            'dpool_index': DynamicMaxPooling.dynamic_pooling_index(long_query_len, long_doc_len, self.text_maxlen, self.text_maxlen)})
+        queries, docs = list(queries), list(docs)
+        x, _ = self._translate_groups(queries, docs)
+        predictions = self._predict(x)
 
         if not silent_mode:
             logger.info("Predictions in the format query, doc, similarity")
-            for i, (q, d) in enumerate(zip(long_query_list, long_doc_list)):
+            pairs = ((q, d) for q, doc in zip(queries, docs) for d in doc)
+            for i, (q, d) in enumerate(pairs):
                 logger.info("%s\t%s\t%s", str(q), str(d), str(predictions[i][0]))
 
         return predictions
@@ -736,34 +1079,7 @@ class MatchPyramid(utils.SaveLoad):
 
         """
         batch_size=20
-        num_correct = 0
-        num_total = 0
-        x1_batch, x2_batch, dupl_batch = [], [], []
-        test_X, test_Y = [], []
-        x1_len, x2_len = [], []
-        for x1, x2, d in zip(X1, X2, D):
-            x1_batch.append(self._make_indexed(x1))
-            x2_batch.append(self._make_indexed(x2))
-            x1_len.append(len(x1))
-            x2_len.append(len(x2))
-            dupl_batch.append(to_categorical(d, 2))
-
-            if len(x1_batch) % batch_size == 0:
-                test_X.append({'query': np.array(x1_batch), 'doc': np.array(x2_batch),
-                    'dpool_index': DynamicMaxPooling.dynamic_pooling_index(x1_len, x2_len, self.text_maxlen, self.text_maxlen)})
-                test_Y.append(np.squeeze(np.array(dupl_batch)))
-
-                for tx, ty in zip(test_X, test_Y):
-                    this_pred = self.model.predict(tx)
-                    for pred_val, true_val in zip(this_pred, ty):
-                        if np.argmax(pred_val) == np.argmax(true_val):
-                            num_correct += 1
-                        num_total += 1
-
-                x1_batch, x2_batch, dupl_batch, x1_len, x2_len = [], [], [], [], []
-                test_X, test_Y = [], []
-
-        return num_correct, num_total, num_correct/num_total
+        return self._evaluate_accuracy(X1, X2, D, batch_size)
 
     def evaluate_inference(self, X1, X2, D, batch_size=20):
         """Evaluate an inference model and return the accuracy
@@ -776,34 +1092,32 @@ class MatchPyramid(utils.SaveLoad):
             the inference label of xi, xj
 
         """
-        num_correct = 0
-        num_total = 0
-        x1_batch, x2_batch, dupl_batch = [], [], []
-        test_X, test_Y = [], []
-        x1_len, x2_len = [], []
-        for x1, x2, d in zip(X1, X2, D):
-            x1_batch.append(self._make_indexed(x1))
-            x2_batch.append(self._make_indexed(x2))
-            x1_len.append(len(x1))
-            x2_len.append(len(x2))
-            dupl_batch.append(to_categorical(d, self.num_inferences))
-
-            if len(x1_batch) % batch_size == 0:
-                test_X.append({'query': np.array(x1_batch), 'doc': np.array(x2_batch),
-                    'dpool_index': DynamicMaxPooling.dynamic_pooling_index(x1_len, x2_len, self.text_maxlen, self.text_maxlen)})
-                test_Y.append(np.squeeze(np.array(dupl_batch)))
-
-                for tx, ty in zip(test_X, test_Y):
-                    this_pred = self.model.predict(tx)
-                    for pred_val, true_val in zip(this_pred, ty):
-                        if np.argmax(pred_val) == np.argmax(true_val):
-                            num_correct += 1
-                        num_total += 1
-
-                x1_batch, x2_batch, dupl_batch, x1_len, x2_len = [], [], [], [], []
-
-                test_X, test_Y = [], []
-        return num_correct, num_total, num_correct/num_total
+        return self._evaluate_accuracy(X1, X2, D, batch_size)
+
+    def score_groups(self, queries, doc_groups, batch_size=DEFAULT_SCORE_BATCH_SIZE):
+        """Scores queries with their groups of candidate docs, many groups per prediction,
+        like for writing a TREC run with :func:`~sl_eval.models.utils.trec_utils.write_run`
+
+        Parameters
+        ----------
+        queries : iterable of list of str
+        doc_groups : iterable of list of list of str
+            The candidate docs of each query
+        batch_size : int, optional
+            The number of (query, doc) pairs translated and predicted at once.
+            See :func:`~sl_eval.models.utils.trec_utils.iter_group_batches`
+
+        Returns
+        -------
+        list of numpy arrays of float
+            The score of each doc of each query, in their order
+        """
+        scores = []
+        for batch_queries, batch_doc_groups in iter_group_batches(queries, doc_groups, batch_size):
+            x, doc_lens = self._translate_groups(batch_queries, batch_doc_groups)
+            predictions = self._predict(x)
+            scores.extend(np.split(predictions[:, 0], np.cumsum(doc_lens)[:-1]))
+        return scores
 
     def evaluate(self, queries, docs, labels):
         """Evaluates the model and provides the results in terms of metrics (MAP, nDCG)
@@ -818,29 +1132,10 @@ class MatchPyramid(utils.SaveLoad):
         labels : list of list of int
             The relevance of the document to the query. 1 = relevant, 0 = not relevant
         """
-        long_query_list = []
-        long_query_len = []
-
-        long_doc_list = []
-        long_doc_len = []
-
-        long_label_list = []
-        doc_lens = []
-
-        for query, doc, label in zip(queries, docs, labels):
-            for d, l in zip(doc, label):
-                long_query_list.append(query)
-                long_query_len.append(len(query))
-                long_doc_list.append(d)
-                long_doc_len.append(len(d))
-                long_label_list.append(l)
-            doc_lens.append(len(doc))
-
-        indexed_long_query_list = self._translate_user_data(long_query_list)
-        indexed_long_doc_list = self._translate_user_data(long_doc_list)
-
-        predictions = self.model.predict(x={'query': indexed_long_query_list, 'doc': indexed_long_doc_list,
-            'dpool_index': DynamicMaxPooling.dynamic_pooling_index(long_query_len, long_doc_len, self.text_maxlen, self.text_maxlen)})
+        queries, docs, labels = list(queries), list(docs), list(labels)
+        x, doc_lens = self._translate_groups(queries, docs)
+        long_label_list = [l for label in labels for l in label]
+        predictions = self._predict(x)
         Y_pred = []
         Y_true = []
         offset = 0
@@ -874,9 +1169,12 @@ class MatchPyramid(utils.SaveLoad):
         """
         # don't save the keras model as it needs to be saved with a keras function
         # Also, we can't save iterable properties. So, ignore them.
-        kwargs['ignore'] = kwargs.get(
-                            'ignore', ['model', '_get_pair_list', '_get_full_batch_iter',
-                                        'queries', 'docs', 'labels', 'pair_list'])
+        ignore = ['model', '_get_pair_list', '_get_full_batch_iter', 'queries', 'docs', 'labels', 'pair_list',
+                  'embedding_store', 'indexed_corpus', '_corpus_source', '_doc_scores']
+        if getattr(self, 'trim_vocab', False):
+            # Saving the full word embeddings would undo the point of trimming the vocab
+            ignore += ['word_embedding', 'inference_corpora']
+        kwargs['ignore'] = kwargs.get('ignore', ignore)
         kwargs['fname_or_handle'] = fname
         super(MatchPyramid, self).save(*args, **kwargs)
         self.model.save(fname + ".keras")
@@ -890,6 +1188,9 @@ class MatchPyramid(utils.SaveLoad):
         ----------
         fname : str
             Path to the saved file.
+        mmap : {None, 'r'}, optional
+            If 'r', the arrays saved separately, like the ones of the vocab and the embedding matrix,
+            are memory mapped instead of read into memory.
 
         Returns
         -------
@@ -906,9 +1207,9 @@ class MatchPyramid(utils.SaveLoad):
         fname = args[0]
         gensim_model = super(MatchPyramid, cls).load(*args, **kwargs)
         keras_model = load_model(
-            fname + '.keras', custom_objects={'rank_hinge_loss': rank_hinge_loss, 'DynamicMaxPooling': DynamicMaxPooling})
+            fname + '.keras', custom_objects={'rank_hinge_loss': rank_hinge_loss, 'LengthDynamicMaxPooling': LengthDynamicMaxPooling})
         gensim_model.model = keras_model
-        gensim_model._get_pair_list = _get_pair_list
+        gensim_model._get_pair_list = get_triplets
         gensim_model._get_full_batch_iter = _get_full_batch_iter
         return gensim_model
 
@@ -932,24 +1233,36 @@ class MatchPyramid(utils.SaveLoad):
 
         """
 
-        query = Input(name='query', shape=(self.text_maxlen,))
-        doc = Input(name='doc', shape=(self.text_maxlen,))
+        # With length_buckets, the sentences are as long as the bucket of their batch
+        seq_len = None if getattr(self, 'length_buckets', None) is not None else self.text_maxlen
+        query = Input(name='query', shape=(seq_len,), dtype='int32')
+        doc = Input(name='doc', shape=(seq_len,), dtype='int32')
 
-        dpool_index = Input(name='dpool_index', shape=[self.text_maxlen, self.text_maxlen, 3], dtype='int32')
+        # The lengths of the unpadded sentences, which the dynamic pooling stretches them from
+        query_len = Input(name='query_len', shape=(1,), dtype='int32')
+        doc_len = Input(name='doc_len', shape=(1,), dtype='int32')
 
-        embedding = Embedding(self.embedding_matrix.shape[0], self.embedding_matrix.shape[1], weights=[self.embedding_matrix],
-            trainable = embed_trainable)
+        if self.embedding_store is not None:
+            embedding = self.embedding_store.get_embedding_layer()
+        else:
+            embedding = Embedding(self.embedding_matrix.shape[0], self.embedding_matrix.shape[1], weights=[self.embedding_matrix],
+                trainable = embed_trainable, name='word_embedding')
         q_embed = embedding(query)
         d_embed = embedding(doc)
 
         cross = Dot(axes=[2, 2], normalize=False)([q_embed, d_embed])
-        cross_reshape = Reshape((self.text_maxlen, self.text_maxlen, 1))(cross)
+        if seq_len is None:
+            cross_reshape = Lambda(lambda x: K.expand_dims(x, -1))(cross)
+        else:
+            cross_reshape = Reshape((self.text_maxlen, self.text_maxlen, 1))(cross)
 
         conv2d = Conv2D(kernel_count, kernel_size, padding='same', activation='relu')
-        dpool = DynamicMaxPooling(dpool_size[0], dpool_size[1])
+        # The sentences are stretched over a text_maxlen grid whatever their padding
+        dpool = LengthDynamicMaxPooling(dpool_size[0], dpool_size[1], grid_size1=self.text_maxlen,
+                                        grid_size2=self.text_maxlen)
 
         conv1 = conv2d(cross_reshape)
-        pool1 = dpool([conv1, dpool_index])
+        pool1 = dpool([conv1, query_len, doc_len])
         pool1_flat = Flatten()(pool1)
         pool1_flat_drop = Dropout(rate=dropout_rate)(pool1_flat)
 
@@ -966,6 +1279,6 @@ class MatchPyramid(utils.SaveLoad):
             out_ = Dense(64, activation='relu')(out_)
             out_ = Dense(self.num_inferences, activation='softmax')(pool1_flat_drop)
 
-        model = Model(inputs=[query, doc, dpool_index], outputs=out_)
+        model = Model(inputs=[query, doc, query_len, doc_len], outputs=out_)
         return model
 
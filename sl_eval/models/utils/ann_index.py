@@ -0,0 +1,312 @@
+"""Script where the nearest neighbour indexes of sentence vectors are kept, for fetching the candidate docs
+of a query from a whole collection before a model re-ranks them.
+
+All the indexes rank docs by the cosine similarity of their vectors with the query vector, so the vectors
+are l2 normalized when they are added. They share the same methods:
+- fit(vectors) : indexes the vectors of the docs, whose ids are their rows
+- search(queries, n_results) : gets the ids and the similarities of the `n_results` nearest docs of each query
+
+Indexes
+-------
+- 'exact' : :class:`ExactIndex`, compares each query with every doc. The reference the others are measured against
+- 'ivf' : :class:`IVFIndex`, an inverted file. The docs are clustered with spherical k-means and a query
+  is only compared with the docs of its `n_probe` nearest clusters
+- 'lsh' : :class:`LSHIndex`, random projection locality sensitive hashing. A query is only compared with
+  the docs which fall in the same bucket as it in at least one of `n_tables` hash tables
+"""
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Keeps zero vectors at zero when they are normalized
+NORM_EPSILON = 1e-12
+
+# The number of queries compared with all the docs at once by the exact index
+DEFAULT_SEARCH_BATCH_SIZE = 256
+
+
+def normalize_vectors(vectors):
+    """Gets a float32 copy of the vectors with their rows l2 normalized"""
+    vectors = np.array(vectors, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), NORM_EPSILON)
+    return vectors
+
+
+def _top_n(scores, n_results):
+    """Gets the indices of the `n_results` largest scores of each row, in decreasing order of score"""
+    n_results = min(n_results, scores.shape[-1])
+    if 0 < n_results < scores.shape[-1]:
+        top = np.argpartition(-scores, n_results - 1, axis=-1)[..., :n_results]
+    else:
+        top = np.broadcast_to(np.arange(scores.shape[-1]), scores.shape)[..., :n_results]
+    top_scores = np.take_along_axis(scores, top, axis=-1)
+    return np.take_along_axis(top, np.argsort(-top_scores, axis=-1, kind='stable'), axis=-1)
+
+
+def _empty_results(n_queries, n_results):
+    """Results with no doc, whose ids are -1 and similarities -inf"""
+    return (np.full((n_queries, n_results), -1, dtype=np.int64),
+            np.full((n_queries, n_results), -np.inf, dtype=np.float32))
+
+
+def _search_candidates(vectors, query, candidates, n_results):
+    """Compares a normalized query with the docs of the `candidates` rows only
+
+    Returns
+    -------
+    ids : numpy array of int64
+    similarities : numpy array of float32
+        Of at most `n_results` docs, in decreasing order of similarity
+    """
+    scores = np.dot(vectors[candidates], query)
+    top = _top_n(scores, n_results)
+    return candidates[top], scores[top]
+
+
+class ExactIndex:
+    """Compares each query with every doc, with one matrix product per batch of queries"""
+
+    def __init__(self, batch_size=DEFAULT_SEARCH_BATCH_SIZE):
+        """
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of queries compared with the docs at once
+        """
+        self.batch_size = batch_size
+        self.vectors = None
+
+    def fit(self, vectors):
+        """Indexes the vectors of the docs
+
+        Parameters
+        ----------
+        vectors : numpy array of shape (n_docs, vector_size)
+        """
+        self.vectors = normalize_vectors(vectors)
+        return self
+
+    def search(self, queries, n_results):
+        """Gets the nearest docs of each query
+
+        Parameters
+        ----------
+        queries : numpy array of shape (n_queries, vector_size)
+        n_results : int
+
+        Returns
+        -------
+        ids : numpy array of int64 of shape (n_queries, n_results)
+            The ids of the docs, in decreasing order of similarity. -1 past the number of docs
+        similarities : numpy array of float32 of shape (n_queries, n_results)
+            -inf past the number of docs
+        """
+        queries = normalize_vectors(queries)
+        ids, similarities = _empty_results(len(queries), n_results)
+        n_found = min(n_results, len(self.vectors))
+        for start in range(0, len(queries), self.batch_size):
+            scores = np.dot(queries[start: start + self.batch_size], self.vectors.T)
+            top = _top_n(scores, n_found)
+            ids[start: start + self.batch_size, :n_found] = top
+            similarities[start: start + self.batch_size, :n_found] = np.take_along_axis(scores, top, axis=1)
+        return ids, similarities
+
+
+class IVFIndex:
+    """Inverted file index. The docs are clustered with spherical k-means and stored cluster by cluster,
+    and a query is only compared with the docs of its `n_probe` nearest clusters.
+
+    The more clusters are probed, the better the recall and the slower the search. Sentence vectors fall in
+    clusters of topics and the defaults find nearly all the exact nearest docs of such vectors, but on vectors
+    with no clusters, like random ones, they only find around half of them. Probing all the clusters gives
+    the results of :class:`ExactIndex`.
+    """
+
+    def __init__(self, n_lists=256, n_probe=32, n_iter=10, n_train=65536, seed=0):
+        """
+        Parameters
+        ----------
+        n_lists : int, optional
+            The number of clusters. Around the square root of the number of docs works well
+        n_probe : int, optional
+            The number of clusters a query is compared with
+        n_iter : int, optional
+            The number of k-means iterations
+        n_train : int, optional
+            The largest number of docs the clusters are learned from, sampled at random
+        seed : int, optional
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.n_train = n_train
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.list_offsets = None
+
+    def _assign(self, vectors, batch_size=DEFAULT_SEARCH_BATCH_SIZE * 16):
+        """Gets the nearest centroid of each vector"""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            assignments[start: start + batch_size] = np.argmax(
+                np.dot(vectors[start: start + batch_size], self.centroids.T), axis=1)
+        return assignments
+
+    def _train_centroids(self, vectors):
+        random_state = np.random.RandomState(self.seed)
+        if len(vectors) > self.n_train:
+            vectors = vectors[random_state.choice(len(vectors), self.n_train, replace=False)]
+        n_lists = min(self.n_lists, len(vectors))
+        self.centroids = vectors[random_state.choice(len(vectors), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignments = self._assign(vectors)
+            order = np.argsort(assignments, kind='stable')
+            counts = np.bincount(assignments, minlength=n_lists)
+            # Clusters which lost all their docs keep their centroid
+            has_docs = counts > 0
+            starts = np.concatenate([[0], np.cumsum(counts[has_docs])[:-1]])
+            self.centroids[has_docs] = normalize_vectors(np.add.reduceat(vectors[order], starts, axis=0))
+
+    def fit(self, vectors):
+        """Learns the clusters and indexes the vectors of the docs
+
+        Parameters
+        ----------
+        vectors : numpy array of shape (n_docs, vector_size)
+        """
+        vectors = normalize_vectors(vectors)
+        self._train_centroids(vectors)
+        assignments = self._assign(vectors)
+        self.ids = np.argsort(assignments, kind='stable')
+        self.vectors = vectors[self.ids]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))])
+        logger.info("Indexed %d docs in %d lists of at most %d docs", len(vectors), len(self.centroids),
+                    np.max(np.diff(self.list_offsets)))
+        return self
+
+    def search(self, queries, n_results):
+        """Gets the nearest docs of each query among the docs of its `n_probe` nearest clusters
+
+        Parameters
+        ----------
+        queries : numpy array of shape (n_queries, vector_size)
+        n_results : int
+
+        Returns
+        -------
+        ids : numpy array of int64 of shape (n_queries, n_results)
+            The ids of the docs, in decreasing order of similarity. -1 past the number of docs found
+        similarities : numpy array of float32 of shape (n_queries, n_results)
+            -inf past the number of docs found
+        """
+        queries = normalize_vectors(queries)
+        ids, similarities = _empty_results(len(queries), n_results)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probed_lists = _top_n(np.dot(queries, self.centroids.T), n_probe)
+        for i, (query, lists) in enumerate(zip(queries, probed_lists)):
+            candidates = np.concatenate([np.arange(self.list_offsets[l], self.list_offsets[l + 1]) for l in lists])
+            rows, scores = _search_candidates(self.vectors, query, candidates, n_results)
+            ids[i, :len(rows)], similarities[i, :len(rows)] = self.ids[rows], scores
+        return ids, similarities
+
+
+class LSHIndex:
+    """Random projection locality sensitive hashing. In each of `n_tables` hash tables, a doc falls in the bucket
+    of the signs of its projections on `n_bits` random directions. A query is only compared with the docs
+    which share its bucket in at least one table.
+
+    More bits give smaller buckets and a faster but less complete search; more tables make up for it.
+    Its recall is lower than the one of :class:`IVFIndex` for the same search time, most of all on vectors
+    with no clusters.
+    """
+
+    def __init__(self, n_bits=8, n_tables=16, seed=0):
+        """
+        Parameters
+        ----------
+        n_bits : int, optional
+            The number of random directions of a table. At most 63
+        n_tables : int, optional
+        seed : int, optional
+        """
+        if not 0 < n_bits < 64:
+            raise ValueError("Unkown number of bits %d. It must be between 1 and 63" % n_bits)
+        self.n_bits = n_bits
+        self.n_tables = n_tables
+        self.seed = seed
+        self.planes = None
+        self.vectors = None
+        self.sorted_codes = None
+        self.sorted_ids = None
+
+    def _hash(self, vectors):
+        """Gets the bucket of each vector in each table, of shape (n_tables, n_vectors)"""
+        bits = np.einsum('nd,tdb->tnb', vectors, self.planes) > 0
+        return np.dot(bits, np.left_shift(1, np.arange(self.n_bits, dtype=np.int64)))
+
+    def fit(self, vectors):
+        """Indexes the vectors of the docs
+
+        Parameters
+        ----------
+        vectors : numpy array of shape (n_docs, vector_size)
+        """
+        self.vectors = normalize_vectors(vectors)
+        self.planes = np.random.RandomState(self.seed).randn(
+            self.n_tables, self.vectors.shape[1], self.n_bits).astype(np.float32)
+        codes = self._hash(self.vectors)
+        self.sorted_ids = np.argsort(codes, axis=1, kind='stable')
+        self.sorted_codes = np.take_along_axis(codes, self.sorted_ids, axis=1)
+        return self
+
+    def search(self, queries, n_results):
+        """Gets the nearest docs of each query among the docs which share one of its buckets
+
+        Parameters
+        ----------
+        queries : numpy array of shape (n_queries, vector_size)
+        n_results : int
+
+        Returns
+        -------
+        ids : numpy array of int64 of shape (n_queries, n_results)
+            The ids of the docs, in decreasing order of similarity. -1 past the number of docs found
+        similarities : numpy array of float32 of shape (n_queries, n_results)
+            -inf past the number of docs found
+        """
+        queries = normalize_vectors(queries)
+        ids, similarities = _empty_results(len(queries), n_results)
+        query_codes = self._hash(queries)
+        starts = np.stack([np.searchsorted(self.sorted_codes[t], query_codes[t], side='left')
+                           for t in range(self.n_tables)])
+        ends = np.stack([np.searchsorted(self.sorted_codes[t], query_codes[t], side='right')
+                         for t in range(self.n_tables)])
+        for i, query in enumerate(queries):
+            candidates = np.unique(np.concatenate([self.sorted_ids[t, starts[t, i]: ends[t, i]]
+                                                   for t in range(self.n_tables)]))
+            if len(candidates) == 0:
+                continue
+            found, scores = _search_candidates(self.vectors, query, candidates, n_results)
+            ids[i, :len(found)], similarities[i, :len(found)] = found, scores
+        return ids, similarities
+
+
+ANN_INDEXES = {'exact': ExactIndex, 'ivf': IVFIndex, 'lsh': LSHIndex}
+
+
+def get_ann_index(index_type, **kwargs):
+    """Gets a new index of the given type
+
+    Parameters
+    ----------
+    index_type : {'exact', 'ivf', 'lsh'}
+    kwargs : dict
+        Passed on to the class of the index
+    """
+    if index_type not in ANN_INDEXES:
+        raise ValueError("Unkown index_type %s. It must be one of %s" % (index_type, list(ANN_INDEXES)))
+    return ANN_INDEXES[index_type](**kwargs)
@@ -0,0 +1,122 @@
+"""Script where the keras Sequences the models are trained on with several workers are kept.
+
+A Sequence gives a batch from its index, so unlike with a Python generator keras can make several
+batches at once in worker processes with `fit_generator(workers=N, use_multiprocessing=True)`.
+The batches are picked here as sentence indices of an :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+and turned into the inputs of a model by the `make_batch` function it gives. `make_batch` and its keyword
+arguments are sent to the worker processes, so it has to be a module level function and they have to be
+arrays or other picklable objects, never the model itself.
+"""
+
+import numpy as np
+from keras.utils import Sequence
+from keras.utils.np_utils import to_categorical
+
+from .corpus import interleave_pairs
+
+
+class TripletSequence(Sequence):
+    """Batches of `batch_size` (query, relevant doc, irrelevant doc) triplets, for the 'ranking' target_mode
+
+    Each epoch goes over the triplets in a permutation drawn from a `RandomState` seeded with (`seed`, epoch),
+    so the batches of an epoch are the same whichever worker makes them and in whichever order.
+    The triplets which don't fill the last batch of an epoch are left out of it.
+
+    Whether and when `fit_generator` calls `Sequence.on_epoch_end` depends on the keras version, so the sequence
+    doesn't count its epochs itself. The model moves it to the next epoch with :meth:`set_epoch` from a
+    `LambdaCallback` it passes to `fit_generator`.
+
+    Parameters
+    ----------
+    triplets : tuple of numpy arrays or function
+        See :func:`~sl_eval.models.utils.corpus.get_triplets`. Or a function which draws new triplets from a
+        `RandomState` each epoch, like a partial of :func:`~sl_eval.models.utils.corpus.sample_triplets`
+    batch_size : int
+        The number of triplets in a batch. A batch has twice as many pairs
+    make_batch : function
+        Called as make_batch(X1, X2, y, **batch_kwargs) with the arrays of
+        :func:`~sl_eval.models.utils.corpus.interleave_pairs`, it returns the (inputs, targets) of the model
+    seed : int, optional
+        If None, the triplets are kept in their order
+    batch_kwargs : dict
+        Passed on to `make_batch`
+    """
+    def __init__(self, triplets, batch_size, make_batch, seed=None, **batch_kwargs):
+        self.draw_triplets = triplets if callable(triplets) else None
+        if self.draw_triplets is None:
+            self.query_idx, self.pos_idx, self.neg_idx = triplets
+        self.batch_size = batch_size
+        self.make_batch = make_batch
+        self.batch_kwargs = batch_kwargs
+        self.seed = seed
+        self.epoch = 0
+        self._set_order()
+
+    def _set_order(self):
+        if self.draw_triplets is not None:
+            random_state = np.random.RandomState([self.seed, self.epoch] if self.seed is not None else None)
+            self.query_idx, self.pos_idx, self.neg_idx = self.draw_triplets(random_state)
+        n_triplets = len(self.query_idx)
+        if n_triplets == 0:
+            raise ValueError("There are no (query, relevant doc, irrelevant doc) triplets in the train data")
+        if self.seed is None:
+            self.order = np.arange(n_triplets)
+        else:
+            self.order = np.random.RandomState([self.seed, self.epoch]).permutation(n_triplets)
+
+    def __len__(self):
+        return max(1, len(self.query_idx) // self.batch_size)
+
+    def __getitem__(self, index):
+        batch = self.order[index * self.batch_size: (index + 1) * self.batch_size]
+        X1, X2, y = interleave_pairs(self.query_idx[batch], self.pos_idx[batch], self.neg_idx[batch])
+        return self.make_batch(X1, X2, y, **self.batch_kwargs)
+
+    def set_epoch(self, epoch):
+        """Draws the order of the triplets of the given epoch, unless it is the current one
+
+        Parameters
+        ----------
+        epoch : int
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._set_order()
+
+
+class LabelledPairSequence(Sequence):
+    """Batches of the (query, doc) pairs of a corpus with a label each, in the order of the corpus,
+    for the 'classification' and 'inference' target_modes
+
+    Like the generators of the models, only full batches are made, unless the corpus is smaller than a batch.
+
+    Parameters
+    ----------
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+        A corpus with a single doc per query
+    batch_size : int
+    n_labels : int
+        The number of classes the labels are one hot encoded in
+    make_batch : function
+        Called as make_batch(X1, X2, y, **batch_kwargs) with the sentence indices of the queries,
+        of the docs and the one hot labels, it returns the (inputs, targets) of the model
+    batch_kwargs : dict
+        Passed on to `make_batch`
+    """
+    def __init__(self, corpus, batch_size, n_labels, make_batch, **batch_kwargs):
+        # The two sentences of a pair are the 'query' and 'doc' of its group
+        self.x1_indices = corpus.group_offsets[:-1]
+        self.labels = np.asarray(corpus.labels)
+        self.batch_size = batch_size
+        self.n_labels = n_labels
+        self.make_batch = make_batch
+        self.batch_kwargs = batch_kwargs
+
+    def __len__(self):
+        return max(1, len(self.x1_indices) // self.batch_size)
+
+    def __getitem__(self, index):
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        X1 = self.x1_indices[batch]
+        y = to_categorical(self.labels[batch], self.n_labels).astype(np.float32)
+        return self.make_batch(X1, X1 + 1, y, **self.batch_kwargs)
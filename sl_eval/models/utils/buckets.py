@@ -0,0 +1,123 @@
+"""Script where sentences are grouped by length, so a batch is padded to the widths of its bucket instead of text_maxlen.
+
+Most sentences are far shorter than text_maxlen, so models padding everything to it spend most of their
+interaction matrix on padding. With a model built with dynamic sentence lengths, each batch is padded
+to the smallest bucket width which holds the longest of its sentences.
+
+The width of a sentence only depends on its own length, never on the other sentences of its batch.
+"""
+
+import numpy as np
+
+
+def get_bucket_widths(lengths, length_buckets, text_maxlen):
+    """Gets the width each sentence is padded to: the smallest bucket width which holds it
+
+    Parameters
+    ----------
+    lengths : numpy array of int
+    length_buckets : list of int
+        The bucket widths. text_maxlen is always one of them and longer ones are ignored
+    text_maxlen : int
+        The length the sentences are clipped to
+
+    Returns
+    -------
+    numpy array of int64 of the shape of `lengths`
+    """
+    widths = np.append(np.asarray(length_buckets, dtype=np.int64), text_maxlen)
+    widths = np.unique(widths[(widths > 0) & (widths <= text_maxlen)])
+    return widths[np.searchsorted(widths, np.minimum(lengths, text_maxlen))]
+
+
+def group_by_widths(widths):
+    """Gets the rows of each distinct combination of widths
+
+    Parameters
+    ----------
+    widths : tuple of numpy array of int
+        The widths of each input of each row, like (query widths, doc widths)
+
+    Returns
+    -------
+    list of (tuple of int, numpy array of int64)
+        The widths of a bucket and its rows, in their order
+    """
+    keys, inverse = np.unique(np.stack(widths, axis=1), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind='mergesort')
+    splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+    return [(tuple(int(width) for width in key), rows) for key, rows in zip(keys, np.split(order, splits))]
+
+
+def iter_bucketed_batches(widths, batch_size, seed=None):
+    """Yields batches of examples of the same bucket, endlessly
+
+    Each epoch, the examples are shuffled in a permutation drawn from a `RandomState` seeded with `seed`,
+    grouped by bucket and cut into batches of at most `batch_size`, which are then yielded in a shuffled order.
+    No example is left out, so the last batch of a bucket can be smaller.
+
+    Parameters
+    ----------
+    widths : tuple of numpy array of int
+        The widths of each input of each example, see :func:`group_by_widths`
+    batch_size : int
+    seed : int, optional
+        If None, the examples and the batches are kept in their order
+
+    Yields
+    ------
+    bucket_widths : tuple of int
+    examples : numpy array of int64
+        The indices of the examples of the batch
+    """
+    n_examples = len(widths[0])
+    if n_examples == 0:
+        raise ValueError("There are no examples to make batches of")
+
+    random_state = np.random.RandomState(seed) if seed is not None else None
+    while True:
+        order = random_state.permutation(n_examples) if random_state is not None else np.arange(n_examples)
+        batches = []
+        for bucket_widths, rows in group_by_widths(tuple(width[order] for width in widths)):
+            examples = order[rows]
+            batches.extend((bucket_widths, examples[start: start + batch_size])
+                           for start in range(0, len(examples), batch_size))
+        if random_state is not None:
+            batches = [batches[i] for i in random_state.permutation(len(batches))]
+        for batch in batches:
+            yield batch
+
+
+def predict_bucketed(model, x, widths):
+    """Predicts translated inputs bucket by bucket, with each padded input cut to the width of its bucket
+
+    Parameters
+    ----------
+    model : :class:`keras.models.Model`
+        A model built with dynamic sentence lengths
+    x : dict of numpy arrays
+        The model inputs, one row per pair, with the sentences padded to text_maxlen
+    widths : dict of numpy arrays
+        The width of each row of the padded inputs, by input name
+
+    Returns
+    -------
+    numpy array
+        The predictions of the rows of `x`, in their order
+    """
+    names = list(widths)
+    n_rows = len(x[names[0]])
+    if n_rows == 0:
+        return model.predict(x=x)
+
+    predictions = None
+    for bucket_widths, rows in group_by_widths(tuple(widths[name] for name in names)):
+        batch = {name: value[rows] for name, value in x.items()}
+        for name, width in zip(names, bucket_widths):
+            batch[name] = batch[name][:, :width]
+        bucket_predictions = model.predict(x=batch)
+        if predictions is None:
+            predictions = np.empty((n_rows,) + bucket_predictions.shape[1:], dtype=bucket_predictions.dtype)
+        predictions[rows] = bucket_predictions
+    return predictions
@@ -0,0 +1,445 @@
+"""Script where the training data is counted and indexed in a single pass.
+
+The readers (like `WikiReaderIterable`) tokenize their whole file each time they are iterated over.
+The models used to go over them once to count the vocab and then once more per epoch to index the batches.
+:func:`build_indexed_corpus` goes over the queries, docs and labels once and
+- cuts the sentences into shards, which are counted and indexed against a vocab local to the shard,
+  in worker processes if asked to
+- merges the shard vocabs in order in the main process, so the words are in the order they are first met,
+  and translates the ids of each shard to the merged ones with a single numpy indexing
+
+The result is an :class:`IndexedCorpus`. The models translate it to their own word ids with
+:meth:`IndexedCorpus.remap` and make their batches from it without going through strings again.
+"""
+
+import logging
+import multiprocessing
+from collections import deque
+import numpy as np
+
+from .embeddings import INDEX_DTYPE
+from .vocab_cache import CorpusFingerprint
+
+logger = logging.getLogger(__name__)
+
+# The number of sentences counted and indexed at once by a worker
+DEFAULT_SHARD_SIZE = 2000
+
+# The number of preallocated buffers the train batches are written into in turn, see BatchBuffers
+N_BATCH_BUFFERS = 2
+
+
+class IndexedCorpus:
+    """The sentences of a corpus as word ids, in a CSR like layout
+
+    All the word ids are concatenated in `ids`, sentence `i` being `ids[offsets[i]: offsets[i + 1]]`.
+    The sentences are stored group after group. For 'ranking', a group is a query followed by its candidate docs.
+    Otherwise, it is a pair of sentences. The query of group `g` is the sentence `group_offsets[g]` and its docs
+    are the sentences up to `group_offsets[g + 1]`.
+
+    Parameters
+    ----------
+    words : list of str
+        The words the ids refer to, in the order they were first met. Only meaningful before :meth:`remap`
+    ids : numpy array of INDEX_DTYPE
+        The ids of the words of all the sentences
+    lengths : numpy array of int64
+        The number of words of each sentence
+    group_sizes : numpy array of int64
+        The number of docs of each group
+    labels : list
+        The labels of each group, as they were given
+    target_mode : {'ranking', 'classification', 'inference'}
+    """
+    def __init__(self, words, ids, lengths, group_sizes, labels, target_mode):
+        self.words = words
+        self.ids = ids
+        self.lengths = lengths
+        self.group_sizes = group_sizes
+        self.labels = labels
+        self.target_mode = target_mode
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.group_offsets = np.zeros(len(group_sizes) + 1, dtype=np.int64)
+        np.cumsum(group_sizes + 1, out=self.group_offsets[1:])
+
+    def __len__(self):
+        return len(self.group_sizes)
+
+    def remap(self, id_map):
+        """Returns a corpus with every id `i` replaced by `id_map[i]`
+
+        Parameters
+        ----------
+        id_map : numpy array of int
+            The new id of each of `words`
+        """
+        id_map = np.asarray(id_map, dtype=INDEX_DTYPE)
+        return IndexedCorpus(self.words, id_map[self.ids], self.lengths, self.group_sizes, self.labels,
+                             self.target_mode)
+
+    def pad_sentences(self, indices, text_maxlen, pad_word_index, out=None):
+        """Gathers sentences into a matrix where they are clipped or padded to `text_maxlen`
+
+        Parameters
+        ----------
+        indices : numpy array of int
+            The indices of the sentences
+        text_maxlen : int
+        pad_word_index : int
+        out : numpy array of shape (len(indices), text_maxlen), optional
+            A preallocated matrix to write the result into
+
+        Returns
+        -------
+        numpy array of shape (len(indices), text_maxlen)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = np.empty((len(indices), text_maxlen), dtype=self.ids.dtype)
+        out.fill(pad_word_index)
+
+        lengths = np.minimum(self.lengths[indices], text_maxlen)
+        n_tokens = int(lengths.sum())
+        rows = np.repeat(np.arange(len(indices)), lengths)
+        cols = np.arange(n_tokens) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        out[rows, cols] = self.ids[self.offsets[indices][rows] + cols]
+        return out
+
+
+def _index_shard(shard):
+    """Counts and indexes a shard of sentences against a vocab of its own
+
+    Parameters
+    ----------
+    shard : list of list of str
+
+    Returns
+    -------
+    words : list of str
+        The words of the shard in the order they are first met. `ids` refers to them
+    counts : numpy array of int64
+    ids : numpy array of INDEX_DTYPE
+    lengths : numpy array of int64
+    digest : str
+        The hexdigest of a :class:`~sl_eval.models.utils.vocab_cache.CorpusFingerprint` of the shard
+    """
+    local_index = {}
+    ids = []
+    lengths = np.empty(len(shard), dtype=np.int64)
+    fingerprint = CorpusFingerprint()
+    for i, sentence in enumerate(shard):
+        ids.extend(local_index.setdefault(word, len(local_index)) for word in sentence)
+        lengths[i] = len(sentence)
+        fingerprint.update(sentence)
+    ids = np.array(ids, dtype=INDEX_DTYPE)
+    counts = np.bincount(ids, minlength=len(local_index)).astype(np.int64)
+    return list(local_index), counts, ids, lengths, fingerprint.hexdigest()
+
+
+def build_indexed_corpus(queries, docs, labels, target_mode='ranking', n_workers=1, shard_size=DEFAULT_SHARD_SIZE):
+    """Counts the words of the training data and indexes it, going over it once
+
+    Parameters
+    ----------
+    queries : iterable list of list of str
+    docs : iterable list of list of list of str for 'ranking', iterable list of list of str otherwise
+    labels : iterable list
+    target_mode : {'ranking', 'classification', 'inference'}, optional
+    n_workers : int, optional
+        The number of processes the shards are counted and indexed in. If 1, it is all done in this process
+    shard_size : int, optional
+        The minimum number of sentences in a shard. The fingerprint depends on it
+
+    Returns
+    -------
+    corpus : :class:`IndexedCorpus`
+        The ids are the positions of the words in `corpus.words`
+    counts : numpy array of int64
+        The count of each of `corpus.words`
+    corpus_fingerprint : :class:`~sl_eval.models.utils.vocab_cache.CorpusFingerprint`
+        A fingerprint of the sentences, which can be updated further
+    """
+    group_sizes, group_labels = [], []
+
+    def iter_shards():
+        shard = []
+        for q, doc, label in zip(queries, docs, labels):
+            doc = doc if target_mode == 'ranking' else [doc]
+            shard.append(q)
+            shard.extend(doc)
+            group_sizes.append(len(doc))
+            group_labels.append(label)
+            if len(shard) >= shard_size:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+
+    word_ids = {}
+    counts = np.zeros(0, dtype=np.int64)
+    id_parts, length_parts = [], []
+    corpus_fingerprint = CorpusFingerprint()
+
+    def merge(result):
+        nonlocal counts
+        words, shard_counts, ids, lengths, digest = result
+        id_map = np.fromiter((word_ids.setdefault(word, len(word_ids)) for word in words),
+                             dtype=INDEX_DTYPE, count=len(words))
+        if len(word_ids) > len(counts):
+            counts = np.concatenate([counts, np.zeros(len(word_ids) - len(counts), dtype=np.int64)])
+        # The ids of a shard are unique, so there are no repeated indices here
+        counts[id_map] += shard_counts
+        id_parts.append(id_map[ids])
+        length_parts.append(lengths)
+        corpus_fingerprint.update([digest])
+
+    if n_workers > 1:
+        logger.info("Counting and indexing the corpus in %d processes", n_workers)
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            # Only a few shards are queued at a time so that the whole corpus is never held in memory as str
+            pending = deque()
+            for shard in iter_shards():
+                pending.append(pool.apply_async(_index_shard, (shard,)))
+                if len(pending) > 2 * n_workers:
+                    merge(pending.popleft().get())
+            while pending:
+                merge(pending.popleft().get())
+        finally:
+            pool.terminate()
+    else:
+        for shard in iter_shards():
+            merge(_index_shard(shard))
+
+    corpus = IndexedCorpus(
+        list(word_ids),
+        np.concatenate(id_parts) if id_parts else np.zeros(0, dtype=INDEX_DTYPE),
+        np.concatenate(length_parts) if length_parts else np.zeros(0, dtype=np.int64),
+        np.array(group_sizes, dtype=np.int64), group_labels, target_mode
+    )
+    logger.info("Indexed %d groups with %d sentences and %d distinct words", len(corpus), len(corpus.lengths),
+                len(corpus.words))
+    return corpus, counts, corpus_fingerprint
+
+
+def get_triplets(corpus):
+    """Gets every (query, relevant doc, irrelevant doc) triplet of a 'ranking' corpus at once
+
+    The triplets of a query are made of each of its docs with the label 1 paired with each of its docs
+    with the label 0, in the order of the docs.
+
+    Parameters
+    ----------
+    corpus : :class:`IndexedCorpus`
+
+    Returns
+    -------
+    query_idx, pos_idx, neg_idx : numpy arrays of INDEX_DTYPE
+        The sentence indices in `corpus` of the query, the relevant doc and the irrelevant doc of each triplet
+
+    Example
+    -------
+    For a corpus where the query 0 has the docs 1, 2, 3 with the labels [0, 1, 0] and the query 4
+    has the docs 5, 6 with the labels [1, 0]
+
+    (array([0, 0, 4]), array([2, 2, 5]), array([1, 3, 6]))
+    """
+    triplet_groups, pos_docs, neg_docs, _ = _enumerate_triplets(corpus)
+    query_idx = corpus.group_offsets[triplet_groups].astype(INDEX_DTYPE)
+    logger.info("There are %d triplets in the train data", len(query_idx))
+    return query_idx, pos_docs.astype(INDEX_DTYPE), neg_docs.astype(INDEX_DTYPE)
+
+
+def get_doc_pairs(corpus):
+    """Gets the (query, doc) pair of each doc of a corpus, in the order of the docs
+
+    Parameters
+    ----------
+    corpus : :class:`IndexedCorpus`
+
+    Returns
+    -------
+    query_idx, doc_idx : numpy arrays of int64
+        The sentence indices in `corpus` of the query and of the doc of each pair
+    """
+    # The query of a group is its first sentence and the others are its docs
+    query_idx = np.repeat(corpus.group_offsets[:-1], corpus.group_sizes)
+    doc_idx = np.delete(np.arange(len(corpus.lengths), dtype=np.int64), corpus.group_offsets[:-1])
+    return query_idx, doc_idx
+
+
+def _enumerate_triplets(corpus):
+    """Pairs each relevant doc of a 'ranking' corpus with each irrelevant doc of its group
+
+    Returns
+    -------
+    triplet_groups, pos_docs, neg_docs, pos_of_triplet : numpy arrays of int
+        The group, relevant doc and irrelevant doc of each triplet, and the index of its relevant doc
+        among all the relevant docs. The triplets of a relevant doc are contiguous
+    """
+    n_groups = len(corpus)
+    group_of_doc = np.repeat(np.arange(n_groups), corpus.group_sizes)
+    doc_indices = np.delete(np.arange(len(corpus.lengths)), corpus.group_offsets[:-1])
+    doc_labels = np.fromiter((l for label in corpus.labels for l in label), dtype=np.int64)
+    if len(doc_labels) != len(doc_indices):
+        raise ValueError("There are %d labels for %d docs" % (len(doc_labels), len(doc_indices)))
+
+    is_pos, is_neg = doc_labels == 1, doc_labels == 0
+    pos_docs, pos_groups = doc_indices[is_pos], group_of_doc[is_pos]
+    neg_docs = doc_indices[is_neg]
+    n_neg = np.bincount(group_of_doc[is_neg], minlength=n_groups)
+    neg_starts = np.cumsum(n_neg) - n_neg
+
+    # Each relevant doc makes one triplet with each irrelevant doc of its group
+    n_triplets_of_pos = n_neg[pos_groups]
+    pos_of_triplet = np.repeat(np.arange(len(pos_docs)), n_triplets_of_pos)
+    neg_rank = np.arange(len(pos_of_triplet)) - np.repeat(np.cumsum(n_triplets_of_pos) - n_triplets_of_pos,
+                                                          n_triplets_of_pos)
+    triplet_groups = pos_groups[pos_of_triplet]
+    return (triplet_groups, pos_docs[pos_of_triplet], neg_docs[neg_starts[triplet_groups] + neg_rank],
+            pos_of_triplet)
+
+
+def sample_triplets(corpus, negatives_per_positive, random_state, doc_scores=None):
+    """Gets triplets where each relevant doc is paired with at most `negatives_per_positive` irrelevant docs of
+    its group, so there are linearly many triplets in the number of relevant docs instead of quadratically
+
+    Parameters
+    ----------
+    corpus : :class:`IndexedCorpus`
+    negatives_per_positive : int
+    random_state : :class:`numpy.random.RandomState`
+    doc_scores : numpy array of float of shape (len(corpus.lengths),), optional
+        The score the model gives each doc for its query, like cached predictions. If given, the irrelevant docs
+        with the highest scores are picked (hard negatives), with ties broken at random.
+        Otherwise they are picked uniformly at random
+
+    Returns
+    -------
+    query_idx, pos_idx, neg_idx : numpy arrays of INDEX_DTYPE
+        See :func:`get_triplets`. The triplets of a relevant doc are contiguous
+    """
+    if negatives_per_positive < 1:
+        raise ValueError("negatives_per_positive must be at least 1, not %s" % str(negatives_per_positive))
+    triplet_groups, pos_docs, neg_docs, pos_of_triplet = _enumerate_triplets(corpus)
+
+    # The triplets are sorted by relevant doc, then by the score of the irrelevant doc, then at random
+    keys = [random_state.random_sample(len(neg_docs))]
+    if doc_scores is not None:
+        keys.append(-np.asarray(doc_scores)[neg_docs])
+    keys.append(pos_of_triplet)
+    order = np.lexsort(keys)
+
+    # pos_of_triplet is sorted, so the ranks of the triplets of a relevant doc start at its first triplet
+    first_of_pos = np.searchsorted(pos_of_triplet, pos_of_triplet)
+    picked = order[(np.arange(len(order)) - first_of_pos) < negatives_per_positive]
+    query_idx = corpus.group_offsets[triplet_groups[picked]].astype(INDEX_DTYPE)
+    return query_idx, pos_docs[picked].astype(INDEX_DTYPE), neg_docs[picked].astype(INDEX_DTYPE)
+
+
+def interleave_pairs(query_idx, pos_idx, neg_idx):
+    """Turns triplets into query-doc pairs, the pair with the relevant doc followed by the one with the irrelevant doc
+
+    Parameters
+    ----------
+    query_idx, pos_idx, neg_idx : numpy arrays of int
+        See :func:`get_triplets`
+
+    Returns
+    -------
+    X1 : numpy array of shape (2 * len(query_idx),)
+        The sentence indices of the queries
+    X2 : numpy array of shape (2 * len(query_idx),)
+        The sentence indices of the docs
+    y : numpy array of float32 with {0, 1} of shape (2 * len(query_idx),)
+        1 : X2[i] is relevant to X1[i]
+        0 : X2[i] is not relevant to X1[i]
+    """
+    X1 = np.repeat(query_idx, 2)
+    X2 = np.stack([pos_idx, neg_idx], axis=1).ravel()
+    y = np.tile(np.array([1, 0], dtype=np.float32), len(query_idx))
+    return X1, X2, y
+
+
+def iter_pair_batches(triplets, batch_size, seed=None):
+    """Yields batches of the pairs of `batch_size` triplets, endlessly
+
+    The triplets go by in a new permutation each epoch, drawn from a `RandomState` seeded with `seed`.
+    The last triplets of an epoch which don't fill a batch start the next batch.
+
+    Parameters
+    ----------
+    triplets : tuple of numpy arrays or function
+        See :func:`get_triplets`. Or a function which draws new triplets from a `RandomState` each epoch,
+        like a partial of :func:`sample_triplets`
+    batch_size : int
+        The number of triplets in a batch
+    seed : int, optional
+        If None, the triplets are kept in their order
+
+    Yields
+    ------
+    X1, X2, y : numpy arrays of shape (2 * batch_size,)
+        See :func:`interleave_pairs`. The same arrays are overwritten with each batch, so they must be used
+        before the next one is taken
+    """
+    random_state = np.random.RandomState(seed) if seed is not None else None
+    draw_triplets = triplets if callable(triplets) else None
+    if draw_triplets is None and len(triplets[0]) == 0:
+        raise ValueError("There are no (query, relevant doc, irrelevant doc) triplets in the train data")
+
+    X1 = np.empty(2 * batch_size, dtype=INDEX_DTYPE)
+    X2 = np.empty(2 * batch_size, dtype=INDEX_DTYPE)
+    # The pairs alternate between relevant and irrelevant docs, so the labels are the same for every batch
+    y = np.tile(np.array([1, 0], dtype=np.float32), batch_size)
+
+    leftover = tuple(np.zeros(0, dtype=INDEX_DTYPE) for _ in range(3))
+    while True:
+        if draw_triplets is not None:
+            triplets = draw_triplets(random_state if random_state is not None else np.random.RandomState())
+            if len(triplets[0]) == 0:
+                raise ValueError("There are no (query, relevant doc, irrelevant doc) triplets in the train data")
+        n_triplets = len(triplets[0])
+        order = random_state.permutation(n_triplets) if random_state is not None else np.arange(n_triplets)
+        query_idx, pos_idx, neg_idx = (np.concatenate([left, idx[order]]) for left, idx in zip(leftover, triplets))
+        n_full = len(query_idx) - len(query_idx) % batch_size
+        for start in range(0, n_full, batch_size):
+            batch = slice(start, start + batch_size)
+            X1[0::2] = X1[1::2] = query_idx[batch]
+            X2[0::2] = pos_idx[batch]
+            X2[1::2] = neg_idx[batch]
+            yield X1, X2, y
+        leftover = (query_idx[n_full:], pos_idx[n_full:], neg_idx[n_full:])
+
+
+class BatchBuffers:
+    """Preallocated arrays which batches are written into in turn, instead of allocating new ones for each batch
+
+    Keras trains on a batch while the generator makes the next one, so a batch stays untouched until
+    `n_buffers - 1` more batches have been taken. The queue of batches `fit_generator` makes ahead,
+    `max_queue_size`, must thus be at most `n_buffers - 1` long.
+
+    Parameters
+    ----------
+    shapes : dict
+        The shape and dtype of each array of a batch, like {'query': ((40, 200), np.int32)}
+    n_buffers : int, optional
+
+    Example
+    -------
+    >>> buffers = BatchBuffers({'query': ((4, 10), np.int32)})
+    >>> batch = buffers.next()
+    >>> corpus.pad_sentences(X1, 10, pad_word_index, out=batch['query'])
+
+    """
+    def __init__(self, shapes, n_buffers=N_BATCH_BUFFERS):
+        self.buffers = [{name: np.empty(shape, dtype=dtype) for name, (shape, dtype) in shapes.items()}
+                        for _ in range(n_buffers)]
+        self._next_buffer = 0
+
+    def next(self):
+        """Returns the arrays of the least recently taken buffer"""
+        buffer = self.buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self.buffers)
+        return buffer
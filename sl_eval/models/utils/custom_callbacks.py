@@ -12,7 +12,7 @@ logging.basicConfig(
 
 class ValidationCallback(Callback):
     """Callback for providing validation metrics on the model trained so far"""
-    def __init__(self, test_data):
+    def __init__(self, test_data, predict_fn=None):
         """
         Parameters
         ----------
@@ -28,6 +28,9 @@ class ValidationCallback(Callback):
                 - "doc_lengths" : list of int
                     It contains the length of each document group. I.e., the number of queries
                     which represent one topic. It is needed for calculating the metrics.
+        predict_fn : function, optional
+            Called with no argument, it returns the predictions of the validation pairs. For models whose
+            inputs aren't only the "query" and "doc" of `test_data`, or which predict bucket by bucket.
 
         """
 
@@ -47,6 +50,7 @@ class ValidationCallback(Callback):
         except AttributeError:
             raise ValueError("test_data must be a dictionary with the keys: 'X1', 'X2', 'y', 'doc_lengths'")
         self.test_data = test_data
+        self.predict_fn = predict_fn
 
     def on_epoch_end(self, epoch, logs={}):
         # Import has to be here to prevent cyclic import
@@ -56,7 +60,10 @@ class ValidationCallback(Callback):
         y = self.test_data["y"]
         doc_lengths = self.test_data["doc_lengths"]
 
-        predictions = self.model.predict(x={"query": X1, "doc": X2})
+        if self.predict_fn is not None:
+            predictions = self.predict_fn()
+        else:
+            predictions = self.model.predict(x={"query": X1, "doc": X2})
 
         Y_pred = []
         Y_true = []
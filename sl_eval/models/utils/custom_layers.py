@@ -89,46 +89,109 @@ class DynamicMaxPooling(Layer):
 
     @staticmethod
     def dynamic_pooling_index(len1, len2, max_len1, max_len2,
-                              compress_ratio1 = 1, compress_ratio2 = 1):
-        def dpool_index_(batch_idx, len1_one, len2_one, max_len1, max_len2):
-            '''
-            TODO: Here is the check of sentences length to be positive.
-            To make sure that the lenght of the input sentences are positive. 
-            if len1_one == 0:
-                print("[Error:DynamicPooling] len1 = 0 at batch_idx = {}".format(batch_idx))
-                exit()
-            if len2_one == 0:
-                print("[Error:DynamicPooling] len2 = 0 at batch_idx = {}".format(batch_idx))
-                exit()
-            '''
-            if len1_one == 0:
-                stride1 = max_len1
-            else:
-                stride1 = 1.0 * max_len1 / len1_one
+                              compress_ratio1 = 1, compress_ratio2 = 1, out=None):
+        """Gets the indices the DynamicMaxPooling layer gathers the interaction matrix with
+
+        Each sentence is stretched over the whole pooled length: the position i of a sentence of length l
+        takes the row int(i / (max_len / l)). Empty sentences only take the row 0.
 
-            if len2_one == 0:
-                stride2 = max_len2
+        Parameters
+        ----------
+        len1, len2 : array like of int
+            The lengths of the sentences of each side of the batch
+        max_len1, max_len2 : int
+        compress_ratio1, compress_ratio2 : int, optional
+        out : numpy array of int32 of shape (len(len1), max_len1, max_len2, 3), optional
+            A preallocated array to write the result into
+
+        Returns
+        -------
+        numpy array of int32 of shape (len(len1), max_len1, max_len2, 3)
+            The [batch index, index in the first sentence, index in the second sentence] of each position
+        """
+        def positions(lens, compress_ratio, max_len):
+            if max_len % compress_ratio != 0:
+                cur_max_len = max_len // compress_ratio + 1
             else:
-                stride2 = 1.0 * max_len2 / len2_one
-
-            idx1_one = [int(i / stride1) for i in range(max_len1)]
-            idx2_one = [int(i / stride2) for i in range(max_len2)]
-            mesh1, mesh2 = np.meshgrid(idx1_one, idx2_one)
-            index_one = np.transpose(np.stack([np.ones(mesh1.shape) * batch_idx,
-                                      mesh1, mesh2]), (2,1,0))
-            return index_one
-        index = []
-        dpool_bias1 = dpool_bias2 = 0
-        if max_len1 % compress_ratio1 != 0:
-            dpool_bias1 = 1
-        if max_len2 % compress_ratio2 != 0:
-            dpool_bias2 = 1
-        cur_max_len1 = max_len1 // compress_ratio1 + dpool_bias1
-        cur_max_len2 = max_len2 // compress_ratio2 + dpool_bias2
-        for i in range(len(len1)):
-            index.append(dpool_index_(i, len1[i] // compress_ratio1, 
-                         len2[i] // compress_ratio2, cur_max_len1, cur_max_len2))
-        return np.array(index)
+                cur_max_len = max_len // compress_ratio
+            lens = np.asarray(lens, dtype=np.int64) // compress_ratio
+            stride = np.where(lens == 0, float(cur_max_len), cur_max_len / np.maximum(lens, 1))
+            return (np.arange(cur_max_len) / stride[:, None]).astype(np.int32)
+
+        idx1 = positions(len1, compress_ratio1, max_len1)
+        idx2 = positions(len2, compress_ratio2, max_len2)
+        shape = (len(idx1), idx1.shape[1], idx2.shape[1], 3)
+        if out is None:
+            out = np.empty(shape, dtype=np.int32)
+        elif out.shape != shape:
+            raise ValueError("out has the shape %s instead of %s" % (str(out.shape), str(shape)))
+        out[..., 0] = np.arange(len(idx1))[:, None, None]
+        out[..., 1] = idx1[:, :, None]
+        out[..., 2] = idx2[:, None, :]
+        return out
+
+    @staticmethod
+    def dynamic_pooling_index_tensor(len1, len2, max_len1, max_len2):
+        """Same as dynamic_pooling_index, in tensorflow ops, for pipelines and graphs
+
+        Parameters
+        ----------
+        len1, len2 : int tensor of shape (batch_size,)
+        max_len1, max_len2 : int
+
+        Returns
+        -------
+        int32 tensor of shape (batch_size, max_len1, max_len2, 3)
+        """
+        def positions(lens, max_len):
+            # In float64, so the positions are exactly those of dynamic_pooling_index
+            lens = K.tf.cast(lens, K.tf.float64)
+            stride = K.tf.where(K.tf.equal(lens, 0), K.tf.fill(K.tf.shape(lens), K.tf.constant(max_len, K.tf.float64)),
+                                max_len / K.tf.maximum(lens, 1))
+            return K.tf.cast(K.tf.range(max_len, dtype=K.tf.float64)[None, :] / stride[:, None], K.tf.int32)
+
+        idx1 = positions(len1, max_len1)
+        idx2 = positions(len2, max_len2)
+        batch_index = K.tf.range(K.tf.shape(idx1)[0])[:, None, None]
+        return K.tf.stack([K.tf.tile(batch_index, [1, max_len1, max_len2]),
+                           K.tf.tile(idx1[:, :, None], [1, 1, max_len2]),
+                           K.tf.tile(idx2[:, None, :], [1, max_len1, 1])], axis=-1)
+
+class LengthDynamicMaxPooling(DynamicMaxPooling):
+    """DynamicMaxPooling which derives its gather indices from the lengths of the two sentences in the graph,
+    with DynamicMaxPooling.dynamic_pooling_index_tensor, instead of taking them as an input made on the host
+
+    Its inputs are [x, len1, len2], x of shape (batch_size, msize1, msize2, channels) and the lengths of
+    shape (batch_size, 1). Lengths over the size of x are clipped to it.
+
+    If `grid_size1` and `grid_size2` are given, the sentences are stretched over a grid of that size
+    whatever the size of x, which can then vary from batch to batch. Only the first `len` rows of x are read,
+    so the output doesn't depend on how far x is padded past the lengths.
+    """
+    def __init__(self, psize1, psize2, grid_size1=None, grid_size2=None, **kwargs):
+        self.grid_size1 = grid_size1
+        self.grid_size2 = grid_size2
+        super(LengthDynamicMaxPooling, self).__init__(psize1, psize2, **kwargs)
+
+    def build(self, input_shape):
+        super(LengthDynamicMaxPooling, self).build(input_shape)
+        self.msize1 = self.grid_size1 or self.msize1
+        self.msize2 = self.grid_size2 or self.msize2
+
+    def get_config(self):
+        config = {
+            'grid_size1': self.grid_size1,
+            'grid_size2': self.grid_size2
+        }
+        base_config = super(LengthDynamicMaxPooling, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+    def call(self, data):
+        x, len1, len2 = data
+        len1 = K.tf.minimum(K.tf.reshape(len1, [-1]), K.tf.minimum(K.tf.shape(x)[1], self.msize1))
+        len2 = K.tf.minimum(K.tf.reshape(len2, [-1]), K.tf.minimum(K.tf.shape(x)[2], self.msize2))
+        dpool_index = self.dynamic_pooling_index_tensor(len1, len2, self.msize1, self.msize2)
+        return super(LengthDynamicMaxPooling, self).call([x, dpool_index])
 
 from keras.layers import Highway as KerasHighway
 from keras.layers import Layer
@@ -0,0 +1,167 @@
+"""Script where the embedding store shared by all the models of a process is kept.
+
+Every model builds its own embedding matrix over the full pretrained embeddings and then its
+Embedding layer copies it once more into the backend. With several models in one evaluation run,
+that is several copies of the same vectors. An :class:`EmbeddingStore` builds the matrix once and
+hands the same array and the same non trainable Embedding layer to every model which is given it.
+
+Rows layout
+-----------
+- the words of the KeyedVectors, in the order of `kv_model.index2word`
+- the pad word
+- the unk word
+- spare rows, given to train words which aren't in the KeyedVectors when `unk_handle_method` is 'random'
+
+Given a `cache_dir`, the built matrix and vocab are saved with :mod:`~sl_eval.models.utils.vocab_cache`
+and later runs over the same KeyedVectors memory map them instead of building them again.
+"""
+
+import logging
+import weakref
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+from keras.layers import Embedding
+
+from .embeddings import EMBEDDING_DTYPES, build_embedding_matrix, normalize_rows, seeded_vectors
+from .vocab import Vocabulary
+from .vocab_cache import get_cache_key, load_vocab_cache, save_vocab_cache
+
+logger = logging.getLogger(__name__)
+
+_stores = weakref.WeakKeyDictionary()
+
+
+class EmbeddingStore:
+    """Read only embedding matrix and Embedding layer over a KeyedVectors, shared between models"""
+    def __init__(self, kv_model, normalize_embeddings=True, unk_handle_method='random', n_spare_rows=20000,
+                 embedding_dtype='float32', cache_dir=None):
+        """
+        Parameters
+        ----------
+        kv_model : :class:`~gensim.models.keyedvectors.KeyedVectors`
+            The pretrained word embeddings
+        normalize_embeddings : bool, optional
+            Whether the rows of the matrix should be L2 normalized
+        unk_handle_method : {'zero', 'random'}, optional
+            The method for handling words which aren't in `kv_model`
+                - 'zero' : they are all set to the zero unk word
+                - 'random' : they get a uniformly random vector based on the word string hash
+        n_spare_rows : int, optional
+            The number of rows reserved for words which aren't in `kv_model`.
+            Once they run out, such words are set to the unk word.
+        embedding_dtype : {'float32', 'float16'}, optional
+            The dtype the matrix is stored in. The Embedding layer computes in float32 either way.
+        cache_dir : str, optional
+            Folder where the built matrix and vocab are cached, see :mod:`~sl_eval.models.utils.vocab_cache`.
+            If None, they are built on every run
+        """
+        if unk_handle_method not in ['random', 'zero']:
+            raise ValueError("Unkown token handling method %s" % str(unk_handle_method))
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError("Unkown embedding_dtype %s. It must be one of %s" % (embedding_dtype, list(EMBEDDING_DTYPES)))
+
+        self.normalize_embeddings = normalize_embeddings
+        self.unk_handle_method = unk_handle_method
+        self.embedding_dim = kv_model.vector_size
+
+        cached = None
+        if cache_dir is not None:
+            # The store doesn't depend on any corpus, only on the KeyedVectors and its settings
+            cache_key = get_cache_key(None, kv_model, unk_handle_method, normalize_embeddings, shared_store=True,
+                                      n_spare_rows=n_spare_rows, embedding_dtype=embedding_dtype)
+            # Copy on write, since the spare rows are written into when words are added
+            cached = load_vocab_cache(cache_dir, cache_key, mmap_mode='c')
+
+        if cached is not None:
+            self.embedding_matrix = cached['embedding_matrix']
+            self.vocab = cached['vocab']
+            self.pad_word_index = cached['pad_word_index']
+            self.unk_word_index = cached['unk_word_index']
+        else:
+            logger.info("Building the shared embedding matrix over %d words", len(kv_model.index2word))
+            self.embedding_matrix, words, _ = build_embedding_matrix(
+                [], kv_model, unk_handle_method=unk_handle_method, normalize_embeddings=normalize_embeddings,
+                n_spare_rows=n_spare_rows, dtype=EMBEDDING_DTYPES[embedding_dtype]
+            )
+            self.vocab = Vocabulary(words)
+            self.pad_word_index = len(words)
+            self.unk_word_index = self.pad_word_index + 1
+
+            if cache_dir is not None:
+                save_vocab_cache(cache_dir, cache_key, self.vocab, len(words), self.embedding_matrix,
+                                 self.pad_word_index, self.unk_word_index)
+        self.embedding_matrix.flags.writeable = False
+
+        self.next_spare_row = self.unk_word_index + 1
+        self._embedding_layer = None
+
+    def add_words(self, words):
+        """Gives the words which aren't in the store yet a row with their seeded vector.
+        Does nothing if `unk_handle_method` is 'zero' since they are all the unk word then.
+
+        Parameters
+        ----------
+        words : iterable of str
+        """
+        if self.unk_handle_method == 'zero':
+            return
+
+        words = list(dict.fromkeys(words))
+        new_words = [word for word, index in zip(words, self.vocab.lookup(words)) if index < 0]
+
+        n_free_rows = len(self.embedding_matrix) - self.next_spare_row
+        if len(new_words) > n_free_rows:
+            logger.info(
+                "Only %d of %d new words fit in the spare rows. The rest will be set to the unk word",
+                n_free_rows, len(new_words)
+            )
+            new_words = new_words[:n_free_rows]
+        if not new_words:
+            return
+
+        start, end = self.next_spare_row, self.next_spare_row + len(new_words)
+        self.embedding_matrix.flags.writeable = True
+        try:
+            rows = self.embedding_matrix[start: end]
+            rows[:] = seeded_vectors(new_words, self.embedding_dim)
+            if self.normalize_embeddings:
+                normalize_rows(rows)
+        finally:
+            self.embedding_matrix.flags.writeable = False
+        self.vocab.extend(new_words, ids=np.arange(start, end))
+        self.next_spare_row = end
+
+        # The layer already holds its own copy of the matrix, so the new rows are written into it as well
+        if self._embedding_layer is not None and self._embedding_layer.built:
+            K.get_session().run(tf.scatter_update(
+                self._embedding_layer.embeddings, np.arange(start, end), self.embedding_matrix[start: end]
+            ))
+        logger.info("Added %d words to the shared embedding matrix", len(new_words))
+
+    def get_embedding_layer(self):
+        """Returns the non trainable Embedding layer over the matrix. The same layer is returned on every call,
+        so all the models using it share a single copy of the weights in the backend.
+        """
+        if self._embedding_layer is None:
+            self._embedding_layer = Embedding(
+                self.embedding_matrix.shape[0], self.embedding_dim, weights=[self.embedding_matrix],
+                trainable=False, name='word_embedding'
+            )
+        return self._embedding_layer
+
+
+def get_embedding_store(kv_model, normalize_embeddings=True, unk_handle_method='random', n_spare_rows=20000,
+                        embedding_dtype='float32', cache_dir=None):
+    """Returns the process wide :class:`EmbeddingStore` for `kv_model` with the given settings,
+    building it on the first call.
+
+    Parameters are the same as :class:`EmbeddingStore`. `n_spare_rows` and `cache_dir` are only used when
+    building the store.
+    """
+    stores = _stores.setdefault(kv_model, {})
+    settings = (bool(normalize_embeddings), unk_handle_method, embedding_dtype)
+    if settings not in stores:
+        stores[settings] = EmbeddingStore(kv_model, normalize_embeddings, unk_handle_method, n_spare_rows,
+                                          embedding_dtype, cache_dir)
+    return stores[settings]
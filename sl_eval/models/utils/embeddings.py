@@ -0,0 +1,187 @@
+"""Script where the helpers for building the models' embedding matrices are kept."""
+
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The dtype of the token ids in the batches fed to the models
+INDEX_DTYPE = np.int32
+
+# The dtypes an embedding matrix can be stored in on the host.
+# The Embedding layers always compute in float32, 'float16' only halves the memory of the stored matrix.
+EMBEDDING_DTYPES = {'float32': np.float32, 'float16': np.float16}
+
+
+def _splitmix64(x):
+    """Mixes an array of uint64 into well spread uint64, elementwise. See http://xoshiro.di.unimi.it/splitmix64.c"""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def seeded_vectors(words, vector_size, dtype=np.float32, chunk_size=4096):
+    """Creates one 'random' vector per word, deterministic by the word string, for all the words at once
+
+    Each word is hashed with md5 into a 64 bit seed. Component `j` of its vector is a counter based hash of
+    (seed, j) mapped to a uniform number in [0, 1), so the whole matrix is made with a few numpy operations
+    instead of one `RandomState` per word. The vectors are scaled like the models always did:
+    (uniform - 0.5) / vector_size
+
+    Parameters
+    ----------
+    words : list of str
+    vector_size : int
+    dtype : numpy dtype, optional
+        The dtype of the returned matrix
+    chunk_size : int, optional
+        The number of words whose vectors are made at once
+
+    Returns
+    -------
+    numpy array of shape (len(words), vector_size)
+    """
+    # Note: built-in hash() may vary by Python version or even (in Py3.x) per launch
+    seeds = np.fromiter(
+        (int.from_bytes(hashlib.md5(word.encode('utf8')).digest()[:8], 'little') for word in words),
+        dtype=np.uint64, count=len(words)
+    )
+    counters = np.arange(vector_size, dtype=np.uint64)
+    vectors = np.empty((len(words), vector_size), dtype=dtype)
+    for start in range(0, len(words), chunk_size):
+        mixed = _splitmix64(_splitmix64(seeds[start: start + chunk_size, None]) ^ counters)
+        # The top 53 bits make a uniform float64 in [0, 1)
+        uniform = (mixed >> np.uint64(11)) * (1.0 / (1 << 53))
+        vectors[start: start + chunk_size] = (uniform - 0.5) / vector_size
+    return vectors
+
+
+def _gather_rows(source, index, out, chunk_size=65536):
+    """Copies `source[index]` into `out` in chunks so that the full gathered array
+    is never materialized next to `out`
+
+    Parameters
+    ----------
+    source : numpy array of shape (n_source_rows, dim)
+    index : numpy array of int
+        The rows of `source` to be copied
+    out : numpy array of shape (len(index), dim)
+        The array the rows are written into
+    chunk_size : int, optional
+        The number of rows copied at once
+    """
+    for start in range(0, len(index), chunk_size):
+        out[start: start + chunk_size] = source[index[start: start + chunk_size]]
+
+
+def normalize_rows(matrix, chunk_size=65536):
+    """L2 normalizes the rows of `matrix` in place. Rows with a zero norm are left as they are.
+
+    Parameters
+    ----------
+    matrix : numpy array of shape (n_rows, dim)
+    chunk_size : int, optional
+        The number of rows normalized at once
+    """
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start: start + chunk_size]
+        # float16 rows are summed up in float32 to keep the norms precise
+        norms = np.sqrt(np.einsum('ij,ij->i', chunk, chunk, dtype=np.promote_types(chunk.dtype, np.float32)))
+        norms[norms == 0] = 1
+        chunk /= norms[:, None].astype(chunk.dtype)
+    return matrix
+
+
+def build_embedding_matrix(words, kv_model, unk_handle_method='random', normalize_embeddings=True,
+                           dtype=np.float32, add_extra_words=True, n_spare_rows=0):
+    """Builds the matrix which can be fed directly into an Embedding layer
+
+    The rows are laid out as:
+    - `words`, in the given order. Words not in `kv_model` get a vector based on `unk_handle_method`,
+      see :func:`seeded_vectors`
+    - the words of `kv_model` which aren't in `words`, in the order of `kv_model.index2word`.
+      It is useful for embedding words encountered in the validation and test set.
+      Only if `add_extra_words` is True.
+    - the pad word
+    - the unk word
+    - `n_spare_rows` zero rows which can be filled later for words met after the build
+
+    The vectors are gathered from `kv_model.vectors` in bulk into one preallocated matrix.
+
+    Parameters
+    ----------
+    words : list of str
+        The vocab words. `words[i]` is given the row `i`.
+    kv_model : :class:`~gensim.models.keyedvectors.KeyedVectors`
+        The pretrained word embeddings
+    unk_handle_method : {'zero', 'random'}, optional
+        The method for handling words which aren't in `kv_model`
+    normalize_embeddings : bool, optional
+        Whether the rows of the matrix should be L2 normalized
+    dtype : numpy dtype, optional
+        The dtype of the returned matrix
+    add_extra_words : bool, optional
+        Whether the words of `kv_model` which aren't in `words` should be added
+    n_spare_rows : int, optional
+        The number of zero rows reserved after the unk word
+
+    Returns
+    -------
+    embedding_matrix : numpy array of shape (len(words) + len(extra_words) + 2 + n_spare_rows, kv_model.vector_size)
+    extra_words : list of str
+        The words from `kv_model` added after `words`, in the order of their rows
+    n_non_embedding_words : int
+        The number of `words` which weren't in `kv_model`
+    """
+    n_words, embedding_dim = len(words), kv_model.vector_size
+    kv_vocab = kv_model.vocab
+
+    kv_index = np.fromiter(
+        (kv_vocab[word].index if word in kv_vocab else -1 for word in words), dtype=np.int64, count=n_words
+    )
+    in_kv = kv_index >= 0
+    n_non_embedding_words = int(n_words - np.count_nonzero(in_kv))
+
+    # Take the words in the embedding file which aren't there in the vocab
+    if add_extra_words:
+        extra_mask = np.ones(len(kv_model.index2word), dtype=bool)
+        extra_mask[kv_index[in_kv]] = False
+        extra_kv_index = np.flatnonzero(extra_mask)
+    else:
+        extra_kv_index = np.zeros(0, dtype=np.int64)
+    n_extra = len(extra_kv_index)
+    pad_word_index = n_words + n_extra
+    unk_word_index = pad_word_index + 1
+
+    embedding_matrix = np.empty((unk_word_index + 1 + n_spare_rows, embedding_dim), dtype=dtype)
+
+    # words found in keyed vectors
+    embedding_matrix[np.flatnonzero(in_kv)] = kv_model.vectors[kv_index[in_kv]]
+
+    # words not found in keyed vectors will get the vector based on unk_handle_method
+    oov_rows = np.flatnonzero(~in_kv)
+    if unk_handle_method == 'random':
+        # Creates the same random vector for the given string each time
+        embedding_matrix[oov_rows] = seeded_vectors([words[i] for i in oov_rows], embedding_dim, dtype=dtype)
+    elif unk_handle_method == 'zero':
+        embedding_matrix[oov_rows] = 0
+
+    _gather_rows(kv_model.vectors, extra_kv_index, embedding_matrix[n_words: n_words + n_extra])
+    extra_words = [kv_model.index2word[i] for i in extra_kv_index]
+
+    # Set the pad and unk word right after the indexed words
+    embedding_matrix[pad_word_index] = np.random.uniform(-0.2, 0.2, embedding_dim)
+    if unk_handle_method == 'random':
+        embedding_matrix[unk_word_index] = np.random.uniform(-0.2, 0.2, embedding_dim)
+    elif unk_handle_method == 'zero':
+        embedding_matrix[unk_word_index] = 0
+    embedding_matrix[unk_word_index + 1:] = 0
+
+    if normalize_embeddings:
+        logger.info("Normalizing the word embeddings")
+        normalize_rows(embedding_matrix)
+
+    return embedding_matrix, extra_words, n_non_embedding_words
@@ -104,3 +104,32 @@ def mean_ndcg(Y_true, Y_pred, k=10):
         if idcg != 0:
             ndcgs.append(dcg / idcg)
     return np.mean(np.array(ndcgs))
+
+
+def mean_recall(retrieved_ids, relevant_ids, k=None):
+    """Calculates the mean over the queries of the fraction of their relevant docs found in
+    their first k retrieved docs
+
+    Parameters
+    ----------
+    retrieved_ids : list of list of int
+        The ids of the docs retrieved for each query, best first
+    relevant_ids : list of list of int
+        The ids of the relevant docs of each query. Queries with none are skipped
+    k : int, optional
+        If None, all the retrieved docs are counted
+
+    Examples
+    --------
+    >>> retrieved_ids = [[3, 1, 4], [1, 5, 9], [2, 6, 5]]
+    >>> relevant_ids = [[1, 7], [9], []]
+    >>> print(mean_recall(retrieved_ids, relevant_ids, k=2))
+    0.25
+    """
+    recalls = []
+    for retrieved, relevant in zip(retrieved_ids, relevant_ids):
+        relevant = set(relevant)
+        if len(relevant) == 0:
+            continue
+        recalls.append(len(relevant.intersection(list(retrieved)[:k])) / len(relevant))
+    return np.mean(np.array(recalls))
@@ -0,0 +1,96 @@
+"""Script where the features a model computes from frozen weights are cached on disk for training its other layers.
+
+When the word embeddings are frozen, everything a model computes from them before its first trainable layer
+is a fixed function of the (query, doc) pair, like the top k of the interaction matrix of DRMM_TKS.
+These features are computed once, one row per pair, into a memory mapped .npy file, and only the layers
+past them are trained on it for all the epochs.
+
+The file is named after a fingerprint of the corpus, of the frozen weights and of the settings,
+so later runs on the same data memory map it again instead of computing it.
+
+File layout
+-----------
+<cache_dir>/<key>.npy : array of FEATURE_DTYPE of shape (n_rows,) + row_shape
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the cached features or the way they are computed changes
+FEATURE_CACHE_VERSION = 1
+
+FEATURE_DTYPE = np.float32
+
+# The number of rows computed at once
+DEFAULT_FEATURE_BATCH_SIZE = 1000
+
+
+def get_feature_cache_key(corpus, weights, **settings):
+    """Gets the name of the file the features of the given data are saved in
+
+    Parameters
+    ----------
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+    weights : list of numpy arrays
+        The frozen weights the features are computed from, like the embedding matrix
+    settings : dict
+        Any other settings which change the features, like text_maxlen
+    """
+    md5 = hashlib.md5()
+    for array in [corpus.ids, corpus.lengths, corpus.group_sizes] + list(weights):
+        md5.update(np.ascontiguousarray(array).tobytes())
+    md5.update(json.dumps(dict(settings, version=FEATURE_CACHE_VERSION), sort_keys=True).encode('utf8'))
+    return md5.hexdigest()
+
+
+def load_feature_cache(cache_dir, key, n_rows, row_shape, compute_rows, batch_size=DEFAULT_FEATURE_BATCH_SIZE):
+    """Memory maps the features saved under `key`, computing and saving them first unless an earlier run already did
+
+    The rows are written to a temporary file which is then renamed, so half computed features are never read.
+
+    Parameters
+    ----------
+    cache_dir : str
+    key : str
+        See :func:`get_feature_cache_key`
+    n_rows : int
+    row_shape : tuple of int
+        The shape of the features of a row
+    compute_rows : function
+        Called as compute_rows(start, stop), it returns the features of the rows from `start` to `stop`
+    batch_size : int, optional
+        The number of rows computed at once
+
+    Returns
+    -------
+    numpy memmap of FEATURE_DTYPE of shape (n_rows,) + row_shape
+        Read only
+    """
+    path = os.path.join(cache_dir, key + '.npy')
+    if os.path.isfile(path):
+        logger.info("The cached features are already at %s", path)
+        return np.load(path, mmap_mode='r')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=key + '.', suffix='.npy', dir=cache_dir)
+    os.close(fd)
+    try:
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=FEATURE_DTYPE,
+                                             shape=(n_rows,) + tuple(row_shape))
+        for start in range(0, n_rows, batch_size):
+            stop = min(start + batch_size, n_rows)
+            features[start: stop] = compute_rows(start, stop)
+        features.flush()
+        del features
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info("Cached the features of %d rows at %s", n_rows, path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,74 @@
+"""Script where batches of str sentences are translated into the padded word id matrices the models are fed."""
+
+import logging
+import numpy as np
+
+from .embeddings import INDEX_DTYPE
+
+logger = logging.getLogger(__name__)
+
+
+def index_sentences(sentences, vocab, text_maxlen, pad_word_index, unk_word_index, out=None):
+    """Translates a batch of sentences into a matrix of word ids, padded or clipped to `text_maxlen`
+
+    Each distinct sentence is translated once and each distinct word is looked up in `vocab` once,
+    in a single call. Repeated sentences, like a query given once per candidate doc, are copied
+    from the row of their first occurrence.
+
+    Parameters
+    ----------
+    sentences : list of list of str
+    vocab : :class:`~sl_eval.models.utils.vocab.Vocabulary`
+    text_maxlen : int
+    pad_word_index : int
+    unk_word_index : int
+        The id given to words which aren't in `vocab`
+    out : numpy array of INDEX_DTYPE of shape (len(sentences), text_maxlen), optional
+        A preallocated matrix to write the result into
+
+    Returns
+    -------
+    indexed : numpy array of INDEX_DTYPE of shape (len(sentences), text_maxlen)
+    n_unknown_words : int
+        The number of words set to `unk_word_index` in the distinct sentences
+    """
+    n_sentences = len(sentences)
+    if out is None:
+        out = np.empty((n_sentences, text_maxlen), dtype=INDEX_DTYPE)
+    elif out.shape != (n_sentences, text_maxlen):
+        raise ValueError("out has the shape %s instead of %s" % (str(out.shape), str((n_sentences, text_maxlen))))
+
+    # Words past text_maxlen are clipped
+    distinct_rows = {}
+    rows = np.empty(n_sentences, dtype=np.int64)
+    distinct_sentences = []
+    for i, sentence in enumerate(sentences):
+        key = tuple(sentence[:text_maxlen])
+        row = distinct_rows.get(key)
+        if row is None:
+            row = distinct_rows[key] = len(distinct_sentences)
+            distinct_sentences.append(key)
+        rows[i] = row
+
+    n_distinct = len(distinct_sentences)
+    lengths = np.fromiter(map(len, distinct_sentences), dtype=np.int64, count=n_distinct)
+    n_tokens = int(lengths.sum())
+
+    word_codes = {}
+    codes = np.fromiter(
+        (word_codes.setdefault(word, len(word_codes)) for sentence in distinct_sentences for word in sentence),
+        dtype=np.int64, count=n_tokens
+    )
+    word_ids = vocab.lookup(list(word_codes))
+    unknown = word_ids < 0
+    word_ids[unknown] = unk_word_index
+
+    # Without repeated sentences the distinct rows are the result itself
+    indexed = out if n_distinct == n_sentences else np.empty((n_distinct, text_maxlen), dtype=INDEX_DTYPE)
+    indexed.fill(pad_word_index)
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    indexed[np.repeat(np.arange(n_distinct), lengths), np.arange(n_tokens) - starts] = word_ids[codes]
+    if indexed is not out:
+        np.take(indexed, rows, axis=0, out=out)
+
+    return out, int(np.count_nonzero(unknown[codes]))
@@ -0,0 +1,101 @@
+"""Script where text_maxlen and topk are sized from the lengths of the train sentences.
+
+Padding to a text_maxlen far past the length of most sentences costs quadratically in the
+(text_maxlen x text_maxlen) interaction matrices of MatchPyramid and DRMM_TKS. :func:`recommend_sizes`
+gets the length percentiles of the queries and docs of an indexed corpus and the shortest text_maxlen which
+leaves a chosen share of them untruncated, and logs what it would save.
+"""
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The share of the train sentences left untruncated by the recommended text_maxlen
+DEFAULT_LENGTH_COVERAGE = 0.995
+
+# The length percentiles which are logged
+LENGTH_PERCENTILES = [50, 90, 95, 99, 99.5, 100]
+
+
+def get_sentence_lengths(corpus):
+    """Splits the lengths of the sentences of a corpus into those of the queries and those of the docs
+
+    Parameters
+    ----------
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+
+    Returns
+    -------
+    query_lengths, doc_lengths : numpy arrays of int
+    """
+    is_query = np.zeros(len(corpus.lengths), dtype=bool)
+    is_query[corpus.group_offsets[:-1]] = True
+    return corpus.lengths[is_query], corpus.lengths[~is_query]
+
+
+def covering_length(lengths, coverage):
+    """Gets the shortest length which at least a `coverage` share of `lengths` fit in
+
+    Parameters
+    ----------
+    lengths : numpy array of int
+    coverage : float between 0 and 1
+
+    Returns
+    -------
+    int
+        At least 1
+    """
+    if not 0 < coverage <= 1:
+        raise ValueError("coverage must be in (0, 1], not %s" % str(coverage))
+    if len(lengths) == 0:
+        return 1
+    sorted_lengths = np.sort(lengths)
+    index = min(len(sorted_lengths), int(np.ceil(coverage * len(sorted_lengths)))) - 1
+    return max(1, int(sorted_lengths[max(index, 0)]))
+
+
+def recommend_sizes(corpus, text_maxlen, topk=None, coverage=DEFAULT_LENGTH_COVERAGE):
+    """Gets the text_maxlen which leaves a `coverage` share of the train sentences untruncated, and the topk
+    which fits in it, logging the length percentiles and the savings against the current sizes
+
+    Parameters
+    ----------
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+    text_maxlen : int
+        The current text_maxlen
+    topk : int, optional
+        The current topk, for models which take the top k of each row of the interaction matrix
+    coverage : float between 0 and 1, optional
+
+    Returns
+    -------
+    recommended_text_maxlen : int
+    recommended_topk : int or None
+        `topk` capped at the recommended text_maxlen, None if `topk` is None
+    """
+    query_lengths, doc_lengths = get_sentence_lengths(corpus)
+    for name, lengths in [('query', query_lengths), ('doc', doc_lengths)]:
+        if len(lengths):
+            logger.info("Percentiles of the %s lengths: %s", name, ', '.join(
+                '%s%%: %d' % (p, l) for p, l in zip(LENGTH_PERCENTILES, np.percentile(lengths, LENGTH_PERCENTILES))
+            ))
+
+    # Queries and docs are padded to the same text_maxlen
+    recommended_text_maxlen = covering_length(corpus.lengths, coverage)
+    recommended_topk = None if topk is None else min(topk, recommended_text_maxlen)
+
+    n_sentences = max(1, len(corpus.lengths))
+    truncated = np.count_nonzero(corpus.lengths > text_maxlen) / n_sentences
+    covered = np.count_nonzero(corpus.lengths <= recommended_text_maxlen) / n_sentences
+    ratio = recommended_text_maxlen / text_maxlen
+    logger.info(
+        "text_maxlen %d truncates %.2f%% of the train sentences. text_maxlen %d would leave %.2f%% of them "
+        "untruncated, with %.1f%% of the FLOPs and memory of the interaction matrices and %.1f%% of those of "
+        "the word embeddings", text_maxlen, 100 * truncated, recommended_text_maxlen, 100 * covered,
+        100 * ratio ** 2, 100 * ratio
+    )
+    if topk is not None and recommended_topk != topk:
+        logger.info("topk %d is longer than text_maxlen %d, so it would be capped at it", topk, recommended_text_maxlen)
+    return recommended_text_maxlen, recommended_topk
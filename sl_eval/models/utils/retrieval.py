@@ -0,0 +1,158 @@
+"""Script where docs are retrieved for queries from a whole collection in two stages.
+
+The models only score the candidate docs they are given, and scoring every doc of a collection of tens of
+thousands with them for every query is far too slow. So the docs are retrieved in two stages:
+
+1. Candidate generation : the mean word vectors of the docs are indexed once in a nearest neighbour index,
+   see :mod:`~sl_eval.models.utils.ann_index`, and the `n_candidates` docs nearest to the query vector are fetched
+2. Re-ranking : a trained model, like :class:`~sl_eval.models.DRMM_TKS` or :class:`~sl_eval.models.MatchPyramid`,
+   scores the candidates with its `score_groups` method and they are sorted by its scores
+
+The time taken by each stage is kept in `TwoStageRetriever.timings`, so their latency can be reported.
+"""
+
+import logging
+import time
+import numpy as np
+
+from .ann_index import get_ann_index
+
+logger = logging.getLogger(__name__)
+
+# The number of docs whose vectors are computed at once
+DEFAULT_INDEX_BATCH_SIZE = 10000
+
+
+class TwoStageRetriever:
+    """Retrieves the candidate docs of queries from a nearest neighbour index and re-ranks them with a model
+
+    Examples
+    --------
+    >>> from sl_eval.models import NumpyWordVectors
+    >>> retriever = TwoStageRetriever(NumpyWordVectors.from_keyed_vectors(kv_model), 'ivf', reranker=drmm_tks_model)
+    >>> retriever.index_docs(iqa_reader.get_answer_pool()[1])
+    >>> doc_ids, scores = retriever.search(queries, n_candidates=100, n_results=10)
+    """
+
+    def __init__(self, word_vectors, index='ivf', reranker=None, **index_kwargs):
+        """
+        Parameters
+        ----------
+        word_vectors : :class:`~sl_eval.models.baseline_numpy.NumpyWordVectors`
+            Or anything with a `sentence_vectors(sentences)` method. Gives the vectors the docs are indexed by
+        index : {'exact', 'ivf', 'lsh'} or index, optional
+            The type of the nearest neighbour index, or an index of :mod:`~sl_eval.models.utils.ann_index`
+        reranker : model, optional
+            A model with a `score_groups` method. If None, the candidates are kept in the order of the index
+        index_kwargs : dict
+            Passed on to the class of the index when `index` is a type
+        """
+        self.word_vectors = word_vectors
+        self.index = get_ann_index(index, **index_kwargs) if isinstance(index, str) else index
+        self.reranker = reranker
+        self.docs = None
+        # The time in seconds taken by each stage the last time it ran, with the number of queries or docs
+        # it ran for
+        self.timings = {}
+
+    def _sentence_vectors(self, sentences, batch_size=DEFAULT_INDEX_BATCH_SIZE):
+        return np.concatenate([self.word_vectors.sentence_vectors(sentences[start: start + batch_size])
+                               for start in range(0, len(sentences), batch_size)])
+
+    def index_docs(self, docs, batch_size=DEFAULT_INDEX_BATCH_SIZE):
+        """Indexes the docs the queries are searched in. The id of a doc is its position in `docs`
+
+        Parameters
+        ----------
+        docs : list of list of str
+        batch_size : int, optional
+            The number of docs whose vectors are computed at once
+        """
+        start_time = time.perf_counter()
+        self.docs = list(docs)
+        self.index.fit(self._sentence_vectors(self.docs, batch_size))
+        self.timings['indexing'] = (time.perf_counter() - start_time, len(self.docs))
+        logger.info("Indexed %d docs in %.2fs", len(self.docs), self.timings['indexing'][0])
+
+    def retrieve(self, queries, n_candidates=100):
+        """Gets the `n_candidates` docs nearest to each query in the index, the first stage
+
+        Parameters
+        ----------
+        queries : list of list of str
+        n_candidates : int, optional
+
+        Returns
+        -------
+        list of numpy arrays of int64
+            The ids of the candidate docs of each query, nearest first
+        """
+        if self.docs is None:
+            raise ValueError("The docs have to be indexed with index_docs before searching them")
+        start_time = time.perf_counter()
+        queries = list(queries)
+        ids, _ = self.index.search(self._sentence_vectors(queries), n_candidates)
+        candidates = [row[row >= 0] for row in ids]
+        self._log_timing('retrieval', start_time, len(queries))
+        return candidates
+
+    def rerank(self, queries, candidates, n_results=None):
+        """Sorts the candidate docs of each query by the scores of the reranker, the second stage
+
+        Parameters
+        ----------
+        queries : list of list of str
+        candidates : list of numpy arrays of int
+            The ids of the candidate docs of each query, like the output of :meth:`retrieve`
+        n_results : int, optional
+            The number of docs kept per query. If None, they all are
+
+        Returns
+        -------
+        doc_ids : list of numpy arrays of int64
+            The ids of the docs of each query, best first
+        scores : list of numpy arrays of float
+            Their scores
+        """
+        start_time = time.perf_counter()
+        queries = list(queries)
+        score_groups = self.reranker.score_groups(queries, [[self.docs[i] for i in ids] for ids in candidates])
+        doc_ids, doc_scores = [], []
+        for ids, scores in zip(candidates, score_groups):
+            order = np.argsort(-np.asarray(scores), kind='stable')[:n_results]
+            doc_ids.append(np.asarray(ids)[order])
+            doc_scores.append(np.asarray(scores)[order])
+        self._log_timing('reranking', start_time, len(queries))
+        return doc_ids, doc_scores
+
+    def search(self, queries, n_candidates=100, n_results=10):
+        """Retrieves the candidate docs of each query and re-ranks them with the reranker, if there is one
+
+        Parameters
+        ----------
+        queries : list of list of str
+        n_candidates : int, optional
+            The number of docs fetched from the index for each query
+        n_results : int, optional
+            The number of docs kept for each query
+
+        Returns
+        -------
+        doc_ids : list of numpy arrays of int64
+            The ids of the docs of each query, best first
+        scores : list of numpy arrays of float
+            Their scores. The similarities of the index if there is no reranker
+        """
+        queries = list(queries)
+        if self.reranker is None:
+            start_time = time.perf_counter()
+            ids, similarities = self.index.search(self._sentence_vectors(queries), n_results)
+            self._log_timing('retrieval', start_time, len(queries))
+            return [row[row >= 0] for row in ids], [s[row >= 0] for row, s in zip(ids, similarities)]
+        return self.rerank(queries, self.retrieve(queries, n_candidates), n_results)
+
+    def _log_timing(self, stage, start_time, n_queries):
+        elapsed = time.perf_counter() - start_time
+        self.timings[stage] = (elapsed, n_queries)
+        logger.info("%s of %d queries took %.2fs, %.2fms per query", stage.capitalize(), n_queries, elapsed,
+                    1000. * elapsed / max(n_queries, 1))
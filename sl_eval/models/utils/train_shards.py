@@ -0,0 +1,209 @@
+"""Script where the pre-indexed train data is exported to sharded .npy files and read back with tf.data.
+
+Each train example (a triplet in the 'ranking' target_mode, a pair otherwise) is one row of int32,
+with its sentences already padded. The rows are read back by a tf.data pipeline which reads several shards at
+once, shuffles the rows in a buffer, batches them, splits them into the model inputs and prefetches the batches,
+all in tensorflow's own threads. Python only hands the finished batches to keras.
+
+The shards are saved in a folder named after a fingerprint of the indexed corpus and the layout of a row,
+so later runs on the same data read them again instead of exporting them.
+
+Folder layout
+-------------
+<shards_dir>/<key>/
+    shard-00000.npy, shard-00001.npy, ... : arrays of ROW_DTYPE of shape (n_rows, row_width)
+    meta.json : the columns of each field of a row, the row width and the shards with their header sizes
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the shards changes
+SHARDS_VERSION = 1
+
+# Little endian, since tf.decode_raw reads the rows as such
+ROW_DTYPE = np.dtype('<i4')
+
+# The number of rows written in a shard
+DEFAULT_ROWS_PER_SHARD = 50000
+
+
+def get_shards_key(corpus, columns, **settings):
+    """Gets the name of the folder the shards of the given data are saved in
+
+    Parameters
+    ----------
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+    columns : list of tuple
+        See :func:`save_train_shards`
+    settings : dict
+        Any other settings which change the rows, like the pad word index
+    """
+    md5 = hashlib.md5()
+    for array in [corpus.ids, corpus.lengths, corpus.group_sizes] + [values for _, values, _ in columns]:
+        md5.update(np.ascontiguousarray(array).tobytes())
+    md5.update(json.dumps(corpus.labels, default=lambda value: value.tolist()).encode('utf8'))
+    md5.update(json.dumps(dict(settings, version=SHARDS_VERSION, columns=[(name, width) for name, _, width in columns]),
+                          sort_keys=True).encode('utf8'))
+    return md5.hexdigest()
+
+
+def _iter_row_blocks(corpus, columns, pad_word_index, rows_per_shard):
+    """Yields the rows of the shards, `rows_per_shard` at a time"""
+    n_rows = len(columns[0][1])
+    row_width = sum(1 if width is None else width for _, _, width in columns)
+    for start in range(0, n_rows, rows_per_shard):
+        stop = min(start + rows_per_shard, n_rows)
+        block = np.empty((stop - start, row_width), dtype=ROW_DTYPE)
+        column = 0
+        for _, values, width in columns:
+            if width is None:
+                block[:, column] = values[start: stop]
+                column += 1
+            else:
+                corpus.pad_sentences(values[start: stop], width, pad_word_index, out=block[:, column: column + width])
+                column += width
+        yield block
+
+
+def save_train_shards(shards_dir, corpus, columns, pad_word_index, rows_per_shard=DEFAULT_ROWS_PER_SHARD, **settings):
+    """Exports the rows of the train examples to .npy shards under `shards_dir`, unless they are already there
+
+    The files are written to a temporary folder which is then renamed, so half written shards
+    are never picked up by :func:`make_train_dataset`.
+
+    Parameters
+    ----------
+    shards_dir : str
+    corpus : :class:`~sl_eval.models.utils.corpus.IndexedCorpus`
+    columns : list of (str, numpy array, int or None)
+        The name, the values for each example and the width of each field of a row.
+        If the width is an int, the values are indices of sentences of `corpus`, padded to it.
+        If it is None, the values are written as they are in a single column, like labels or lengths
+    pad_word_index : int
+    rows_per_shard : int, optional
+    settings : dict
+        Any other settings which change the rows, see :func:`get_shards_key`
+
+    Returns
+    -------
+    str
+        The key of the shards
+    """
+    key = get_shards_key(corpus, columns, pad_word_index=int(pad_word_index), **settings)
+    final_path = os.path.join(shards_dir, key)
+    if os.path.isdir(final_path):
+        logger.info("The train shards are already at %s", final_path)
+        return key
+
+    os.makedirs(shards_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=key + '.', dir=shards_dir)
+    fields, column = {}, 0
+    for name, _, width in columns:
+        fields[name] = [column, column + (1 if width is None else width)]
+        column = fields[name][1]
+
+    shards = []
+    try:
+        for i, block in enumerate(_iter_row_blocks(corpus, columns, pad_word_index, rows_per_shard)):
+            file_name = 'shard-%05d.npy' % i
+            with open(os.path.join(tmp_path, file_name), 'wb') as f:
+                np.save(f, block)
+                # The header is skipped when reading the rows back
+                header_bytes = f.tell() - block.nbytes
+            shards.append({'file': file_name, 'header_bytes': header_bytes, 'n_rows': len(block)})
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'row_width': column, 'fields': fields, 'shards': shards}, f)
+        os.rename(tmp_path, final_path)
+    except OSError:
+        # Another process may have written the same shards in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(final_path):
+            raise
+    logger.info("Exported %d train rows to %d shards at %s", sum(s['n_rows'] for s in shards), len(shards), final_path)
+    return key
+
+
+def make_train_dataset(shards_dir, key, batch_size, to_inputs, shuffle_buffer=10000, seed=None, cycle_length=4,
+                       prefetch=2):
+    """Makes an endless tf.data pipeline of the batches of the shards saved by :func:`save_train_shards`
+
+    Parameters
+    ----------
+    shards_dir : str
+    key : str
+    batch_size : int
+        The number of rows of a batch
+    to_inputs : function
+        Turns a dict of the fields of a batch of rows, as int32 tensors of shape (batch_size, width), into the
+        (inputs, targets) of the model, in tensorflow ops
+    shuffle_buffer : int, optional
+        The number of rows the rows are shuffled within
+    seed : int, optional
+        The seed of the shuffling of the shards and the rows. If None, the shards are read in their order,
+        but the shuffling and the parallel reads aren't deterministic
+    cycle_length : int, optional
+        The number of shards read at once
+    prefetch : int, optional
+        The number of batches made ahead of the training
+
+    Returns
+    -------
+    :class:`tf.data.Dataset`
+    """
+    path = os.path.join(shards_dir, key)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    row_width, fields = meta['row_width'], meta['fields']
+
+    files = tf.data.Dataset.from_tensor_slices((
+        [os.path.join(path, shard['file']) for shard in meta['shards']],
+        np.array([shard['header_bytes'] for shard in meta['shards']], dtype=np.int64)
+    ))
+    if seed is not None:
+        files = files.shuffle(len(meta['shards']), seed=seed)
+    files = files.repeat()
+
+    rows = files.apply(tf.contrib.data.parallel_interleave(
+        lambda file_name, header_bytes: tf.data.FixedLengthRecordDataset(
+            file_name, row_width * ROW_DTYPE.itemsize, header_bytes=header_bytes
+        ),
+        cycle_length=cycle_length, sloppy=seed is None
+    ))
+    rows = rows.shuffle(shuffle_buffer, seed=seed).batch(batch_size)
+
+    def split_fields(raw_rows):
+        batch = tf.reshape(tf.decode_raw(raw_rows, tf.int32), [-1, row_width])
+        return to_inputs({name: batch[:, start: stop] for name, (start, stop) in fields.items()})
+
+    return rows.map(split_fields, num_parallel_calls=cycle_length).prefetch(prefetch)
+
+
+def interleave_tensors(a, b):
+    """Interleaves the rows of two tensors of the same shape: a[0], b[0], a[1], b[1], ...
+
+    Same as :func:`~sl_eval.models.utils.corpus.interleave_pairs` for the tensors of a batch of triplets
+    """
+    return tf.reshape(tf.stack([a, b], axis=1), tf.concat([[-1], tf.shape(a)[1:]], axis=0))
+
+
+def iter_dataset(dataset, session):
+    """Yields the batches of an endless `dataset` as numpy arrays, for `fit_generator`
+
+    Parameters
+    ----------
+    dataset : :class:`tf.data.Dataset`
+    session : :class:`tf.Session`
+        The session of the keras model
+    """
+    next_batch = dataset.make_one_shot_iterator().get_next()
+    while True:
+        yield session.run(next_batch)
@@ -0,0 +1,80 @@
+"""Script where the TREC qrels and run files of the evaluation scripts are written, and the groups of candidate docs
+they score are batched.
+
+Formats
+-------
+qrels : <query_id>\t0\t<document_id>\t<relevance>
+run : <query_id>\tQ0\t<document_id>\t99\t<model_score>\tSTANDARD
+
+The 0, Q0, 99 and STANDARD fields are ignored by trec_eval.
+"""
+
+# The size of the write buffers of the files, so lines are written in large blocks
+WRITE_BUFFER_SIZE = 1 << 20
+
+# The number of (query, doc) pairs scored at once by the `score_groups` of the models
+DEFAULT_SCORE_BATCH_SIZE = 20000
+
+
+def write_qrels(fname, query_ids, doc_id_groups, label_groups):
+    """Writes the relevance of each doc of each query in the TREC qrels format
+
+    Parameters
+    ----------
+    fname : str
+    query_ids : iterable of str
+    doc_id_groups : iterable of list of str
+        The ids of the candidate docs of each query
+    label_groups : iterable of list of int
+        The relevance of each candidate doc of each query
+    """
+    with open(fname, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        for q_id, d_ids, labels in zip(query_ids, doc_id_groups, label_groups):
+            f.writelines('%s\t0\t%s\t%s\n' % (q_id, d_id, label) for d_id, label in zip(d_ids, labels))
+
+
+def write_run(fname, query_ids, doc_id_groups, score_groups):
+    """Writes the score of each doc of each query in the TREC run format
+
+    Parameters
+    ----------
+    fname : str
+    query_ids : iterable of str
+    doc_id_groups : iterable of list of str
+        The ids of the candidate docs of each query
+    score_groups : iterable of iterable of float
+        The score of each candidate doc of each query, like the output of `score_groups`
+    """
+    with open(fname, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        for q_id, d_ids, scores in zip(query_ids, doc_id_groups, score_groups):
+            f.writelines('%s\tQ0\t%s\t99\t%s\tSTANDARD\n' % (q_id, d_id, score) for d_id, score in zip(d_ids, scores))
+
+
+def iter_group_batches(queries, doc_groups, batch_size=DEFAULT_SCORE_BATCH_SIZE):
+    """Yields the queries with their candidate docs in batches of about `batch_size` (query, doc) pairs
+
+    A group is never split, so a batch holds more pairs when its last group doesn't fit.
+
+    Parameters
+    ----------
+    queries : iterable of list of str
+    doc_groups : iterable of list of list of str
+        The candidate docs of each query
+    batch_size : int, optional
+
+    Yields
+    ------
+    batch_queries : list of list of str
+    batch_doc_groups : list of list of list of str
+    """
+    batch_queries, batch_doc_groups, n_pairs = [], [], 0
+    for query, docs in zip(queries, doc_groups):
+        docs = list(docs)
+        batch_queries.append(query)
+        batch_doc_groups.append(docs)
+        n_pairs += len(docs)
+        if n_pairs >= batch_size:
+            yield batch_queries, batch_doc_groups
+            batch_queries, batch_doc_groups, n_pairs = [], [], 0
+    if batch_queries:
+        yield batch_queries, batch_doc_groups
@@ -0,0 +1,145 @@
+"""Script where the compact vocabulary shared by the models is kept.
+
+Instead of `word2index`/`index2word` dicts with a Python object per word, a :class:`Vocabulary` keeps
+- the words utf-8 encoded and packed in one byte array, with their offsets
+- the id of each word
+- a sorted array of 64 bit hashes of the words with the ids in the same order, to look words up
+  with a binary search
+
+All of them are numpy arrays, so a saved vocabulary is loaded without unpickling any dict and
+can be memory mapped with `Vocabulary.load(fname, mmap='r')`.
+
+Two different words having the same 64 bit hash is astronomically unlikely. It is checked for when
+words are added, but a looked up word which isn't in the vocabulary is trusted not to collide with one.
+"""
+
+import logging
+import numpy as np
+from gensim import utils
+
+from .embeddings import INDEX_DTYPE
+from .word_hashes import hash_words, lookup_hashes
+
+logger = logging.getLogger(__name__)
+
+
+def pack_words(words):
+    """Packs a list of str into a utf-8 byte buffer and the offsets of each word in it
+
+    Returns
+    -------
+    packed : numpy array of uint8
+    offsets : numpy array of int64 of shape (len(words) + 1,)
+    """
+    encoded = [word.encode('utf8') for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    packed = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return packed, offsets
+
+
+def unpack_words(packed, offsets):
+    """Inverse of :func:`pack_words`"""
+    buffer = np.asarray(packed).tobytes()
+    offsets = np.asarray(offsets).tolist()
+    return [buffer[start:end].decode('utf8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class Vocabulary(utils.SaveLoad):
+    """Maps words to int ids with a packed byte buffer and a sorted hash index"""
+    def __init__(self, words=(), ids=None, counts=None):
+        """
+        Parameters
+        ----------
+        words : list of str, optional
+            The words, without duplicates
+        ids : iterable of int, optional
+            The id of each word. If None, words are given their position in `words`
+        counts : iterable of int, optional
+            The counts of the first `len(counts)` words. The other words get a count of 0
+        """
+        self.packed = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=INDEX_DTYPE)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sorted_hashes = np.zeros(0, dtype=np.uint64)
+        self.sorted_ids = np.zeros(0, dtype=INDEX_DTYPE)
+        self.extend(words, ids, counts)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, word):
+        return self.lookup([word])[0] >= 0
+
+    def __getitem__(self, word):
+        index = self.lookup([word])[0]
+        if index < 0:
+            raise KeyError(word)
+        return int(index)
+
+    def __iter__(self):
+        return iter(self.words())
+
+    def words(self):
+        """Returns the list of words, in the order they were added"""
+        return unpack_words(self.packed, self.offsets)
+
+    def lookup(self, tokens, default=-1):
+        """Gets the ids of a batch of tokens
+
+        Parameters
+        ----------
+        tokens : list of str
+        default : int, optional
+            The id given to tokens which aren't in the vocabulary
+
+        Returns
+        -------
+        numpy array of INDEX_DTYPE of shape (len(tokens),)
+        """
+        return lookup_hashes(self.sorted_hashes, self.sorted_ids, tokens, default)
+
+    def extend(self, words, ids=None, counts=None):
+        """Adds new words to the vocabulary
+
+        Parameters
+        ----------
+        words : list of str
+            Words which aren't in the vocabulary yet
+        ids : iterable of int, optional
+            The id of each word. If None, they get the next positions after the existing words
+        counts : iterable of int, optional
+            The counts of the first `len(counts)` words. The other words get a count of 0
+
+        Raises
+        ------
+        ValueError : If a word is repeated or already in the vocabulary
+        """
+        words = list(words)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(words), dtype=INDEX_DTYPE)
+        else:
+            ids = np.asarray(ids, dtype=INDEX_DTYPE)
+        if len(ids) != len(words):
+            raise ValueError("Got %d ids for %d words" % (len(ids), len(words)))
+
+        new_counts = np.zeros(len(words), dtype=np.int64)
+        if counts is not None:
+            counts = np.fromiter(counts, dtype=np.int64)
+            new_counts[:len(counts)] = counts
+
+        packed, offsets = pack_words(words)
+        hashes = np.concatenate([self.sorted_hashes, hash_words(words)])
+        all_ids = np.concatenate([self.sorted_ids, ids])
+        order = np.argsort(hashes, kind='mergesort')
+        hashes, all_ids = hashes[order], all_ids[order]
+        if np.any(hashes[1:] == hashes[:-1]):
+            raise ValueError("The words added to the vocabulary must be unique and not already in it")
+
+        self.packed = np.concatenate([self.packed, packed])
+        self.offsets = np.concatenate([self.offsets, offsets[1:] + self.offsets[-1]])
+        self.ids = np.concatenate([self.ids, ids])
+        self.counts = np.concatenate([self.counts, new_counts])
+        self.sorted_hashes = hashes
+        self.sorted_ids = all_ids
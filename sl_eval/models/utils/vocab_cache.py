@@ -0,0 +1,169 @@
+"""Script where the on-disk cache of the models' vocabularies and embedding matrices is kept.
+
+Building the vocabulary and the embedding matrix over a full pretrained embedding file takes a while.
+The results are saved in a folder named after a fingerprint of everything they depend on:
+- the training corpus
+- the KeyedVectors
+- `unk_handle_method` and `normalize_embeddings`
+
+Later runs with the same inputs memory map the saved arrays instead of rebuilding them.
+
+Folder layout
+-------------
+<cache_dir>/<key>/
+    embedding_matrix.npy : float array of shape (n_rows, embedding_dim). The seeded vectors of the words
+        which aren't in the KeyedVectors are kept in it, so they are never generated again
+    vocab, vocab.*.npy : the :class:`~sl_eval.models.utils.vocab.Vocabulary` with all its arrays
+        stored separately, so they can be memory mapped
+    meta.json : the pad and unk word indices and the train vocab size
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+
+from .vocab import Vocabulary
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of the cached files or the way they are built changes
+CACHE_VERSION = 4
+
+_kv_fingerprints = weakref.WeakKeyDictionary()
+
+
+class CorpusFingerprint:
+    """Incrementally hashes the sentences of a corpus"""
+    def __init__(self):
+        self._md5 = hashlib.md5()
+
+    def update(self, sentence):
+        """Adds a sentence to the fingerprint
+
+        Parameters
+        ----------
+        sentence : list of str
+        """
+        self._md5.update(('\x1f'.join(sentence) + '\x1e').encode('utf8'))
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def keyed_vectors_fingerprint(kv_model, n_sample_rows=1000):
+    """Gets a hash of a KeyedVectors object from its words and a strided sample of its vectors.
+    The result is memoized per object.
+
+    Parameters
+    ----------
+    kv_model : :class:`~gensim.models.keyedvectors.KeyedVectors`
+    n_sample_rows : int, optional
+        The number of vectors which are hashed
+    """
+    try:
+        return _kv_fingerprints[kv_model]
+    except (KeyError, TypeError):
+        pass
+
+    md5 = hashlib.md5()
+    md5.update(str((kv_model.vectors.shape, kv_model.vectors.dtype.str)).encode('utf8'))
+    md5.update('\n'.join(kv_model.index2word).encode('utf8'))
+    stride = max(1, len(kv_model.vectors) // n_sample_rows)
+    md5.update(np.ascontiguousarray(kv_model.vectors[::stride]).tobytes())
+    fingerprint = md5.hexdigest()
+
+    try:
+        _kv_fingerprints[kv_model] = fingerprint
+    except TypeError:
+        pass
+    return fingerprint
+
+
+def get_cache_key(corpus_fingerprint, kv_model, unk_handle_method, normalize_embeddings, **kwargs):
+    """Gets the name of the cache folder for the given inputs
+
+    Parameters
+    ----------
+    corpus_fingerprint : str
+        The hexdigest of a :class:`CorpusFingerprint` over the training corpus
+    kv_model : :class:`~gensim.models.keyedvectors.KeyedVectors`
+    unk_handle_method : {'zero', 'random'}
+    normalize_embeddings : bool
+    kwargs : dict
+        Any other settings which change the built vocab or embedding matrix
+    """
+    settings = dict(kwargs, version=CACHE_VERSION, corpus=corpus_fingerprint,
+                    kv=keyed_vectors_fingerprint(kv_model), unk_handle_method=unk_handle_method,
+                    normalize_embeddings=bool(normalize_embeddings))
+    return hashlib.md5(json.dumps(settings, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def save_vocab_cache(cache_dir, key, vocab, vocab_size, embedding_matrix, pad_word_index, unk_word_index):
+    """Saves a built vocab and embedding matrix under `cache_dir`/`key`
+
+    The files are written to a temporary folder which is then renamed, so a half written cache
+    is never picked up by :func:`load_vocab_cache`.
+
+    Parameters
+    ----------
+    cache_dir : str
+    key : str
+        See :func:`get_cache_key`
+    vocab : :class:`~sl_eval.models.utils.vocab.Vocabulary`
+        All the indexed words
+    vocab_size : int
+        The number of train vocab words
+    embedding_matrix : numpy array
+    pad_word_index : int
+    unk_word_index : int
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    final_path = os.path.join(cache_dir, key)
+    tmp_path = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+    try:
+        np.save(os.path.join(tmp_path, 'embedding_matrix.npy'), embedding_matrix)
+        vocab.save(os.path.join(tmp_path, 'vocab'), sep_limit=0)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'vocab_size': int(vocab_size), 'pad_word_index': int(pad_word_index),
+                       'unk_word_index': int(unk_word_index)}, f)
+        os.rename(tmp_path, final_path)
+    except OSError:
+        # Another process may have written the same cache in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(final_path):
+            raise
+    logger.info("Saved the vocab and embedding matrix to the cache at %s", final_path)
+
+
+def load_vocab_cache(cache_dir, key, mmap_mode='r'):
+    """Loads what :func:`save_vocab_cache` saved
+
+    Parameters
+    ----------
+    cache_dir : str
+    key : str
+        See :func:`get_cache_key`
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional
+        Passed on to `np.load` for the embedding matrix and the vocab arrays
+
+    Returns
+    -------
+    dict or None
+        None if there is no such cache. Otherwise a dict with the keys:
+        'embedding_matrix', 'vocab', 'vocab_size', 'pad_word_index', 'unk_word_index'
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        cached = json.load(f)
+    cached['embedding_matrix'] = np.load(os.path.join(path, 'embedding_matrix.npy'), mmap_mode=mmap_mode)
+    cached['vocab'] = Vocabulary.load(os.path.join(path, 'vocab'), mmap=mmap_mode)
+    logger.info("Loaded the vocab and embedding matrix from the cache at %s", path)
+    return cached
@@ -0,0 +1,56 @@
+"""Script where words are hashed and looked up in the sorted hash index of a
+:class:`~sl_eval.models.utils.vocab.Vocabulary`.
+
+It only depends on numpy, so the index can be used by the NumPy scorers without gensim.
+"""
+
+import hashlib
+import numpy as np
+
+from .embeddings import INDEX_DTYPE
+
+
+def hash_words(words):
+    """Gets a 64 bit hash of each word which is the same across processes and Python versions
+
+    Parameters
+    ----------
+    words : iterable of str
+
+    Returns
+    -------
+    numpy array of uint64
+    """
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(word.encode('utf8'), digest_size=8).digest(), 'little') for word in words),
+        dtype=np.uint64
+    )
+
+
+def lookup_hashes(sorted_hashes, sorted_ids, tokens, default=-1):
+    """Gets the ids of a batch of tokens from a sorted hash index
+
+    Parameters
+    ----------
+    sorted_hashes : numpy array of uint64
+        The hashes of the words, sorted
+    sorted_ids : numpy array of int
+        The id of the word of each hash
+    tokens : list of str
+    default : int, optional
+        The id given to tokens which aren't in the index
+
+    Returns
+    -------
+    numpy array of INDEX_DTYPE of shape (len(tokens),)
+    """
+    hashes = hash_words(tokens)
+    result = np.full(len(hashes), default, dtype=INDEX_DTYPE)
+    if len(sorted_hashes) == 0 or len(hashes) == 0:
+        return result
+
+    positions = np.searchsorted(sorted_hashes, hashes)
+    np.minimum(positions, len(sorted_hashes) - 1, out=positions)
+    found = sorted_hashes[positions] == hashes
+    result[found] = sorted_ids[positions[found]]
+    return result
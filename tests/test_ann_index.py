@@ -0,0 +1,106 @@
+"""Tests of the nearest neighbour indexes of :mod:`~sl_eval.models.utils.ann_index`"""
+
+import doctest
+
+import numpy as np
+import pytest
+
+from sl_eval.models.utils.ann_index import ExactIndex, IVFIndex, LSHIndex, get_ann_index
+
+N_RESULTS = 10
+
+
+def _clustered_vectors(random_state, n_vectors, n_clusters=50, dim=32):
+    """Vectors around random centers, like sentence vectors fall around topics"""
+    centers = random_state.randn(n_clusters, dim)
+    return centers[random_state.randint(n_clusters, size=n_vectors)] + 0.5 * random_state.randn(n_vectors, dim)
+
+
+@pytest.fixture(scope='module')
+def data():
+    random_state = np.random.RandomState(0)
+    vectors = _clustered_vectors(random_state, 5100)
+    return vectors[:5000], vectors[5000:]
+
+
+@pytest.fixture(scope='module')
+def exact_results(data):
+    docs, queries = data
+    return ExactIndex(batch_size=32).fit(docs).search(queries, N_RESULTS)
+
+
+def _recall(ids, exact_ids):
+    return np.mean([len(set(row) & set(exact_row)) / len(exact_row) for row, exact_row in zip(ids, exact_ids)])
+
+
+def test_exact_index(data, exact_results):
+    docs, queries = data
+    ids, similarities = exact_results
+    docs = docs / np.linalg.norm(docs, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = np.dot(queries, docs.T)
+    assert ids.shape == similarities.shape == (len(queries), N_RESULTS)
+    assert (ids == np.argsort(-scores, axis=1)[:, :N_RESULTS]).all()
+    np.testing.assert_allclose(similarities, np.take_along_axis(scores, ids, axis=1), rtol=1e-5)
+
+
+def test_ivf_probing_all_lists_is_exact(data, exact_results):
+    docs, queries = data
+    ids, similarities = IVFIndex(n_lists=20, n_probe=20).fit(docs).search(queries, N_RESULTS)
+    assert (ids == exact_results[0]).all()
+    np.testing.assert_allclose(similarities, exact_results[1], rtol=1e-5)
+
+
+def test_lsh_with_large_buckets_is_exact(data, exact_results):
+    docs, queries = data
+    # With a single bit, half the docs share the bucket of a query in each table, and the nearest docs
+    # share it in at least one of many tables
+    ids, similarities = LSHIndex(n_bits=1, n_tables=16).fit(docs).search(queries, N_RESULTS)
+    assert (ids == exact_results[0]).all()
+    np.testing.assert_allclose(similarities, exact_results[1], rtol=1e-5)
+
+
+@pytest.mark.parametrize('index_type', ['exact', 'ivf', 'lsh'])
+def test_default_recall(data, exact_results, index_type):
+    docs, queries = data
+    ids, similarities = get_ann_index(index_type).fit(docs).search(queries, N_RESULTS)
+    assert _recall(ids, exact_results[0]) >= 0.95
+    # The docs found are in decreasing order of similarity
+    assert (np.diff(similarities, axis=1) <= 0).all()
+
+
+def test_ivf_recall_grows_with_n_probe():
+    # Random vectors have no clusters, the hardest case for an inverted file
+    random_state = np.random.RandomState(1)
+    docs, queries = random_state.randn(5000, 32), random_state.randn(100, 32)
+    exact_ids, _ = ExactIndex().fit(docs).search(queries, N_RESULTS)
+    recalls = [_recall(IVFIndex(n_lists=50, n_probe=n_probe).fit(docs).search(queries, N_RESULTS)[0], exact_ids)
+               for n_probe in [5, 25, 50]]
+    assert recalls[0] < recalls[1] < recalls[2] == 1
+
+
+@pytest.mark.parametrize('index', [ExactIndex(), IVFIndex(n_lists=4, n_probe=1), LSHIndex(n_bits=16, n_tables=1)])
+def test_padding(index):
+    random_state = np.random.RandomState(2)
+    docs = random_state.randn(6, 8)
+    ids, similarities = index.fit(docs).search(docs[:3], 10)
+    assert ids.shape == similarities.shape == (3, 10)
+    for row, row_similarities in zip(ids, similarities):
+        n_found = np.sum(row >= 0)
+        # Each doc at least finds itself
+        assert 1 <= n_found <= 6
+        assert (row[n_found:] == -1).all() and np.isneginf(row_similarities[n_found:]).all()
+        assert np.isfinite(row_similarities[:n_found]).all()
+    assert (ids[:, 0] == np.arange(3)).all()
+
+
+def test_unknown_index_type():
+    with pytest.raises(ValueError):
+        get_ann_index('annoy')
+
+
+def test_mean_recall():
+    evaluation_metrics = pytest.importorskip('sl_eval.models.utils.evaluation_metrics')
+    assert doctest.testmod(evaluation_metrics).failed == 0
+    assert evaluation_metrics.mean_recall([[3, 1, 4], [1, 5, 9], [2, 6, 5]], [[1, 7], [9], []], k=2) == 0.25
+    assert evaluation_metrics.mean_recall([[3, 1, 4], [1, 5, 9]], [[1, 7], [9]]) == 0.75
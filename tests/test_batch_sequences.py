@@ -0,0 +1,42 @@
+"""Tests of the keras Sequences of :mod:`~sl_eval.models.utils.batch_sequences`"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gensim')
+pytest.importorskip('keras')
+
+from sl_eval.models.utils.batch_sequences import TripletSequence  # noqa: E402
+
+
+def _make_batch(X1, X2, y):
+    return X2[0::2].copy(), y
+
+
+@pytest.fixture
+def sequence():
+    triplets = tuple(np.arange(start, start + 12, dtype=np.int32) for start in (0, 100, 200))
+    return TripletSequence(triplets, 4, _make_batch, seed=3)
+
+
+def _epoch_order(sequence):
+    return np.concatenate([sequence[i][0] for i in range(len(sequence))]).tolist()
+
+
+def test_set_epoch(sequence):
+    first = _epoch_order(sequence)
+    assert sorted(first) == list(range(100, 112))
+
+    # Keras calling on_epoch_end as well doesn't move the sequence twice
+    sequence.on_epoch_end()
+    assert _epoch_order(sequence) == first
+
+    sequence.set_epoch(1)
+    second = _epoch_order(sequence)
+    assert second != first and sorted(second) == sorted(first)
+    sequence.set_epoch(1)
+    assert _epoch_order(sequence) == second
+
+    # The order of an epoch only depends on the seed and the epoch
+    sequence.set_epoch(0)
+    assert _epoch_order(sequence) == first
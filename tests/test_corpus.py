@@ -0,0 +1,208 @@
+"""Tests that the batches made from an :class:`~sl_eval.models.utils.corpus.IndexedCorpus` hold the same
+training pairs as the batches the models used to make from the strings, with `_get_pair_list` and
+`_get_full_batch_iter`
+"""
+
+from itertools import islice
+from functools import partial
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gensim')
+
+from sl_eval.models.utils.corpus import (  # noqa: E402
+    build_indexed_corpus, get_triplets, interleave_pairs, iter_pair_batches, sample_triplets
+)
+
+TEXT_MAXLEN = 5
+
+QUERIES = [
+    'what is a cat'.split(),
+    'nothing to rank'.split(),
+    'only good answers'.split(),
+    'only bad answers'.split(),
+    'how do planes fly'.split(),
+    'why is the sky blue'.split(),
+]
+DOCS = [
+    ['a cat is an animal'.split(), 'dogs bark'.split(),
+     'cats purr loudly at night when they are hungry'.split()],
+    [],
+    ['good answer'.split(), 'another good answer'.split()],
+    ['bad answer'.split(), 'another bad answer'.split()],
+    ['birds fly'.split(), 'planes fly with wings that make lift'.split(), [], 'lift from the wings'.split()],
+    ['light is scattered by the air more for blue light'.split(), 'the sky is big'.split(),
+     'rayleigh scattering'.split()],
+]
+LABELS = [[1, 0, 0], [], [1, 1], [0, 0], [0, 1, 0, 1], [1, 0, 1]]
+N_TRIPLETS = 8
+
+
+def _baseline_pair_list(queries, docs, labels, _make_indexed):
+    """One pass of `_get_pair_list` as the models had it before the corpus was indexed.
+    It can't unpack a group without docs, so those are skipped."""
+    for q, doc, label in zip(queries, docs, labels):
+        if not doc:
+            continue
+        doc, label = (list(t) for t in zip(*sorted(zip(doc, label), reverse=True)))
+        for item in zip(doc, label):
+            if item[1] == 1:
+                for new_item in zip(doc, label):
+                    if new_item[1] == 0:
+                        yield (_make_indexed(q), _make_indexed(item[0]), _make_indexed(new_item[0]))
+
+
+def _baseline_full_batch_iter(pair_list, batch_size):
+    """`_get_full_batch_iter` as the models had it before the corpus was indexed"""
+    X1, X2, y = [], [], []
+    while True:
+        for i, (query, pos_doc, neg_doc) in enumerate(pair_list):
+            X1.append(query)
+            X2.append(pos_doc)
+            y.append(1)
+            X1.append(query)
+            X2.append(neg_doc)
+            y.append(0)
+            if i % batch_size == 0 and i != 0:
+                yield ({'query': np.array(X1), 'doc': np.array(X2)}, np.array(y))
+                X1, X2, y = [], [], []
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    return build_indexed_corpus(QUERIES, DOCS, LABELS)[0]
+
+
+@pytest.fixture(scope='module')
+def make_indexed(corpus):
+    """`_make_indexed` of the models before the corpus was indexed, over the vocab of the corpus"""
+    word2index = {word: i for i, word in enumerate(corpus.words)}
+    pad_word_index, unk_word_index = len(word2index), len(word2index) + 1
+
+    def _make_indexed(sentence):
+        indexed_sent = [word2index.get(word, unk_word_index) for word in sentence][:TEXT_MAXLEN]
+        return indexed_sent + [pad_word_index] * (TEXT_MAXLEN - len(indexed_sent))
+    return _make_indexed
+
+
+@pytest.fixture(scope='module')
+def baseline_triplets(make_indexed):
+    triplets = list(_baseline_pair_list(QUERIES, DOCS, LABELS, make_indexed))
+    assert len(triplets) == N_TRIPLETS
+    return triplets
+
+
+def _padded_triplets(corpus, query_idx, pos_idx, neg_idx):
+    pad_word_index = len(corpus.words)
+    sentences = [corpus.pad_sentences(idx, TEXT_MAXLEN, pad_word_index).tolist()
+                 for idx in (query_idx, pos_idx, neg_idx)]
+    return list(zip(*sentences))
+
+
+def _as_multiset(triplets):
+    return sorted(tuple(tuple(sentence) for sentence in triplet) for triplet in triplets)
+
+
+def test_build_indexed_corpus(corpus):
+    assert len(corpus) == len(QUERIES)
+    assert corpus.group_sizes.tolist() == [len(doc) for doc in DOCS]
+    assert corpus.labels == LABELS
+    sentences = [s for q, doc in zip(QUERIES, DOCS) for s in [q] + doc]
+    assert corpus.lengths.tolist() == [len(s) for s in sentences]
+    words = np.array(corpus.words)
+    for i, sentence in enumerate(sentences):
+        assert words[corpus.ids[corpus.offsets[i]: corpus.offsets[i + 1]]].tolist() == sentence
+    assert [sentences[g] for g in corpus.group_offsets[:-1]] == QUERIES
+
+
+def test_build_indexed_corpus_in_workers(corpus):
+    in_workers, _, fingerprint = build_indexed_corpus(QUERIES, DOCS, LABELS, n_workers=2, shard_size=3)
+    assert in_workers.words == corpus.words
+    assert in_workers.ids.tolist() == corpus.ids.tolist()
+    assert in_workers.lengths.tolist() == corpus.lengths.tolist()
+    assert in_workers.group_offsets.tolist() == corpus.group_offsets.tolist()
+    assert fingerprint.hexdigest() == build_indexed_corpus(QUERIES, DOCS, LABELS, shard_size=3)[2].hexdigest()
+
+
+def test_pad_sentences(corpus, make_indexed):
+    sentences = [s for q, doc in zip(QUERIES, DOCS) for s in [q] + doc]
+    padded = corpus.pad_sentences(np.arange(len(sentences)), TEXT_MAXLEN, len(corpus.words))
+    assert padded.tolist() == [make_indexed(s) for s in sentences]
+
+
+def test_triplets_match_baseline(corpus, baseline_triplets):
+    triplets = _padded_triplets(corpus, *get_triplets(corpus))
+    assert _as_multiset(triplets) == _as_multiset(baseline_triplets)
+
+
+def test_sample_all_triplets_match_baseline(corpus, baseline_triplets):
+    # With as many negatives as there are docs, every triplet is sampled
+    sampled = sample_triplets(corpus, 4, np.random.RandomState(0))
+    assert _as_multiset(_padded_triplets(corpus, *sampled)) == _as_multiset(baseline_triplets)
+
+
+def test_sample_one_negative_per_positive(corpus, baseline_triplets):
+    query_idx, pos_idx, neg_idx = sample_triplets(corpus, 1, np.random.RandomState(0))
+    # The relevant docs of the groups with irrelevant docs, each once
+    assert sorted(pos_idx.tolist()) == [1, 13, 15, 17, 19]
+    assert set(_as_multiset(_padded_triplets(corpus, query_idx, pos_idx, neg_idx))) <= set(
+        _as_multiset(baseline_triplets))
+
+
+def test_sample_hard_negatives(corpus):
+    doc_scores = np.zeros(len(corpus.lengths))
+    doc_scores[[3, 14]] = 1.
+    _, _, neg_idx = sample_triplets(corpus, 1, np.random.RandomState(0), doc_scores=doc_scores)
+    assert neg_idx.tolist() == [3, 14, 14, 18, 18]
+
+
+def _epoch_pairs(batches, n_pairs):
+    """The (query, doc, label) rows of the first `n_pairs` pairs of the batches"""
+    rows = []
+    for x, y in batches:
+        rows.extend(zip(map(tuple, x['query'].tolist()), map(tuple, x['doc'].tolist()), y.tolist()))
+        if len(rows) >= n_pairs:
+            return rows[:n_pairs]
+
+
+def _corpus_batches(corpus, triplets, batch_size, seed=None):
+    pad_word_index = len(corpus.words)
+    for X1, X2, y in iter_pair_batches(triplets, batch_size, seed=seed):
+        assert X1.shape == X2.shape == y.shape == (2 * batch_size,)
+        assert y.tolist() == [1, 0] * batch_size
+        assert (X1[0::2] == X1[1::2]).all()
+        yield ({'query': corpus.pad_sentences(X1, TEXT_MAXLEN, pad_word_index),
+                'doc': corpus.pad_sentences(X2, TEXT_MAXLEN, pad_word_index)}, y.astype(int))
+
+
+@pytest.mark.parametrize('seed', [None, 7])
+def test_pair_batches_match_baseline(corpus, baseline_triplets, seed):
+    batch_size = 4
+    baseline = _epoch_pairs(_baseline_full_batch_iter(baseline_triplets, batch_size), 2 * N_TRIPLETS)
+    batches = _corpus_batches(corpus, get_triplets(corpus), batch_size, seed=seed)
+    assert sorted(_epoch_pairs(batches, 2 * N_TRIPLETS)) == sorted(baseline)
+
+
+def test_pair_batches_carry_over_epochs(corpus):
+    # 3 doesn't divide the 8 triplets, so the batches run across epochs and every triplet still comes
+    # by once per epoch
+    triplets = get_triplets(corpus)
+    batches = islice(iter_pair_batches(triplets, 3, seed=1), 8)
+    seen = np.concatenate([X2[0::2].copy() for X1, X2, y in batches])
+    for epoch in range(3):
+        assert sorted(seen[epoch * N_TRIPLETS: (epoch + 1) * N_TRIPLETS]) == sorted(triplets[1])
+
+
+def test_pair_batches_from_sampled_triplets(corpus):
+    draw = partial(sample_triplets, corpus, 1)
+    X1, X2, y = next(iter_pair_batches(draw, 5, seed=0))
+    assert sorted(X2[0::2]) == [1, 13, 15, 17, 19]
+    assert interleave_pairs(X1[0::2], X2[0::2], X2[1::2])[2].tolist() == y.tolist()
+
+
+def test_no_triplets():
+    corpus = build_indexed_corpus(QUERIES[1:4], DOCS[1:4], LABELS[1:4])[0]
+    assert all(len(idx) == 0 for idx in get_triplets(corpus))
+    with pytest.raises(ValueError):
+        next(iter_pair_batches(get_triplets(corpus), 2))
@@ -0,0 +1,78 @@
+"""Tests of :class:`~sl_eval.models.utils.vocab.Vocabulary`"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('gensim')
+
+from sl_eval.models.utils import vocab as vocab_module  # noqa: E402
+from sl_eval.models.utils.embeddings import INDEX_DTYPE  # noqa: E402
+from sl_eval.models.utils.vocab import Vocabulary  # noqa: E402
+
+WORDS = ['the', 'cat', 'sat', 'on', 'mat', 'état', '猫']
+
+
+def test_lookup_known_words():
+    vocab = Vocabulary(WORDS)
+    ids = vocab.lookup(WORDS)
+    assert ids.dtype == INDEX_DTYPE
+    assert ids.tolist() == list(range(len(WORDS)))
+    assert vocab['état'] == 5
+    assert '猫' in vocab
+    assert vocab.words() == WORDS
+
+
+def test_lookup_unknown_words():
+    vocab = Vocabulary(WORDS)
+    assert vocab.lookup(['dog', 'cat', '', 'The']).tolist() == [-1, 1, -1, -1]
+    assert vocab.lookup(['dog', 'cat'], default=42).tolist() == [42, 1]
+    assert 'dog' not in vocab
+    with pytest.raises(KeyError):
+        vocab['dog']
+    assert Vocabulary().lookup(['cat']).tolist() == [-1]
+    assert vocab.lookup([]).tolist() == []
+
+
+def test_colliding_words(monkeypatch):
+    # Only keeps 2 bits of the hash, so 5 different words are bound to collide
+    monkeypatch.setattr(vocab_module, 'hash_words', lambda words: np.array(
+        [hash(word) % 4 for word in words], dtype=np.uint64))
+    with pytest.raises(ValueError):
+        Vocabulary(['a', 'b', 'c', 'd', 'e'])
+
+    with pytest.raises(ValueError):
+        Vocabulary(['a', 'a'])
+
+
+def test_extend_keeps_ids():
+    vocab = Vocabulary(WORDS[:3], counts=[5, 3])
+    before = vocab.lookup(WORDS[:3])
+
+    vocab.extend(WORDS[3:5])
+    vocab.extend(WORDS[5:], ids=[100, 200])
+    assert vocab.lookup(WORDS[:3]).tolist() == before.tolist()
+    assert vocab.lookup(WORDS).tolist() == [0, 1, 2, 3, 4, 100, 200]
+    assert vocab.counts.tolist() == [5, 3, 0, 0, 0, 0, 0]
+    assert vocab.words() == WORDS
+
+    with pytest.raises(ValueError):
+        vocab.extend(['cat'])
+    with pytest.raises(ValueError):
+        vocab.extend(['dog'], ids=[1, 2])
+
+
+@pytest.mark.parametrize('mmap', [None, 'r'])
+def test_save_load(tmpdir, mmap):
+    vocab = Vocabulary(WORDS[:4], counts=[1, 2, 3, 4])
+    vocab.extend(WORDS[4:], ids=[10, 11, 12])
+    fname = str(tmpdir.join('vocab'))
+    vocab.save(fname, sep_limit=0)
+
+    loaded = Vocabulary.load(fname, mmap=mmap)
+    assert loaded.words() == WORDS
+    assert loaded.lookup(WORDS + ['dog']).tolist() == [0, 1, 2, 3, 10, 11, 12, -1]
+    assert loaded.counts.tolist() == vocab.counts.tolist()
+
+    # A memory mapped vocab is read only, but it can still be extended
+    loaded.extend(['dog'])
+    assert loaded['dog'] == 7